@@ -0,0 +1,100 @@
+"""
+Pre-aggregated activity of groups.
+
+For every group and every hour and day, `roll_up()` stores the number of
+messages posted, likes given and distinct users who posted as GroupActivity
+rows, so dashboards read a few rollup rows instead of the messages table.
+
+The rollup is a batch job, `python manage.py rollup_activity`, kept off the
+chat hot path. Each run reads messages and likes through their timestamp
+indexes, one window of CHAT_ACTIVITY_BATCH_DAYS days at a time, and
+replaces the rollups of that window in one transaction. Without `since` a
+run picks up from the start of the last day it rolled up, which it counts
+again in full, so running it every few minutes keeps today's numbers fresh.
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from .models import GroupActivity, Message, MessageLike
+
+TRUNCATE = {
+    GroupActivity.HOUR: TruncHour,
+    GroupActivity.DAY: TruncDay,
+}
+
+# Columns of each bucket returned by the activity endpoint
+ACTIVITY_FIELDS = ['start', 'messages', 'likes', 'active_users']
+
+
+def start_of_day(moment):
+    return timezone.localtime(moment).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def count_activity(period, since, until):
+    """
+    Return unsaved GroupActivity rows of `period` for messages and likes in [since, until).
+    """
+    trunc = TRUNCATE[period]
+    buckets = defaultdict(lambda: {'messages': 0, 'likes': 0, 'active_users': 0})
+    messages = (
+        Message.objects.filter(timestamp__gte=since, timestamp__lt=until)
+        .annotate(start=trunc('timestamp'))
+        .values('group_id', 'start')
+        .annotate(messages=Count('id'), active_users=Count('user_id', distinct=True))
+        .order_by()
+    )
+    for row in messages:
+        bucket = buckets[row['group_id'], row['start']]
+        bucket['messages'] = row['messages']
+        bucket['active_users'] = row['active_users']
+    likes = (
+        MessageLike.objects.filter(timestamp__gte=since, timestamp__lt=until)
+        .annotate(start=trunc('timestamp'))
+        .values('message__group_id', 'start')
+        .annotate(likes=Count('id'))
+        .order_by()
+    )
+    for row in likes:
+        buckets[row['message__group_id'], row['start']]['likes'] = row['likes']
+    return [
+        GroupActivity(group_id=group_id, period=period, start=start, **counts)
+        for (group_id, start), counts in buckets.items()
+    ]
+
+
+def roll_up(since=None, until=None):
+    """
+    Recount the activity between `since` and `until` (now by default).
+
+    `since` is moved back to the start of its day so that day buckets are
+    always complete. Returns the number of rollup rows written.
+    """
+    if until is None:
+        until = timezone.now()
+    if since is None:
+        since = GroupActivity.objects.filter(period=GroupActivity.DAY).aggregate(Max('start'))['start__max']
+    if since is None:
+        # Nothing rolled up yet, start from the oldest message
+        since = Message.objects.aggregate(Min('timestamp'))['timestamp__min']
+    if since is None:
+        return 0
+
+    window = timedelta(days=getattr(settings, 'CHAT_ACTIVITY_BATCH_DAYS', 7))
+    since = start_of_day(since)
+    written = 0
+    while since < until:
+        end = min(since + window, until)
+        rows = count_activity(GroupActivity.HOUR, since, end) + count_activity(GroupActivity.DAY, since, end)
+        with transaction.atomic():
+            GroupActivity.objects.filter(start__gte=since, start__lt=end).delete()
+            GroupActivity.objects.bulk_create(rows, batch_size=500)
+        written += len(rows)
+        since = end
+    return written
@@ -1,6 +1,20 @@
 from django.contrib import admin
 
-from .models import Group, Message
+from .models import Attachment, Group, GroupActivity, Membership, Message, MessageLike, Mention
 
-admin.site.register(Group)
+
+class MembershipInline(admin.TabularInline):
+    model = Membership
+    raw_id_fields = ('user',)
+
+
+@admin.register(Group)
+class GroupAdmin(admin.ModelAdmin):
+    inlines = [MembershipInline]
+
+
+admin.site.register(Attachment)
 admin.site.register(Message)
+admin.site.register(MessageLike)
+admin.site.register(Mention)
+admin.site.register(GroupActivity)
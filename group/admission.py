@@ -0,0 +1,168 @@
+"""
+Admission control and graceful drain of WebSocket workers.
+
+A worker holds at most CHAT_MAX_CONNECTIONS sockets, and a room at most
+CHAT_MAX_ROOM_CONNECTIONS across every worker sharing the cache (None lifts
+a limit). A socket over a limit is accepted just long enough to be told why,
+then closed:
+
+- a full worker closes with 1013 (try again later) and a `reconnect` hint,
+  so the client retries, most likely on another worker,
+- a full room closes with CLOSE_ROOM_FULL and a `rejected` frame, as
+  retrying right away would not help.
+
+`drain()` prepares a worker for shutdown: it stops admitting sockets,
+flushes pending work, tells every client to reconnect after a random delay
+of up to CHAT_DRAIN_RECONNECT_SPREAD seconds, closes the sockets with 1012
+(service restart) and, once they are gone, stops the process. Spreading the
+delays keeps a rolling deploy from turning into a reconnect storm. Sending
+CHAT_DRAIN_SIGNAL (SIGUSR1 by default) to a worker starts a drain.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import signal
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import fanout, profiling
+from .mentions import mention_worker
+from .writer import db_writer
+
+logger = logging.getLogger(__name__)
+
+CLOSE_RESTARTING = 1012
+CLOSE_OVERLOADED = 1013
+CLOSE_ROOM_FULL = 4001
+
+# Open sockets of this process
+_consumers = weakref.WeakSet()
+_draining = False
+_signal_installed = False
+
+
+def max_connections():
+    return getattr(settings, 'CHAT_MAX_CONNECTIONS', None)
+
+
+def max_room_connections():
+    return getattr(settings, 'CHAT_MAX_ROOM_CONNECTIONS', None)
+
+
+def retry_after(spread=None):
+    """
+    Pick a random reconnect delay in seconds, so clients do not come back at once.
+    """
+    if spread is None:
+        spread = getattr(settings, 'CHAT_DRAIN_RECONNECT_SPREAD', 30)
+    return round(random.uniform(1, max(1, spread)), 1)
+
+
+def connection_count():
+    return len(_consumers)
+
+
+def is_draining():
+    return _draining
+
+
+def admit(consumer):
+    """
+    Count `consumer` against the worker's limit.
+
+    Returns None if it is admitted, or the `(close_code, frame)` to reject it
+    with. An admitted consumer must be released with `release()`.
+    """
+    _install_signal_handler()
+    if _draining:
+        return CLOSE_RESTARTING, {'action': 'reconnect', 'retry_after': retry_after()}
+    limit = max_connections()
+    if limit is not None and len(_consumers) >= limit:
+        return CLOSE_OVERLOADED, {'action': 'reconnect', 'retry_after': retry_after()}
+    _consumers.add(consumer)
+    return None
+
+
+def release(consumer):
+    _consumers.discard(consumer)
+
+
+def join_room(slug):
+    """
+    Count a socket in the room like `fanout.join`, unless the room is full.
+
+    Returns `(shards, grown)`, or None if the room is full.
+    """
+    shards, grown = fanout.join(slug)
+    limit = max_room_connections()
+    if limit is not None and fanout.room_size(slug) > limit:
+        fanout.leave(slug)
+        return None
+    return shards, grown
+
+
+def room_full_rejection():
+    return CLOSE_ROOM_FULL, {'action': 'rejected', 'reason': 'room_full'}
+
+
+async def drain(timeout=None, exit=True):
+    """
+    Stop admitting sockets, flush pending work, send every client away with a
+    spread-out reconnect hint and wait up to `timeout` seconds for them to go.
+
+    With `exit`, the process then terminates itself with SIGTERM so that the
+    server shuts down as usual.
+    """
+    global _draining
+    if timeout is None:
+        timeout = getattr(settings, 'CHAT_DRAIN_TIMEOUT', 10)
+    _draining = True
+    consumers = list(_consumers)
+    logger.info('Draining %d sockets', len(consumers))
+
+    # Messages and mentions still queued would be lost with the process
+    await db_writer.flush()
+    await sync_to_async(mention_worker.flush, thread_sensitive=False)()
+    profiling.flush()
+
+    await asyncio.gather(
+        *(consumer.close_for_restart(retry_after()) for consumer in consumers),
+        return_exceptions=True,
+    )
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while _consumers and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    if _consumers:
+        logger.warning('%d sockets still open after draining for %s seconds', len(_consumers), timeout)
+
+    if exit:
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+def _install_signal_handler():
+    """
+    Start a drain when CHAT_DRAIN_SIGNAL is received, once per process.
+
+    Installed from the first connection, as that is the first time the
+    server's event loop is known.
+    """
+    global _signal_installed
+    if _signal_installed:
+        return
+    _signal_installed = True
+    name = getattr(settings, 'CHAT_DRAIN_SIGNAL', 'SIGUSR1')
+    if not name or not hasattr(signal, name):
+        return
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            getattr(signal, name), lambda: asyncio.ensure_future(drain()),
+        )
+    except (NotImplementedError, RuntimeError, ValueError):
+        # Not on the main thread, or not supported by this platform's loop
+        logger.info('Not draining on %s, signal handlers are not available', name)
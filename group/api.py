@@ -0,0 +1,158 @@
+"""
+REST API views.
+
+Django REST framework is only imported by this module, which `group.urls`
+loads the first time an /api/ route is requested, so workers that never
+serve the API never pay for importing it.
+"""
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from .provisioning import astream_results, provision_users, stream_results
+
+
+@api_view(['POST'])
+def create_user(request):
+    """
+    API endpoint to create a new user.
+
+    This view allows users to register by providing a unique username and password in the request data.
+    If the provided username or password is missing, it will return a 400 Bad Request error.
+    If the username is already taken, it will return a 400 Bad Request error.
+    If the username is available and the password is provided, it will create a new user with the given
+    username and password, and return a 201 Created response with a success message.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object containing the user's data.
+
+    Returns:
+        Response: JSON response with a success message if the user is created successfully,
+                  or an error message if the username is already taken or validation fails.
+
+    """
+    if request.method == 'POST':
+        username = request.data.get('username')
+        password = request.data.get('password')
+        # Perform basic validation
+        if not username or not password:
+            return Response({'error': 'Both username and password are required.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            # Check if the username already exists
+            user = User.objects.get(username=username)
+            return Response({'error': 'Username already exists.'}, status=status.HTTP_400_BAD_REQUEST)
+        except User.DoesNotExist:
+            # Create a new user
+            user = User.objects.create_user(username=username, password=password)
+            return Response({'message': 'User created successfully.'}, status=status.HTTP_201_CREATED)
+
+
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def create_users(request):
+    """
+    API endpoint to create many users at once, for staff users only.
+
+    Expects a JSON body of the form {"users": [{"username": ..., "password": ...}, ...]}.
+    Usernames that already exist are found with a single query per 500 names, passwords
+    are hashed in parallel on a process pool and the new users are inserted in batches.
+    If the "users" list is missing or longer than CHAT_PROVISION_MAX_USERS, it will
+    return a 400 Bad Request error.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object containing the users' data.
+
+    Returns:
+        StreamingHttpResponse: Newline-delimited JSON with one result per user, streamed
+                               as each batch is created. Each result has the 'username'
+                               and a 'status' of 'created', 'exists' or 'invalid'.
+    """
+    users = request.data.get('users')
+    if not isinstance(users, list):
+        return Response({'error': 'A list of users is required.'}, status=status.HTTP_400_BAD_REQUEST)
+    max_users = getattr(settings, 'CHAT_PROVISION_MAX_USERS', 10000)
+    if len(users) > max_users:
+        return Response({'error': 'At most %d users can be created at once.' % max_users}, status=status.HTTP_400_BAD_REQUEST)
+    # Django buffers a synchronous iterator in full before sending it over ASGI
+    stream = astream_results if isinstance(request._request, ASGIRequest) else stream_results
+    return StreamingHttpResponse(stream(provision_users(users)), content_type='application/x-ndjson', status=status.HTTP_200_OK)
+
+
+@api_view(['PUT', 'PATCH'])
+def edit_user(request, username):
+    """
+    Edit user details using PUT or PATCH method.
+
+    Retrieves the user with the given username from the database. If the user exists,
+    the view checks the request method. If the method is PUT, the view updates the user's
+    details (username and password) using the provided data. If the method is PATCH, the view
+    updates the user's details based on the provided data (either username or password).
+
+    For PUT method:
+    - New username and password are required.
+    - The new username must be unique (not taken by other users).
+    - The user's details are updated in the database.
+
+    For PATCH method:
+    - Either username or password can be updated.
+    - The new username must be unique (not taken by other users).
+    - The user's details are updated in the database.
+
+    If the user does not exist, a 404 Not Found response is returned.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object.
+
+        username (str): The username of the user to edit.
+
+    Returns:
+        Response: JSON response with a success message on successful update (PUT/PATCH),
+                  or an error message if the user is not found or validation fails.
+
+    """
+    try:
+        # Check if the user exists
+        user = User.objects.get(username=username)
+    except User.DoesNotExist:
+        return Response({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+    if request.method == 'PUT':
+        # Update user details using PUT data
+        new_username = request.data.get('username')
+        new_password = request.data.get('password')
+
+        # Perform basic validation
+        if not new_username or not new_password:
+            return Response({'error': 'Both username and password are required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Check if the new username is already taken
+        if new_username != username and User.objects.filter(username=new_username).exists():
+            return Response({'error': 'Username already exists.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        user.username = new_username
+        user.set_password(new_password)
+        user.save()
+        return Response({'message': 'User updated successfully.'}, status=status.HTTP_200_OK)
+
+    elif request.method == 'PATCH':
+        # Update user details using PATCH data
+        new_username = request.data.get('username')
+        new_password = request.data.get('password')
+
+        # Check if the new username is already taken
+        if new_username and new_username != username and User.objects.filter(username=new_username).exists():
+            return Response({'error': 'Username already exists.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if new_username:
+            user.username = new_username
+        if new_password:
+            user.set_password(new_password)
+
+        user.save()
+        return Response({'message': 'User updated successfully.'}, status=status.HTTP_200_OK)
@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class GroupConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'group'
+
+    def ready(self):
+        # Registers the system checks
+        from . import checks
+        from .sqlite import configure_connection
+
+        connection_created.connect(configure_connection, dispatch_uid='group.sqlite.configure_connection')
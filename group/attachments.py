@@ -0,0 +1,286 @@
+"""
+Content-addressed file attachments.
+
+Files are uploaded over HTTP, never over the chat WebSocket, in chunks of at
+most CHAT_ATTACHMENT_CHUNK_SIZE bytes:
+
+1. `start_upload()` hands out a signed upload id naming the uploader, the
+   group, the file name, its size and type. No row is written yet.
+2. Each chunk is appended at the offset the client says it starts at, which
+   must be the size received so far. After a failure the client asks for the
+   current offset and resumes from there.
+3. `complete_upload()` hashes the received file, records an `Attachment`
+   row and moves the file to `objects/<sha256[:2]>/<sha256[2:4]>/<sha256>`
+   under CHAT_ATTACHMENTS_DIR, unless a file with that content is stored
+   already.
+
+Identical files are therefore stored once, however many times they are
+uploaded. Stored files are never modified, so they can be served with
+long-lived caching headers.
+"""
+
+import hashlib
+import os
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+
+from .models import Attachment, Message
+from .replicas import primary
+
+UPLOAD_SALT = 'group.attachments.upload'
+BLOCK_SIZE = 64 * 1024
+
+# Types a browser may display in place, anything else is sent as a download
+INLINE_TYPES = ('image/gif', 'image/jpeg', 'image/png', 'image/webp')
+
+
+class UploadError(Exception):
+    pass
+
+
+def chunk_size():
+    return getattr(settings, 'CHAT_ATTACHMENT_CHUNK_SIZE', 1024 * 1024)
+
+
+def storage_dir():
+    return getattr(settings, 'CHAT_ATTACHMENTS_DIR', 'attachments')
+
+
+def object_path(sha256):
+    return os.path.join(storage_dir(), 'objects', sha256[:2], sha256[2:4], sha256)
+
+
+def upload_path(claims):
+    return os.path.join(storage_dir(), 'uploads', claims['id'] + '.part')
+
+
+def start_upload(user, group, name, size, content_type):
+    """
+    Return the signed id of a new upload of `size` bytes by `user` to `group`.
+    """
+    max_size = getattr(settings, 'CHAT_ATTACHMENT_MAX_SIZE', 100 * 1024 * 1024)
+    if not 0 < size <= max_size:
+        raise UploadError('Attachments must be between 1 and %d bytes.' % max_size)
+    claims = {
+        'id': uuid.uuid4().hex,
+        'u': user.id,
+        'g': group.id,
+        'name': os.path.basename(name)[:255] or 'attachment',
+        'size': size,
+        'type': content_type or 'application/octet-stream',
+    }
+    os.makedirs(os.path.dirname(upload_path(claims)), exist_ok=True)
+    open(upload_path(claims), 'wb').close()
+    return signing.dumps(claims, salt=UPLOAD_SALT, compress=True)
+
+
+def read_upload(upload_id, user):
+    """
+    Return the claims of an upload started by `user`, or None.
+    """
+    try:
+        claims = signing.loads(
+            upload_id,
+            salt=UPLOAD_SALT,
+            max_age=getattr(settings, 'CHAT_ATTACHMENT_UPLOAD_MAX_AGE', 24 * 60 * 60),
+        )
+    except signing.BadSignature:
+        return None
+    if claims['u'] != user.id or not os.path.exists(upload_path(claims)):
+        return None
+    return claims
+
+
+def received(claims):
+    return os.path.getsize(upload_path(claims))
+
+
+def append_chunk(claims, offset, length, stream):
+    """
+    Copy `length` bytes from `stream` to the upload at `offset`.
+
+    Returns the number of bytes received so far.
+    """
+    if length > chunk_size():
+        raise UploadError('Chunks must not be larger than %d bytes.' % chunk_size())
+    if offset + length > claims['size']:
+        raise UploadError('The chunk ends after the end of the file.')
+    with open(upload_path(claims), 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() != offset:
+            raise UploadError('Expected a chunk at offset %d.' % f.tell())
+        copied = 0
+        while copied < length:
+            block = stream.read(min(BLOCK_SIZE, length - copied))
+            if not block:
+                break
+            f.write(block)
+            copied += len(block)
+        if copied != length:
+            # The client went away, drop the partial chunk so it can be resent
+            f.truncate(offset)
+            raise UploadError('The chunk was cut short.')
+        return f.tell()
+
+
+def complete_upload(claims):
+    """
+    Store a fully received upload under its content hash and return its `Attachment`.
+    """
+    path = upload_path(claims)
+    if received(claims) != claims['size']:
+        raise UploadError('The upload is missing %d bytes.' % (claims['size'] - received(claims)))
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    sha256 = digest.hexdigest()
+
+    # Recorded before the stored file is relied on: from now on a concurrent
+    # _remove_object() of the same content puts the file back
+    attachment = Attachment.objects.create(
+        sha256=sha256,
+        size=claims['size'],
+        name=claims['name'],
+        content_type=claims['type'],
+        group_id=claims['g'],
+        user_id=claims['u'],
+    )
+
+    target = object_path(sha256)
+    if os.path.exists(target):
+        os.remove(path)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Atomic, so a concurrent upload of the same content just replaces it with itself
+        os.replace(path, target)
+    return attachment
+
+
+@primary()
+def find_attachment(attachment_id, slug, username):
+    """
+    Return the attachment `attachment_id` if `username` uploaded it to group `slug`, or None.
+    """
+    try:
+        attachment_id = int(attachment_id)
+    except (TypeError, ValueError):
+        return None
+    return Attachment.objects.filter(id=attachment_id, group__slug=slug, user__username=username).first()
+
+
+def discard_attachment(attachment_id):
+    """
+    Delete an attachment that no message refers to any more, and its file
+    once no other attachment has the same content.
+
+    The file is removed after the surrounding transaction commits, so a
+    rollback leaves it in place.
+    """
+    if Message.objects.filter(attachment_id=attachment_id).exists():
+        return
+    try:
+        attachment = Attachment.objects.get(id=attachment_id)
+    except Attachment.DoesNotExist:
+        return
+    attachment.delete()
+    if not Attachment.objects.filter(sha256=attachment.sha256).exists():
+        transaction.on_commit(lambda: _remove_object(attachment.sha256))
+
+
+@primary()
+def _remove_object(sha256):
+    """
+    Remove the stored file of `sha256`, unless an attachment was recorded for
+    it since `discard_attachment()` checked.
+
+    The file is moved aside before that check, so an upload completing in
+    between either finds it gone and stores its own copy, or is seen by the
+    check and gets the file back.
+    """
+    target = object_path(sha256)
+    removed = '%s.%s.removed' % (target, uuid.uuid4().hex)
+    try:
+        os.rename(target, removed)
+    except FileNotFoundError:
+        return
+    if Attachment.objects.filter(sha256=sha256).exists():
+        os.replace(removed, target)
+    else:
+        os.remove(removed)
+
+
+def describe(attachment):
+    """
+    Return the JSON description of an attachment sent with a chat message.
+    """
+    if attachment is None:
+        return None
+    return {'id': attachment.id, 'name': attachment.name, 'size': attachment.size, 'url': attachment.get_absolute_url()}
+
+
+def parse_range(header, size):
+    """
+    Return the `(start, end)` positions, end included, asked for by a Range
+    header, or None to send the whole file.
+
+    Only single byte ranges are served; anything else gets the whole file, as
+    HTTP allows. Raises ValueError when the range cannot be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, _, end = header[len('bytes='):].strip().partition('-')
+    if start.isdigit():
+        start = int(start)
+        end = min(int(end), size - 1) if end.isdigit() else size - 1
+        if end < start and start < size:
+            return None
+    elif end.isdigit():
+        # The last `end` bytes
+        start, end = size - int(end), size - 1
+        if start == size:
+            raise ValueError('Empty suffix range.')
+        start = max(0, start)
+    else:
+        return None
+    if start >= size:
+        raise ValueError('The range starts after the end of the file.')
+    return start, end
+
+
+def iter_file(path, start, length):
+    """
+    Yield `length` bytes of the file at `path` from `start`, one block at a time.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+async def aiter_file(path, start, length):
+    """
+    Like `iter_file`, for ASGI servers. Each block is read in a thread, so
+    only one block is held in memory at a time and the event loop is never
+    blocked on the disk.
+    """
+    f = await sync_to_async(open, thread_sensitive=False)(path, 'rb')
+    try:
+        await sync_to_async(f.seek, thread_sensitive=False)(start)
+        while length > 0:
+            block = await sync_to_async(f.read, thread_sensitive=False)(min(BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+    finally:
+        f.close()
@@ -0,0 +1,63 @@
+"""
+System checks for state shared between workers.
+
+Room sizes and shard counts (group.fanout), room connection limits
+(group.admission), read-your-writes pins (group.replicas) and the
+generations of sessions (group.sessions) and likes (group.likes) live in
+the default cache, so that every worker agrees on them. A process-local
+cache gives each worker its own copy: a worker that has not seen a room's joins
+sends to shard 0 only, and sockets in the other shards silently miss
+messages.
+"""
+
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+
+# Cache backends whose data is only visible to the process that wrote it
+LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+# Channel layers that only deliver within one process
+LOCAL_CHANNEL_LAYERS = (
+    'channels.layers.InMemoryChannelLayer',
+)
+
+
+def cache_is_local():
+    return settings.CACHES.get('default', {}).get('BACKEND') in LOCAL_CACHES
+
+
+def channel_layer_is_local():
+    layers = getattr(settings, 'CHANNEL_LAYERS', {})
+    return layers.get('default', {}).get('BACKEND', LOCAL_CHANNEL_LAYERS[0]) in LOCAL_CHANNEL_LAYERS
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    if not cache_is_local():
+        return []
+    if not channel_layer_is_local():
+        return [Error(
+            'The channel layer is shared between processes but the default cache is not.',
+            hint='Room shard counts must be shared by every worker, or messages are lost. '
+                 'Configure a shared CACHES backend such as Redis or Memcached.',
+            id='group.E001',
+        )]
+    features = [
+        name for name, enabled in (
+            ('CHAT_READ_REPLICAS', getattr(settings, 'CHAT_READ_REPLICAS', [])),
+            ('CHAT_MAX_ROOM_CONNECTIONS', getattr(settings, 'CHAT_MAX_ROOM_CONNECTIONS', None) is not None),
+            ('group.sessions', getattr(settings, 'SESSION_ENGINE', None) == 'group.sessions'),
+        ) if enabled
+    ]
+    if features:
+        return [Warning(
+            '%s %s on the default cache, which is local to each process.' % (
+                ' and '.join(features), 'relies' if len(features) == 1 else 'rely',
+            ),
+            hint='With more than one worker, configure a shared CACHES backend such as Redis or Memcached.',
+            id='group.W001',
+        )]
+    return []
@@ -1,108 +1,502 @@
+import asyncio
 import json
+from collections import deque
 
-from django.contrib.auth.models import User
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
 from asgiref.sync import sync_to_async
 from django.utils import timezone
-from .models import Group, Message
+from .likes import like_message, unlike_message
+from .delivery import clean_client_id, delete_message, edit_message, store_message
+from .attachments import describe, find_attachment
+from .auth import make_connect_token
+from . import admission
+from .mentions import mention_worker, user_group_name
+from .models import Group
+from .replicas import primary
+from .writer import db_writer
+from .profiling import phase, profiled
+from . import fanout
 from channels.db import database_sync_to_async
 
 class ChatConsumer(AsyncWebsocketConsumer):
 
-    @database_sync_to_async
-    def get_message(self, message_id):
-        try:
-            # Assuming you have a Message model, replace 'Message' with your actual model name
-            return Message.objects.get(id=message_id)
-        except Message.DoesNotExist:
-            return None
+    async def toggle_like(self, action, message_id, user_id):
+        if action == 'like':
+            return await db_writer.run(like_message, message_id, user_id)
+        return await db_writer.run(unlike_message, message_id, user_id)
 
-    @database_sync_to_async
-    def update_message_likes(self, message_id, likes):
-        try:
-            # Assuming you have a Message model, replace 'Message' with your actual model name
-            message = Message.objects.get(id=message_id)
-            message.likes = likes
-            message.save()
-        except Message.DoesNotExist:
-            pass
+    async def patch_message(self, action, slug, message_id, user, content):
+        if action == 'edit':
+            return await db_writer.run(edit_message, message_id, slug, user.id, content)
+        return await db_writer.run(delete_message, message_id, slug, user.id, user.username)
 
     async def connect(self):
         self.group_name = self.scope['url_route']['kwargs']['group_name']
-        self.group_name_2 = 'chat_%s' % self.group_name
+
+        # A connect token is only valid for the room it was issued for
+        claims = self.scope.get('connect_token')
+        if claims is not None and claims['g'] != self.group_name:
+            await self.close()
+            return
+
+        # Workers and rooms over their connection limits turn the socket away
+        rejection = admission.admit(self)
+        if rejection is None:
+            # Large rooms are split into shards, each socket joins one of them
+            joined = await sync_to_async(admission.join_room)(self.group_name)
+            if joined is None:
+                admission.release(self)
+                rejection = admission.room_full_rejection()
+        if rejection is not None:
+            await self.reject(*rejection)
+            return
+        self.shards, grown = joined
+        self.group_name_2 = fanout.shard_group(self.group_name, fanout.shard_of(self.channel_name, self.shards))
+        self.previous_group_name = None
+        self.leave_previous_task = None
+        self.recent_message_ids = deque(maxlen=64)
 
         await self.channel_layer.group_add(
             self.group_name_2,
             self.channel_name
         )
 
+        if grown:
+            # Tell the sockets already in the room to move to the new shard layout
+            await fanout.group_send(self.channel_layer, self.group_name, self.shards, {
+                'type': 'fanout_rebalance',
+                'group': self.group_name,
+                'shards': self.shards,
+            })
+
+        # Mentions are delivered to the user's own group, not to the room
+        user = self.scope.get('user')
+        if user is not None and user.is_authenticated:
+            self.user_group_name = user_group_name(user.id)
+            await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+            mention_worker.listen(asyncio.get_running_loop())
+        else:
+            self.user_group_name = None
+
+        await self.accept()
+
+        if user is not None and user.is_authenticated and claims is None:
+            # Hand out a token so the next reconnect skips the session lookup too. Only
+            # a session may do so, otherwise a token could be renewed forever after logout
+            await self.send(text_data=json.dumps({
+                'action': 'token',
+                'token': make_connect_token(user, self.group_name),
+            }))
+
+    async def reject(self, code, frame):
+        # Accept first, so the client can read why it was turned away
         await self.accept()
+        await self.send(text_data=json.dumps(frame))
+        await self.close(code=code)
+
+    async def close_for_restart(self, retry_after):
+        await self.send(text_data=json.dumps({'action': 'reconnect', 'retry_after': retry_after}))
+        await self.close(code=admission.CLOSE_RESTARTING)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            self.group_name_2,
-            self.channel_name
-        )
+        admission.release(self)
+        if not hasattr(self, 'shards'):
+            # Rejected before joining the room
+            return
+        if self.leave_previous_task is not None:
+            self.leave_previous_task.cancel()
+        for group_name in (self.group_name_2, self.previous_group_name, self.user_group_name):
+            if group_name is not None:
+                await self.channel_layer.group_discard(
+                    group_name,
+                    self.channel_name
+                )
+        await sync_to_async(fanout.leave)(self.group_name)
+
+    async def fanout_rebalance(self, event):
+        shards = event['shards']
+        if shards <= self.shards:
+            return
+        self.shards = shards
+        group_name = fanout.shard_group(self.group_name, fanout.shard_of(self.channel_name, shards))
+        if group_name == self.group_name_2:
+            return
+
+        # Join the new shard first and only leave the old one once senders
+        # that still use the old layout have caught up
+        await self.channel_layer.group_add(group_name, self.channel_name)
+        if self.previous_group_name is not None:
+            await self.channel_layer.group_discard(self.previous_group_name, self.channel_name)
+        self.previous_group_name, self.group_name_2 = self.group_name_2, group_name
+        if self.leave_previous_task is not None:
+            self.leave_previous_task.cancel()
+        self.leave_previous_task = asyncio.ensure_future(self.leave_previous_group())
+
+    async def leave_previous_group(self):
+        await asyncio.sleep(getattr(settings, 'CHAT_FANOUT_REBALANCE_GRACE', 5))
+        previous_group_name, self.previous_group_name = self.previous_group_name, None
+        self.leave_previous_task = None
+        if previous_group_name is not None:
+            await self.channel_layer.group_discard(previous_group_name, self.channel_name)
 
     # Receive message from WebSocket
+    @profiled('ws;receive')
     async def receive(self, text_data):
-        data = json.loads(text_data)
+        with phase('parse'):
+            data = json.loads(text_data)
         action = data.get('action')
 
-        if action == 'like':
+        if action in ('like', 'unlike'):
             message_id = data.get('message_id')
-            username = data.get('username')
-            group = data.get('group')
-
-            message = await self.get_message(message_id)
-            if message:
-                # Update the message likes count
-                message.likes += 1
-                await self.update_message_likes(message_id, message.likes)
+            user = self.scope.get('user')
+            if user is None or not user.is_authenticated:
+                return
+            try:
+                message_id = int(message_id)
+            except (TypeError, ValueError):
+                return
 
+            # Repeated likes (and unlikes of nothing) leave the count untouched
+            with phase('db'):
+                likes = await self.toggle_like(action, message_id, user.id)
+            if likes is not None:
                 # Broadcast the updated like count to all connected clients
-                await self.send(text_data=json.dumps({
-                    'action': 'like',
-                    'message_id': message_id,
-                    'likes': message.likes,
-                }))
+                with phase('send'):
+                    await self.send(text_data=json.dumps({
+                        'action': action,
+                        'message_id': message_id,
+                        'likes': likes,
+                    }))
+
+        elif action in ('edit', 'delete'):
+            user = self.scope.get('user')
+            if user is None or not user.is_authenticated:
+                return
+            try:
+                message_id = int(data.get('message_id'))
+            except (TypeError, ValueError):
+                return
+
+            with phase('db'):
+                patch = await self.patch_message(action, self.group_name, message_id, user, str(data.get('message', '')))
+            if patch is not None:
+                # Only the changed message is sent, clients patch it in place
+                with phase('channel_layer'):
+                    await fanout.group_send(self.channel_layer, self.group_name, self.shards, patch)
 
         else:
             message = data['message']
             username = data['username']
             group = data['group']
+            client_id = clean_client_id(data.get('client_id'))
             timestamp = timezone.now().strftime('%Y-%m-%d %H:%M:%S')
-            await self.save_message(username, group, message, timestamp)
 
-            # await self.save_message(username, group, message)
+            # Files are uploaded over HTTP beforehand, the message only refers to one
+            attachment = None
+            if data.get('attachment_id') is not None:
+                with phase('db'):
+                    attachment = await database_sync_to_async(find_attachment)(data['attachment_id'], group, username)
+                if attachment is None:
+                    return
 
-            # Send message to group group
-            await self.channel_layer.group_send(
-                self.group_name_2,
-                {
-                    'type': 'chat_message',
-                    'message': message,
-                    'username': username,
-                    'timestamp': timestamp
-                }
-            )
+            with phase('db'):
+                message_id, created = await self.save_message(username, group, message, timestamp, client_id, attachment)
+
+            # A resent message is only acknowledged, never delivered twice
+            if created:
+                # Send message to every shard of the group
+                with phase('channel_layer'):
+                    await fanout.group_send(
+                        self.channel_layer,
+                        self.group_name,
+                        self.shards,
+                        {
+                            'type': 'chat_message',
+                            'group': self.group_name,
+                            'message': message,
+                            'username': username,
+                            'timestamp': timestamp,
+                            'message_id': message_id,
+                            'client_id': client_id,
+                            'attachment': describe(attachment),
+                        }
+                    )
+
+            if client_id is not None:
+                with phase('send'):
+                    await self.send(text_data=json.dumps({
+                        'action': 'ack',
+                        'client_id': client_id,
+                        'message_id': message_id,
+                    }))
 
     # Receive message from group group
+    @profiled('ws;chat_message')
     async def chat_message(self, event):
+        # While moving between shards a socket is briefly in two of them
+        if self.previous_group_name is not None and event.get('message_id') is not None:
+            if event['message_id'] in self.recent_message_ids:
+                return
+            self.recent_message_ids.append(event['message_id'])
+
         message = event['message']
         username = event['username']
         timestamp = event['timestamp']
 
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'username': username,
-            'timestamp': timestamp
-        }))
-
-    @sync_to_async
-    def save_message(self, username, group, message, timestamp):
-        user = User.objects.get(username=username)
-        group = Group.objects.get(slug=group)
-        # message = f"{message} [{timestamp}]\n"
-        Message.objects.create(user=user, group=group, content=message, timestamp=timestamp)
+        with phase('send'):
+            await self.send(text_data=json.dumps({
+                'message': message,
+                'username': username,
+                'timestamp': timestamp,
+                'message_id': event.get('message_id'),
+                'client_id': event.get('client_id'),
+                'attachment': event.get('attachment'),
+            }))
+
+    @profiled('ws;message_patch')
+    async def message_patch(self, event):
+        # Clients ignore a version they already have, so a copy from a second shard is harmless
+        with phase('send'):
+            await self.send(text_data=json.dumps({
+                'action': event['action'],
+                'group': event['group'],
+                'message_id': event['message_id'],
+                'version': event['version'],
+                'message': event['message'],
+                'edited': event['edited'],
+            }))
+
+    @profiled('ws;mention_notify')
+    async def mention_notify(self, event):
+        with phase('send'):
+            await self.send(text_data=json.dumps({
+                'action': 'mention',
+                'message_id': event['message_id'],
+                'group': event['group'],
+                'username': event['username'],
+                'message': event['message'],
+            }))
+
+    async def save_message(self, username, group, message, timestamp, client_id=None, attachment=None):
+        return await db_writer.run(store_message, username, group, message, timestamp, client_id, attachment)
+
+
+class Subscription:
+    """
+    The membership of a multiplexed socket in one room, see ChatConsumer for
+    how rooms are sharded and rebalanced.
+    """
+
+    def __init__(self, slug, shards):
+        self.slug = slug
+        self.shards = shards
+        self.group_name = None
+        self.previous_group_name = None
+        self.leave_previous_task = None
+        self.recent_message_ids = deque(maxlen=64)
+
+    def group_names(self):
+        return [name for name in (self.group_name, self.previous_group_name) if name is not None]
+
+
+class MultiplexConsumer(ChatConsumer):
+    """
+    One WebSocket for every room a user has open.
+
+    Clients send `subscribe` and `unsubscribe` frames naming a group, and
+    every other frame in either direction carries the group it is about.
+    Membership is checked on each subscription, so a connect token issued
+    for any room is enough to open the socket. Likes, edits, saving messages
+    and mentions work as in ChatConsumer.
+    """
+
+    async def connect(self):
+        self.subscriptions = {}
+        self.user = self.scope.get('user')
+        if self.user is None or not self.user.is_authenticated:
+            await self.close()
+            return
+
+        rejection = admission.admit(self)
+        if rejection is not None:
+            await self.reject(*rejection)
+            return
+
+        self.user_group_name = user_group_name(self.user.id)
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+        mention_worker.listen(asyncio.get_running_loop())
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        admission.release(self)
+        for slug in list(self.subscriptions):
+            await self.unsubscribe(slug)
+        if getattr(self, 'user_group_name', None) is not None:
+            await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+
+    async def send_json(self, data):
+        await self.send(text_data=json.dumps(data))
+
+    @database_sync_to_async
+    def is_member(self, slug):
+        with primary():
+            return Group.objects.filter(slug=slug, members=self.user.id).exists()
+
+    async def subscribe(self, slug):
+        if slug in self.subscriptions:
+            return
+        if len(self.subscriptions) >= getattr(settings, 'CHAT_MAX_SUBSCRIPTIONS', 50):
+            await self.send_json({'action': 'error', 'group': slug, 'reason': 'too_many_subscriptions'})
+            return
+        if not await self.is_member(slug):
+            await self.send_json({'action': 'error', 'group': slug, 'reason': 'not_member'})
+            return
+        joined = await sync_to_async(admission.join_room)(slug)
+        if joined is None:
+            await self.send_json({'action': 'error', 'group': slug, 'reason': 'room_full'})
+            return
+
+        shards, grown = joined
+        subscription = Subscription(slug, shards)
+        subscription.group_name = fanout.shard_group(slug, fanout.shard_of(self.channel_name, shards))
+        self.subscriptions[slug] = subscription
+        await self.channel_layer.group_add(subscription.group_name, self.channel_name)
+        if grown:
+            await fanout.group_send(self.channel_layer, slug, shards, {
+                'type': 'fanout_rebalance',
+                'group': slug,
+                'shards': shards,
+            })
+        await self.send_json({'action': 'subscribed', 'group': slug})
+
+    async def unsubscribe(self, slug):
+        subscription = self.subscriptions.pop(slug, None)
+        if subscription is None:
+            return
+        if subscription.leave_previous_task is not None:
+            subscription.leave_previous_task.cancel()
+        for group_name in subscription.group_names():
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+        await sync_to_async(fanout.leave)(slug)
+
+    async def fanout_rebalance(self, event):
+        subscription = self.subscriptions.get(event.get('group'))
+        if subscription is None or event['shards'] <= subscription.shards:
+            return
+        subscription.shards = event['shards']
+        group_name = fanout.shard_group(subscription.slug, fanout.shard_of(self.channel_name, subscription.shards))
+        if group_name == subscription.group_name:
+            return
+
+        await self.channel_layer.group_add(group_name, self.channel_name)
+        if subscription.previous_group_name is not None:
+            await self.channel_layer.group_discard(subscription.previous_group_name, self.channel_name)
+        subscription.previous_group_name, subscription.group_name = subscription.group_name, group_name
+        if subscription.leave_previous_task is not None:
+            subscription.leave_previous_task.cancel()
+        subscription.leave_previous_task = asyncio.ensure_future(self.leave_previous_group(subscription))
+
+    async def leave_previous_group(self, subscription):
+        await asyncio.sleep(getattr(settings, 'CHAT_FANOUT_REBALANCE_GRACE', 5))
+        previous_group_name, subscription.previous_group_name = subscription.previous_group_name, None
+        subscription.leave_previous_task = None
+        if previous_group_name is not None:
+            await self.channel_layer.group_discard(previous_group_name, self.channel_name)
+
+    @profiled('ws;multiplex_receive')
+    async def receive(self, text_data):
+        with phase('parse'):
+            data = json.loads(text_data)
+        action = data.get('action')
+        slug = data.get('group')
+        if not isinstance(slug, str):
+            return
+
+        if action == 'subscribe':
+            await self.subscribe(slug)
+        elif action == 'unsubscribe':
+            await self.unsubscribe(slug)
+            await self.send_json({'action': 'unsubscribed', 'group': slug})
+        elif slug not in self.subscriptions:
+            await self.send_json({'action': 'error', 'group': slug, 'reason': 'not_subscribed'})
+        elif action in ('like', 'unlike'):
+            try:
+                message_id = int(data.get('message_id'))
+            except (TypeError, ValueError):
+                return
+            with phase('db'):
+                likes = await self.toggle_like(action, message_id, self.user.id)
+            if likes is not None:
+                with phase('send'):
+                    await self.send_json({'action': action, 'group': slug, 'message_id': message_id, 'likes': likes})
+        elif action in ('edit', 'delete'):
+            try:
+                message_id = int(data.get('message_id'))
+            except (TypeError, ValueError):
+                return
+            with phase('db'):
+                patch = await self.patch_message(action, slug, message_id, self.user, str(data.get('message', '')))
+            if patch is not None:
+                with phase('channel_layer'):
+                    await fanout.group_send(self.channel_layer, slug, self.subscriptions[slug].shards, patch)
+        elif action == 'message':
+            await self.post_message(slug, data)
+
+    async def post_message(self, slug, data):
+        message = data.get('message', '')
+        client_id = clean_client_id(data.get('client_id'))
+        timestamp = timezone.now().strftime('%Y-%m-%d %H:%M:%S')
+        attachment = None
+        if data.get('attachment_id') is not None:
+            with phase('db'):
+                attachment = await database_sync_to_async(find_attachment)(data['attachment_id'], slug, self.user.username)
+            if attachment is None:
+                return
+
+        with phase('db'):
+            message_id, created = await self.save_message(
+                self.user.username, slug, message, timestamp, client_id, attachment,
+            )
+        if created:
+            with phase('channel_layer'):
+                await fanout.group_send(self.channel_layer, slug, self.subscriptions[slug].shards, {
+                    'type': 'chat_message',
+                    'group': slug,
+                    'message': message,
+                    'username': self.user.username,
+                    'timestamp': timestamp,
+                    'message_id': message_id,
+                    'client_id': client_id,
+                    'attachment': describe(attachment),
+                })
+        if client_id is not None:
+            with phase('send'):
+                await self.send_json({'action': 'ack', 'group': slug, 'client_id': client_id, 'message_id': message_id})
+
+    @profiled('ws;multiplex_chat_message')
+    async def chat_message(self, event):
+        subscription = self.subscriptions.get(event.get('group'))
+        if subscription is None:
+            return
+        if subscription.previous_group_name is not None and event.get('message_id') is not None:
+            if event['message_id'] in subscription.recent_message_ids:
+                return
+            subscription.recent_message_ids.append(event['message_id'])
+
+        with phase('send'):
+            await self.send_json({
+                'action': 'message',
+                'group': subscription.slug,
+                'message': event['message'],
+                'username': event['username'],
+                'timestamp': event['timestamp'],
+                'message_id': event.get('message_id'),
+                'client_id': event.get('client_id'),
+                'attachment': event.get('attachment'),
+            })
+
+    async def message_patch(self, event):
+        if event.get('group') in self.subscriptions:
+            await super().message_patch(event)
@@ -0,0 +1,186 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .attachments import discard_attachment
+from .lru import LRUCache
+from .mentions import mention_worker
+from .models import Group, Mention, Message
+from .replicas import pin, primary
+
+
+class RecentClientIds:
+    """
+    Per-room memory of recently delivered client message ids.
+
+    Maps each sender's `client_id` to the server-assigned message id for
+    the last few messages of each room, so a resend after a flaky connection
+    is acknowledged without touching the database. Ids are kept per sender,
+    so a member reusing someone else's id is not acknowledged with their
+    message. Both the rooms and the ids inside a room are bounded LRUs;
+    anything that falls out is still caught by the (group, user, client_id)
+    unique constraint on `Message`.
+    """
+
+    def __init__(self, max_rooms, ids_per_room):
+        self.ids_per_room = ids_per_room
+        self._rooms = LRUCache(max_rooms)
+
+    def get(self, room, username, client_id):
+        ids = self._rooms.get(room)
+        if ids is None:
+            return None
+        return ids.get((username, client_id))
+
+    def add(self, room, username, client_id, message_id):
+        ids = self._rooms.get(room)
+        if ids is None:
+            ids = LRUCache(self.ids_per_room)
+            self._rooms.set(room, ids)
+        ids.set((username, client_id), message_id)
+
+    def clear(self):
+        self._rooms.clear()
+
+
+recent_client_ids = RecentClientIds(
+    getattr(settings, 'CHAT_DELIVERY_ROOMS', 10000),
+    getattr(settings, 'CHAT_DELIVERY_IDS_PER_ROOM', 1000),
+)
+
+
+def clean_client_id(value):
+    """
+    Normalise the optional client-generated id sent with a message.
+    """
+    if value is None or value == '':
+        return None
+    return str(value)[:64]
+
+
+@primary()
+def store_message(username, slug, content, timestamp, client_id=None, attachment=None):
+    """
+    Save a chat message at most once per (room, sender, client_id).
+
+    Returns a `(message_id, created)` tuple. When the user already
+    delivered `client_id` to this room the existing message id is returned with
+    `created` False, so the caller acknowledges without broadcasting again.
+    """
+    if client_id is not None:
+        message_id = recent_client_ids.get(slug, username, client_id)
+        if message_id is not None:
+            return message_id, False
+
+    user = User.objects.get(username=username)
+    group = Group.objects.get(slug=slug)
+    try:
+        with transaction.atomic():
+            message = Message.objects.create(
+                user=user, group=group, content=content, timestamp=timestamp, client_id=client_id,
+                attachment=attachment,
+            )
+        message_id, created = message.id, True
+        pin(user.id)
+        mention_worker.submit(message.id, group.id, slug, user.username, content)
+    except IntegrityError:
+        if client_id is None:
+            raise
+        message_id = Message.objects.values_list('id', flat=True).get(group=group, user=user, client_id=client_id)
+        created = False
+
+    if client_id is not None:
+        recent_client_ids.add(slug, username, client_id, message_id)
+    return message_id, created
+
+
+def message_patch(action, message_id, slug, version, content, edited):
+    """
+    Return the channel-layer event telling a room that a message changed.
+    """
+    return {
+        'type': 'message_patch',
+        'action': action,
+        'group': slug,
+        'message_id': message_id,
+        'version': version,
+        'message': content,
+        'edited': edited.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def next_change(group_id):
+    """
+    Count one more change in the group and return the new count.
+
+    Must run inside the transaction that records the change; the update
+    locks the group's row, so concurrent changes get distinct counts.
+    """
+    Group.objects.filter(id=group_id).update(changes=F('changes') + 1)
+    return Group.objects.values_list('changes', flat=True).get(id=group_id)
+
+
+@primary()
+def edit_message(message_id, slug, user_id, content):
+    """
+    Replace the content of a message `user_id` posted to room `slug`.
+
+    The message's mentions are indexed again, mentioned users are only
+    notified of mentions that are new. Returns the `message_patch` event to
+    broadcast, or None if the message does not exist, was deleted or was
+    posted by someone else.
+    """
+    if not content:
+        return None
+    edited = timezone.now()
+    with transaction.atomic():
+        try:
+            group_id, author, previous = Message.objects.values_list('group_id', 'user__username', 'content').get(
+                id=message_id, group__slug=slug, user_id=user_id, deleted=False,
+            )
+        except Message.DoesNotExist:
+            return None
+        Message.objects.filter(id=message_id).update(
+            content=content, version=F('version') + 1, edited=edited, change=next_change(group_id),
+        )
+        version = Message.objects.values_list('version', flat=True).get(id=message_id)
+    pin(user_id)
+    if '@' in previous:
+        mention_worker.submit(message_id, group_id, slug, author, content, edited=True)
+    else:
+        mention_worker.submit(message_id, group_id, slug, author, content)
+    return message_patch('edit', message_id, slug, version, content, edited)
+
+
+@primary()
+def delete_message(message_id, slug, user_id, username):
+    """
+    Turn a message of room `slug` into a tombstone, if the user `user_id`
+    (named `username`) posted it or is the group's admin.
+
+    The content is dropped, the message leaves the mention inboxes and its
+    attachment can no longer be downloaded. Returns the `message_patch`
+    event to broadcast, or None.
+    """
+    edited = timezone.now()
+    with transaction.atomic():
+        try:
+            group_id, attachment_id = (
+                Message.objects.filter(Q(user_id=user_id) | Q(group__admin=username))
+                .values_list('group_id', 'attachment_id')
+                .get(id=message_id, group__slug=slug, deleted=False)
+            )
+        except Message.DoesNotExist:
+            return None
+        Message.objects.filter(id=message_id).update(
+            content='', attachment=None, deleted=True, version=F('version') + 1, edited=edited,
+            change=next_change(group_id),
+        )
+        Mention.objects.filter(message_id=message_id).delete()
+        if attachment_id is not None:
+            discard_attachment(attachment_id)
+        version = Message.objects.values_list('version', flat=True).get(id=message_id)
+    pin(user_id)
+    return message_patch('delete', message_id, slug, version, '', edited)
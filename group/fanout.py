@@ -0,0 +1,105 @@
+"""
+Sharded fan-out for chat rooms.
+
+Small rooms use the single channel-layer group `chat_<slug>`. Once a room
+holds more than CHAT_FANOUT_SHARD_SIZE sockets it is split into 2, 4, 8...
+sub-groups (`chat_<slug>`, `chat_<slug>.1`, ...), and a broadcast becomes a
+two-level tree: the sender sends one event per shard, and the channel layer
+delivers each shard to its own members. With a multi-process layer the shard
+groups hash to different keys, so the work is spread across layer workers.
+
+Room sizes and shard counts live in the Django cache so that every worker
+sharing the cache agrees on them. With several workers the cache must be
+shared too, which the group.E001 system check enforces. The shard count only grows while the room
+is in use; it is reset when the last socket leaves.
+"""
+
+import asyncio
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def shard_size():
+    return getattr(settings, 'CHAT_FANOUT_SHARD_SIZE', 1000)
+
+
+def max_shards():
+    return getattr(settings, 'CHAT_FANOUT_MAX_SHARDS', 64)
+
+
+def _size_key(slug):
+    return 'fanout:size:%s' % slug
+
+
+def _shards_key(slug):
+    return 'fanout:shards:%s' % slug
+
+
+def shards_for_size(size):
+    """
+    Return the power-of-two number of shards needed for `size` sockets.
+    """
+    shards = 1
+    while shards * shard_size() < size and shards < max_shards():
+        shards *= 2
+    return shards
+
+
+def shard_group(slug, shard):
+    if shard == 0:
+        return 'chat_%s' % slug
+    return 'chat_%s.%d' % (slug, shard)
+
+
+def shard_of(channel_name, shards):
+    """
+    Pick the shard of a socket. The hash is stable across processes, and with
+    power-of-two growth a socket either stays put or moves to `shard + old`.
+    """
+    return zlib.crc32(channel_name.encode()) % shards
+
+
+def room_shards(slug):
+    return cache.get(_shards_key(slug), 1)
+
+
+def room_size(slug):
+    return cache.get(_size_key(slug), 0)
+
+
+def join(slug):
+    """
+    Count a new socket in the room.
+
+    Returns `(shards, grown)`, where `grown` is True when this socket pushed
+    the room over a shard boundary and the other sockets must rebalance.
+    """
+    cache.add(_size_key(slug), 0, timeout=None)
+    size = cache.incr(_size_key(slug))
+    current = room_shards(slug)
+    needed = shards_for_size(size)
+    if needed > current:
+        cache.set(_shards_key(slug), needed, timeout=None)
+        return needed, True
+    return current, False
+
+
+def leave(slug):
+    try:
+        size = cache.decr(_size_key(slug))
+    except ValueError:
+        return
+    if size <= 0:
+        cache.delete_many([_size_key(slug), _shards_key(slug)])
+
+
+async def group_send(channel_layer, slug, shards, event):
+    """
+    Broadcast `event` to every shard of the room.
+    """
+    await asyncio.gather(*(
+        channel_layer.group_send(shard_group(slug, shard), event)
+        for shard in range(shards)
+    ))
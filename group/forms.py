@@ -1,3 +1,7 @@
+import csv
+import io
+import re
+
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from django import forms
@@ -14,3 +18,35 @@ class GroupForm(forms.ModelForm):
     class Meta:
         model = Group
         fields = ['name']
+
+
+class BulkMembersForm(forms.Form):
+    usernames = forms.CharField(
+        widget=forms.Textarea,
+        required=False,
+        help_text='Usernames separated by commas, spaces or new lines.',
+    )
+    csv_file = forms.FileField(
+        required=False,
+        label='CSV file',
+        help_text='A CSV file with one username in the first column of each row, after an optional "username" header.',
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        usernames = re.split(r'[\s,]+', cleaned_data.get('usernames') or '')
+        csv_file = cleaned_data.get('csv_file')
+        if csv_file:
+            try:
+                rows = [row[0].strip() for row in csv.reader(io.StringIO(csv_file.read().decode('utf-8-sig'))) if row]
+            except (UnicodeDecodeError, csv.Error):
+                raise forms.ValidationError('The CSV file could not be read.')
+            # Skip the header row, if the file has one
+            if rows and rows[0].lower() == 'username':
+                rows = rows[1:]
+            usernames += rows
+        usernames = [username for username in usernames if username]
+        if not usernames:
+            raise forms.ValidationError('Enter at least one username or upload a CSV file.')
+        cleaned_data['username_list'] = usernames
+        return cleaned_data
@@ -0,0 +1,88 @@
+import asyncio
+
+from channels.layers import get_channel_layer
+
+from . import fanout
+from .models import Message
+
+# Columns of each message row returned by the delta-sync endpoint
+MESSAGE_FIELDS = ['id', 'username', 'content', 'timestamp', 'likes', 'attachment', 'version', 'deleted']
+
+# Columns read for each row, in MESSAGE_FIELDS order
+ROW_COLUMNS = ['id', 'user__username', 'content', 'timestamp', 'likes', 'attachment_id', 'version', 'deleted']
+
+
+def _row(values):
+    message_id, username, content, timestamp, likes, attachment_id, version, deleted = values[:len(ROW_COLUMNS)]
+    return [message_id, username, content, timestamp.strftime('%Y-%m-%d %H:%M:%S'), likes, attachment_id, version, deleted]
+
+
+def messages_after(group, after, limit):
+    """
+    Return up to `limit` messages of `group` with an id greater than `after`,
+    oldest first, as compact lists in MESSAGE_FIELDS order.
+    """
+    rows = Message.objects.filter(group=group, id__gt=after).order_by('id').values_list(*ROW_COLUMNS)[:limit]
+    return [_row(values) for values in rows]
+
+
+def changes_after(group, after, since, limit):
+    """
+    Return the messages of `group` up to id `after` that were edited or
+    deleted after the group's change count `since`, in the order they
+    changed, as compact lists in MESSAGE_FIELDS order.
+
+    Returns `(rows, last_change, more)`: the change count to ask from next
+    time and whether more changes are waiting. `group.changes` must have been
+    read before this call, so a change made in between is sent again rather
+    than skipped.
+    """
+    rows = list(
+        Message.objects.filter(group=group, change__gt=since, id__lte=after)
+        .order_by('change')
+        .values_list(*ROW_COLUMNS, 'change')[:limit + 1]
+    )
+    more = len(rows) > limit
+    rows = rows[:limit]
+    last_change = rows[-1][-1] if more else max(group.changes, since)
+    return [_row(values) for values in rows], last_change, more
+
+
+class RoomListener:
+    """
+    Wait on the channel layer for the next message broadcast to a room.
+
+    Every broadcast is sent to every shard of the room, so listening on the
+    first shard is enough. The listener must be opened before the database is
+    checked, so that a message saved in between is not missed.
+    """
+
+    def __init__(self, slug):
+        self.group_name = fanout.shard_group(slug, 0)
+        self.channel_layer = get_channel_layer()
+        self.channel_name = None
+
+    async def __aenter__(self):
+        self.channel_name = await self.channel_layer.new_channel()
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def wait(self, timeout):
+        """
+        Return True once a message is posted, edited or deleted, or False after `timeout` seconds.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                event = await asyncio.wait_for(self.channel_layer.receive(self.channel_name), remaining)
+            except asyncio.TimeoutError:
+                return False
+            if event.get('type') in ('chat_message', 'message_patch'):
+                return True
@@ -0,0 +1,134 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .lru import LRUCache
+from .models import Message, MessageLike
+from .replicas import pin, primary
+
+GENERATION_KEY = 'chat-like-generation:%d'
+
+
+def _generation(message_id):
+    return cache.get(GENERATION_KEY % message_id)
+
+
+class LikeIndex:
+    """
+    In-memory index of who liked the messages users tried to like twice.
+
+    For every message it holds, the index keeps the complete set of user ids
+    that liked it, so a repeated like or unlike is refused without a query.
+    Likes and unlikes go straight to the database, where the `MessageLike`
+    unique constraint stays the source of truth; a message's likers are only
+    loaded once a write was refused, and evicted least-recently-used after
+    that.
+
+    Each process has its own index, so every like or unlike also gives the
+    message a new generation in the default cache, which workers share (see
+    group.checks). An entry is only used while its generation is current,
+    and for at most CHAT_LIKE_INDEX_TTL seconds.
+    """
+
+    def __init__(self, max_messages, ttl):
+        self.ttl = ttl
+        self._likers = LRUCache(max_messages, ttl=ttl)
+
+    def has_liked(self, message_id, user_id):
+        """
+        Return True or False, or None when the message is not indexed or its
+        likes changed since it was.
+        """
+        entry = self._likers.get(message_id)
+        if entry is None:
+            return None
+        likers, generation = entry
+        if generation != _generation(message_id):
+            self._likers.pop(message_id)
+            return None
+        return user_id in likers
+
+    def load(self, message_id):
+        # Read before the likers, so a change in between leaves the entry stale
+        generation = _generation(message_id)
+        likers = set(MessageLike.objects.filter(message_id=message_id).values_list('user_id', flat=True))
+        self._likers.set(message_id, (likers, generation))
+        return likers
+
+    def changed(self, message_id, user_id, liked):
+        """
+        Record that `user_id` liked or unliked `message_id`, and make the
+        entries of other processes stale.
+        """
+        entry = self._likers.get(message_id)
+        previous = _generation(message_id)
+        generation = uuid.uuid4().hex
+        cache.set(GENERATION_KEY % message_id, generation, self.ttl)
+        if entry is None:
+            return
+        likers, known = entry
+        if known != previous:
+            # Someone else changed the likes too, this entry misses it
+            self._likers.pop(message_id)
+            return
+        if liked:
+            likers.add(user_id)
+        else:
+            likers.discard(user_id)
+        self._likers.set(message_id, (likers, generation))
+
+    def clear(self):
+        self._likers.clear()
+
+
+like_index = LikeIndex(
+    getattr(settings, 'CHAT_LIKE_INDEX_SIZE', 10000),
+    getattr(settings, 'CHAT_LIKE_INDEX_TTL', 300),
+)
+
+
+@primary()
+def like_message(message_id, user_id):
+    """
+    Record a like by `user_id` on `message_id`.
+
+    Returns the new likes count, or None if the user had already liked the
+    message or the message does not exist or was deleted.
+    """
+    if like_index.has_liked(message_id, user_id):
+        return None
+    try:
+        with transaction.atomic():
+            if not Message.objects.filter(id=message_id, deleted=False).update(likes=F('likes') + 1):
+                return None
+            MessageLike.objects.create(message_id=message_id, user_id=user_id)
+    except IntegrityError:
+        # Already liked; index the likers so a repeat is refused without a query
+        like_index.load(message_id)
+        return None
+    like_index.changed(message_id, user_id, liked=True)
+    pin(user_id)
+    return Message.objects.values_list('likes', flat=True).get(id=message_id)
+
+
+@primary()
+def unlike_message(message_id, user_id):
+    """
+    Remove a like by `user_id` from `message_id`.
+
+    Returns the new likes count, or None if the user had not liked the message.
+    """
+    if like_index.has_liked(message_id, user_id) is False:
+        return None
+    with transaction.atomic():
+        deleted, _ = MessageLike.objects.filter(message_id=message_id, user_id=user_id).delete()
+        if not deleted:
+            like_index.load(message_id)
+            return None
+        Message.objects.filter(id=message_id, likes__gt=0).update(likes=F('likes') - 1)
+    like_index.changed(message_id, user_id, liked=False)
+    pin(user_id)
+    return Message.objects.values_list('likes', flat=True).get(id=message_id)
@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe mapping that evicts the least recently used key.
+
+    Consumers run their database work on a thread pool, so every operation
+    takes a lock. Reads refresh the key's position; once the cache holds
+    more than `max_size` keys the oldest one is dropped. With a `ttl` in
+    seconds, keys also expire that long after they were last set.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            if self.ttl is None:
+                return self._data[key]
+            expires, value = self._data[key]
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if self.ttl is not None:
+                value = (time.monotonic() + self.ttl, value)
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data.pop(key)
+        if self.ttl is None:
+            return value
+        expires, value = value
+        return value if expires >= time.monotonic() else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        missing = object()
+        return self.get(key, missing) is not missing
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,171 @@
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from group.delivery import store_message
+from group.models import Group, Membership, Message
+from group.writer import db_writer
+
+HISTORY_SIZE = 50
+
+
+def use_database(path):
+    """
+    Point the default connection of the current thread at the SQLite file `path`.
+    """
+    connections[DEFAULT_DB_ALIAS].close()
+    connection = connections.create_connection(DEFAULT_DB_ALIAS)
+    connection.settings_dict = dict(connection.settings_dict, NAME=str(path))
+    connections[DEFAULT_DB_ALIAS] = connection
+
+
+def restore_database():
+    connections[DEFAULT_DB_ALIAS].close()
+    del connections[DEFAULT_DB_ALIAS]
+
+
+def connected(path, func, *args):
+    """
+    Call `func` with the current thread connected to the database at `path`.
+    """
+    use_database(path)
+    try:
+        return func(*args)
+    finally:
+        restore_database()
+
+
+def profiles():
+    """
+    Return the settings of each profile compared by the benchmark.
+    """
+    return {
+        # SQLite's own defaults, every consumer writing from its own thread
+        'default': {'CHAT_SQLITE_PRAGMAS': {}, 'CHAT_DB_WRITER': False},
+        'tuned': {'CHAT_SQLITE_PRAGMAS': getattr(settings, 'CHAT_SQLITE_PRAGMAS', {}), 'CHAT_DB_WRITER': True},
+    }
+
+
+def percentile(values, n):
+    if len(values) < 2:
+        return round(values[0], 2) if values else None
+    return round(statistics.quantiles(values, n=100)[n - 1], 2)
+
+
+class Command(BaseCommand):
+    help = 'Measure chat write throughput and history read latency on SQLite under a mixed load, per connection profile.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', choices=sorted(profiles()), action='append', dest='profiles', help='Profile to measure, every profile by default.')
+        parser.add_argument('--writers', type=int, default=8, help='Threads posting messages.')
+        parser.add_argument('--readers', type=int, default=8, help='Threads reading the latest messages of the room.')
+        parser.add_argument('--duration', type=float, default=5, help='Seconds the load runs for each profile.')
+        parser.add_argument('--messages', type=int, default=10000, help='Messages in the room before the load starts.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON, for tracking over time.')
+
+    def handle(self, *args, **options):
+        results = []
+        for name in options['profiles'] or sorted(profiles()):
+            with tempfile.TemporaryDirectory() as directory, override_settings(**profiles()[name]):
+                result = self.measure(os.path.join(directory, 'bench.sqlite3'), options)
+            results.append(dict(result, profile=name))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+
+        self.stdout.write('%d writers and %d readers for %.1f s:' % (options['writers'], options['readers'], options['duration']))
+        for result in results:
+            self.stdout.write('  %-8s %8.1f writes/s  reads p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  %d errors' % (
+                result['profile'], result['writes_per_second'],
+                result['read_p50_ms'] or 0, result['read_p95_ms'] or 0, result['read_p99_ms'] or 0, result['errors'],
+            ))
+
+    def measure(self, path, options):
+        """
+        Run the mixed load against a new database at `path`.
+
+        The benchmark's threads, the writer included, are pointed at that
+        file, so the project's database is never touched.
+        """
+        group = self.run_in_thread(path, self.seed, options['messages'])
+        db_writer.call(use_database, path)
+
+        deadline = time.perf_counter() + options['duration']
+        writes = []
+        latencies = []
+        errors = []
+
+        def write():
+            done = 0
+            while time.perf_counter() < deadline:
+                try:
+                    db_writer.call(store_message, group.admin.username, group.slug, 'Hello', timezone.now())
+                    done += 1
+                except OperationalError:
+                    errors.append('write')
+            writes.append(done)
+
+        def read():
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    list(Message.objects.filter(group=group).select_related('user').order_by('-id')[:HISTORY_SIZE])
+                except OperationalError:
+                    errors.append('read')
+                    continue
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        threads = [threading.Thread(target=connected, args=(path, write)) for _ in range(options['writers'])]
+        threads += [threading.Thread(target=connected, args=(path, read)) for _ in range(options['readers'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        db_writer.call(restore_database)
+
+        return {
+            'writes': sum(writes),
+            'writes_per_second': round(sum(writes) / elapsed, 1),
+            'reads': len(latencies),
+            'read_p50_ms': percentile(latencies, 50),
+            'read_p95_ms': percentile(latencies, 95),
+            'read_p99_ms': percentile(latencies, 99),
+            'errors': len(errors),
+        }
+
+    @staticmethod
+    def run_in_thread(path, func, *args):
+        """
+        Call `func` on a new thread connected to the database at `path` and return its result.
+        """
+        result = []
+        thread = threading.Thread(target=lambda: result.append(connected(path, func, *args)))
+        thread.start()
+        thread.join()
+        return result[0] if result else None
+
+    @staticmethod
+    def seed(messages):
+        call_command('migrate', run_syncdb=True, interactive=False, verbosity=0)
+        user = User.objects.create_user(username='bench')
+        group = Group.objects.create(name='Bench', slug='bench', admin=user)
+        Membership.objects.create(group=group, user=user)
+        Message.objects.bulk_create(
+            (Message(group=group, user=user, content='Message %d' % i) for i in range(messages)),
+            batch_size=1000,
+        )
+        return group
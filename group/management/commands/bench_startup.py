@@ -0,0 +1,71 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+IMPORT_CODE = 'import time; t = time.perf_counter(); import group_chat.asgi; print(time.perf_counter() - t)'
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+def parse_import_times(output):
+    """
+    Parse `python -X importtime` output into (module, self us, cumulative us, depth) tuples.
+    """
+    imports = []
+    for line in output.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append((module, int(self_us), int(cumulative_us), len(indent) // 2))
+    return imports
+
+
+class Command(BaseCommand):
+    help = 'Measure how long a fresh process takes to import the ASGI application, and which imports cost the most.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='Number of fresh processes to time.')
+        parser.add_argument('--lean', action='store_true', help='Time the lean startup mode (GROUP_CHAT_LEAN_STARTUP=1).')
+        parser.add_argument('--top', type=int, default=15, help='Number of direct imports of group_chat.asgi to list.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON, for tracking over time.')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, GROUP_CHAT_LEAN_STARTUP='1' if options['lean'] else '0')
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'group_chat.settings')
+
+        times = []
+        imports = []
+        for _ in range(options['runs']):
+            result = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c', IMPORT_CODE],
+                cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+            )
+            times.append(float(result.stdout.strip().splitlines()[-1]) * 1000)
+            imports = parse_import_times(result.stderr)
+
+        # Modules imported directly while loading group_chat.asgi, by cumulative time in the last run
+        top = sorted((i for i in imports if i[3] == 1), key=lambda i: i[2], reverse=True)[:options['top']]
+        summary = {
+            'lean': options['lean'],
+            'python': sys.version.split()[0],
+            'runs_ms': [round(t, 1) for t in times],
+            'median_ms': round(statistics.median(times), 1),
+            'min_ms': round(min(times), 1),
+            'modules': len(imports),
+            'top_imports': [{'module': m, 'self_us': s, 'cumulative_us': c} for m, s, c, _ in top],
+        }
+
+        if options['json']:
+            self.stdout.write(json.dumps(summary))
+            return
+
+        self.stdout.write('Import of group_chat.asgi%s: median %.1f ms, min %.1f ms over %d runs, %d modules' % (
+            ' (lean)' if options['lean'] else '', summary['median_ms'], summary['min_ms'], len(times), len(imports),
+        ))
+        for item in summary['top_imports']:
+            self.stdout.write('  %8.1f ms  %s' % (item['cumulative_us'] / 1000, item['module']))
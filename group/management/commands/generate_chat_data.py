@@ -0,0 +1,83 @@
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from group.models import Group, Membership, Message
+
+
+def generate_chat_data(users=2000, groups=200, members=50, messages=100000, prefix='perf', batch_size=5000, seed=0):
+    """
+    Bulk-insert a synthetic dataset for performance testing.
+
+    Creates `users` users sharing the password 'password', and `groups`
+    groups. The first group is a very large room with every generated user
+    as a member; each other group gets `members` random members. `messages`
+    messages are spread randomly over the groups, each written by a member
+    of its group. Returns the created users and groups.
+    """
+    rng = random.Random(seed)
+    password = make_password('password')
+
+    with transaction.atomic():
+        User.objects.bulk_create(
+            [User(username='%s_user_%d' % (prefix, i), password=password) for i in range(users)],
+            batch_size=batch_size,
+        )
+        user_objs = list(User.objects.filter(username__startswith='%s_user_' % prefix).order_by('id'))
+        admin = user_objs[0]
+
+        Group.objects.bulk_create(
+            [Group(name='%s group %d' % (prefix, i), slug='%s_group_%d' % (prefix, i), admin=admin.username) for i in range(groups)],
+            batch_size=batch_size,
+        )
+        group_objs = list(Group.objects.filter(slug__startswith='%s_group_' % prefix).order_by('id'))
+
+        group_members = {group_objs[0].id: [user.id for user in user_objs]}
+        for group in group_objs[1:]:
+            group_members[group.id] = [user.id for user in rng.sample(user_objs, min(members, len(user_objs)))]
+        Membership.objects.bulk_create(
+            [Membership(group_id=group_id, user_id=user_id) for group_id, user_ids in group_members.items() for user_id in user_ids],
+            batch_size=batch_size,
+        )
+
+        group_ids = list(group_members)
+        batch = []
+        for i in range(messages):
+            group_id = rng.choice(group_ids)
+            batch.append(Message(group_id=group_id, user_id=rng.choice(group_members[group_id]), content='Message %d' % i))
+            if len(batch) >= batch_size:
+                Message.objects.bulk_create(batch)
+                batch = []
+        Message.objects.bulk_create(batch)
+
+    return user_objs, group_objs
+
+
+class Command(BaseCommand):
+    help = 'Generate a large synthetic dataset of users, groups, memberships and messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--groups', type=int, default=200)
+        parser.add_argument('--members', type=int, default=50, help='Members of each group but the first, which gets every user.')
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--prefix', default='perf', help='Prefix of the generated usernames and group slugs.')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        users, groups = generate_chat_data(
+            users=options['users'],
+            groups=options['groups'],
+            members=options['members'],
+            messages=options['messages'],
+            prefix=options['prefix'],
+            batch_size=options['batch_size'],
+            seed=options['seed'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            'Created %d users, %d groups and %d messages.' % (len(users), len(groups), options['messages'])
+        ))
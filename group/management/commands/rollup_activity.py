@@ -0,0 +1,40 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from group.activity import roll_up
+from group.models import Message
+
+
+class Command(BaseCommand):
+    help = 'Roll up the hourly and daily activity of every group.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backfill', action='store_true', help='Recount the whole message history.')
+        parser.add_argument('--since', help='Recount from this date (YYYY-MM-DD) instead of the last rolled up day.')
+        parser.add_argument('--interval', type=float, default=0, help='Keep rolling up every INTERVAL seconds instead of once.')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = timezone.make_aware(datetime.strptime(options['since'], '%Y-%m-%d'))
+            except ValueError:
+                raise CommandError('--since must be a date like 2023-01-31.')
+        if options['backfill']:
+            since = Message.objects.aggregate(Min('timestamp'))['timestamp__min']
+            if since is None:
+                self.stdout.write('There are no messages to roll up.')
+                return
+
+        while True:
+            started = time.perf_counter()
+            written = roll_up(since)
+            self.stdout.write('Wrote %d rollups in %.1f ms.' % (written, (time.perf_counter() - started) * 1000))
+            if not options['interval']:
+                break
+            since = None
+            time.sleep(options['interval'])
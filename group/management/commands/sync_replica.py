@@ -0,0 +1,32 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from group.replicas import sync_replica
+
+
+class Command(BaseCommand):
+    help = 'Copy the primary database into the local SQLite read replicas.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', dest='databases', help='Replica to refresh, every replica by default.')
+        parser.add_argument('--interval', type=float, default=0, help='Keep refreshing every INTERVAL seconds instead of once.')
+
+    def handle(self, *args, **options):
+        aliases = options['databases'] or settings.CHAT_READ_REPLICAS
+        if not aliases:
+            raise CommandError('No read replicas are configured, set GROUP_CHAT_REPLICA=1.')
+        for alias in aliases:
+            if alias not in settings.CHAT_READ_REPLICAS:
+                raise CommandError('%s is not a read replica.' % alias)
+
+        while True:
+            started = time.perf_counter()
+            for alias in aliases:
+                sync_replica(connections[alias].settings_dict['NAME'])
+            self.stdout.write('Synced %s in %.1f ms.' % (', '.join(aliases), (time.perf_counter() - started) * 1000))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,46 @@
+from django.contrib.auth.models import User
+
+from .models import Membership
+
+# Keeps every IN list well below SQLite's bound-parameter limit
+LOOKUP_BATCH_SIZE = 500
+
+
+def add_members_in_bulk(group, usernames):
+    """
+    Add the users named in `usernames` to `group`.
+
+    Usernames are resolved with one IN query per LOOKUP_BATCH_SIZE names and
+    only the missing membership rows are inserted, in a single bulk insert.
+
+    Returns a tuple of three lists of usernames: the ones added, the ones that
+    were already members and the ones that do not exist.
+    """
+    usernames = list(dict.fromkeys(usernames))
+    user_ids = {}
+    for i in range(0, len(usernames), LOOKUP_BATCH_SIZE):
+        batch = usernames[i:i + LOOKUP_BATCH_SIZE]
+        user_ids.update(User.objects.filter(username__in=batch).values_list('username', 'id'))
+
+    existing = set()
+    ids = list(user_ids.values())
+    for i in range(0, len(ids), LOOKUP_BATCH_SIZE):
+        existing.update(
+            Membership.objects.filter(group=group, user_id__in=ids[i:i + LOOKUP_BATCH_SIZE]).values_list('user_id', flat=True)
+        )
+
+    added, already_members, not_found = [], [], []
+    for username in usernames:
+        if username not in user_ids:
+            not_found.append(username)
+        elif user_ids[username] in existing:
+            already_members.append(username)
+        else:
+            added.append(username)
+
+    Membership.objects.bulk_create(
+        [Membership(group=group, user_id=user_ids[username]) for username in added],
+        batch_size=LOOKUP_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    return added, already_members, not_found
@@ -0,0 +1,180 @@
+"""
+@mention indexing, off the chat hot path.
+
+`store_message` hands every new message that contains an "@", and
+`edit_message` every edited message, to the background `mention_worker`.
+The worker collects messages into batches, resolves the mentioned
+usernames of a whole batch with one query (only members of the message's
+group count), inserts the inbox rows with one bulk insert and notifies
+the mentioned users on their personal channel-layer group `user_<id>`,
+never the whole room.
+
+Notifications are sent on the event loop of the server's sockets, which
+the consumers hand to the worker as they join their user group: an
+in-memory channel layer only wakes sockets waiting on its own loop.
+"""
+
+import asyncio
+import logging
+import queue
+import re
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_old_connections
+
+from .models import Mention
+from .replicas import primary
+
+logger = logging.getLogger(__name__)
+
+MENTION_RE = re.compile(r'(?<![\w@])@([\w.+-]+)')
+
+
+def parse_mentions(content):
+    """
+    Return the usernames mentioned in `content`, in order and without duplicates.
+    """
+    return list(dict.fromkeys(name.rstrip('.') for name in MENTION_RE.findall(content)))
+
+
+def user_group_name(user_id):
+    return 'user_%d' % user_id
+
+
+@primary()
+def process_batch(items, edited=()):
+    """
+    Index and notify the mentions of a batch of
+    `(message_id, group_id, slug, author, content)` tuples.
+
+    Messages whose id is in `edited` are indexed again: mentions the edit
+    removed are deleted, and users who were already mentioned are not
+    notified a second time.
+    """
+    mentioned = {item[0]: parse_mentions(item[4]) for item in items}
+    usernames = {username for names in mentioned.values() for username in names}
+    previous = {}
+    if edited:
+        previous = {
+            (message_id, user_id): mention_id
+            for mention_id, message_id, user_id in Mention.objects.filter(message_id__in=edited).values_list('id', 'message_id', 'user_id')
+        }
+    if not usernames:
+        if previous:
+            Mention.objects.filter(id__in=previous.values()).delete()
+        return []
+    group_ids = {item[1] for item in items}
+    members = {
+        (username, group_id): user_id
+        for username, user_id, group_id in User.objects.filter(
+            username__in=usernames, group__id__in=group_ids,
+        ).values_list('username', 'id', 'group__id')
+    }
+
+    mentions = []
+    notifications = []
+    for message_id, group_id, slug, author, content in items:
+        for username in mentioned[message_id]:
+            user_id = members.get((username, group_id))
+            if user_id is None or username == author:
+                continue
+            mentions.append(Mention(user_id=user_id, message_id=message_id, group_id=group_id))
+            if (message_id, user_id) in previous:
+                continue
+            notifications.append((user_id, {
+                'type': 'mention_notify',
+                'message_id': message_id,
+                'group': slug,
+                'username': author,
+                'message': content,
+            }))
+    stale = set(previous) - {(mention.message_id, mention.user_id) for mention in mentions}
+    if stale:
+        Mention.objects.filter(id__in=[previous[key] for key in stale]).delete()
+    Mention.objects.bulk_create(mentions, ignore_conflicts=True)
+
+    send_notifications(notifications)
+    return mentions
+
+
+def send_notifications(notifications):
+    """
+    Send each `(user_id, event)` to the user's group, on the server's event
+    loop when the worker knows it.
+    """
+    channel_layer = get_channel_layer()
+    loop = mention_worker.loop
+    for user_id, event in notifications:
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(channel_layer.group_send(user_group_name(user_id), event), loop).result()
+        else:
+            async_to_sync(channel_layer.group_send)(user_group_name(user_id), event)
+
+
+class MentionWorker:
+    """
+    Daemon thread draining queued messages in batches of up to
+    CHAT_MENTIONS_BATCH_SIZE, waiting at most CHAT_MENTIONS_BATCH_WAIT
+    seconds for a batch to fill up.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def listen(self, loop):
+        """
+        Send notifications on `loop`, the event loop of the sockets receiving them.
+        """
+        self.loop = loop
+
+    def submit(self, message_id, group_id, slug, author, content, edited=False):
+        # An edit may have removed the message's only mention
+        if '@' not in content and not edited:
+            return
+        self.start()
+        self.queue.put(((message_id, group_id, slug, author, content), edited))
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='mention-worker', daemon=True)
+                self._thread.start()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + getattr(settings, 'CHAT_MENTIONS_BATCH_WAIT', 0.5)
+            while len(batch) < getattr(settings, 'CHAT_MENTIONS_BATCH_SIZE', 500):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                close_old_connections()
+                process_batch([item for item, _ in batch], edited={item[0] for item, edited in batch if edited})
+            except Exception:
+                logger.exception('Failed to index mentions of %d messages', len(batch))
+            finally:
+                close_old_connections()
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self):
+        """
+        Block until every queued message has been processed.
+        """
+        self.queue.join()
+
+
+mention_worker = MentionWorker()
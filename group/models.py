@@ -1,23 +1,132 @@
 from django.contrib.auth.models import User
 from django.db import models
+from django.urls import reverse
 
 
 class Group(models.Model):
     name = models.CharField(max_length=255)
     slug = models.SlugField(unique=True)
     admin = models.CharField(max_length=255)
-    members = models.ManyToManyField(User, related_name='group')
+    members = models.ManyToManyField(User, related_name='group', through='Membership')
+    # Counts edits and deletions of the group's messages, the cursor of delta sync for changes
+    changes = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.name
 
 
+class Membership(models.Model):
+    # The table Django created for Group.members, with an index for each direction:
+    # members of a group and groups of a user are both read from the index alone
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, db_index=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+
+    class Meta:
+        db_table = 'group_group_members'
+        constraints = [
+            models.UniqueConstraint(fields=['group', 'user'], name='unique_membership'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'group'], name='membership_user_group_idx'),
+        ]
+
+
+class Attachment(models.Model):
+    # Files are stored once per content hash, see group.attachments
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.PositiveBigIntegerField()
+    name = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=255)
+    group = models.ForeignKey(Group, related_name='attachments', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='attachments', on_delete=models.CASCADE)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+    def get_absolute_url(self):
+        return reverse('attachment', args=[self.id])
+
+
 class Message(models.Model):
-    group = models.ForeignKey(Group, related_name='messages', on_delete=models.CASCADE)
+    # Indexed by message_group_idx below
+    group = models.ForeignKey(Group, related_name='messages', on_delete=models.CASCADE, db_index=False)
     user = models.ForeignKey(User, related_name='messages', on_delete=models.CASCADE)
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     likes = models.PositiveIntegerField(default=0)
+    client_id = models.CharField(max_length=64, blank=True, null=True)
+    attachment = models.ForeignKey(Attachment, related_name='messages', blank=True, null=True, on_delete=models.SET_NULL)
+    # Bumped by every edit and by deletion, so clients apply patches in order
+    version = models.PositiveIntegerField(default=1)
+    edited = models.DateTimeField(blank=True, null=True)
+    # A deleted message stays as a tombstone without content, keeping its place in the history
+    deleted = models.BooleanField(default=False)
+    # The group's change count at the last edit or deletion, 0 while unchanged
+    change = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['group', 'user', 'client_id'], name='unique_message_client_id'),
+        ]
+        indexes = [
+            # Serves the history and delta-sync of a group, newest or oldest first by id
+            models.Index(fields=['group', 'id'], name='message_group_idx'),
+            # Serves delta sync of the messages edited or deleted since a change count
+            models.Index(fields=['group', 'change'], name='message_change_idx'),
+            # Lets activity rollups read a time window without a full scan
+            models.Index(fields=['timestamp'], name='message_timestamp_idx'),
+        ]
+
+
+class MessageLike(models.Model):
+    message = models.ForeignKey(Message, related_name='message_likes', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='message_likes', on_delete=models.CASCADE)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'message'], name='unique_message_like'),
+        ]
+        indexes = [
+            models.Index(fields=['timestamp'], name='message_like_timestamp_idx'),
+        ]
+
+
+class Mention(models.Model):
+    user = models.ForeignKey(User, related_name='mentions', on_delete=models.CASCADE)
+    message = models.ForeignKey(Message, related_name='mentions', on_delete=models.CASCADE)
+    group = models.ForeignKey(Group, related_name='mentions', on_delete=models.CASCADE)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'message'], name='unique_mention'),
+        ]
+        indexes = [
+            # Serves the inbox, newest first, one page at a time
+            models.Index(fields=['user', '-id'], name='mention_inbox_idx'),
+        ]
+
+
+class GroupActivity(models.Model):
+    HOUR = 'hour'
+    DAY = 'day'
+    PERIOD_CHOICES = [(HOUR, 'Hour'), (DAY, 'Day')]
+
+    # Counts of one group over the hour or day starting at `start`, see group.activity
+    group = models.ForeignKey(Group, related_name='activity', on_delete=models.CASCADE)
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    start = models.DateTimeField()
+    messages = models.PositiveIntegerField(default=0)
+    likes = models.PositiveIntegerField(default=0)
+    active_users = models.PositiveIntegerField(default=0)
 
     class Meta:
-        ordering = ('timestamp',)
+        constraints = [
+            models.UniqueConstraint(fields=['group', 'period', 'start'], name='unique_group_activity'),
+        ]
+        indexes = [
+            # Serves the busiest groups over a time window
+            models.Index(fields=['period', 'start'], name='group_activity_period_idx'),
+        ]
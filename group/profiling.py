@@ -0,0 +1,191 @@
+"""
+Opt-in sampling profiler for views and consumer handlers.
+
+With CHAT_PROFILE_SAMPLE_RATE set to N, one in N HTTP requests and WebSocket
+frames is timed. A sampled unit of work records the time spent in each
+`phase()` it enters (parse, db, channel_layer, send, ...), and the self time
+of every phase is aggregated by stack. Every CHAT_PROFILE_FLUSH_INTERVAL
+seconds the aggregate is written to CHAT_PROFILE_DIR in the folded-stack
+format read by flamegraph.pl, inferno and speedscope, one
+`root;phase;subphase microseconds` line per stack.
+
+When the rate is 0 (the default) `profile()` and `phase()` only read a
+setting or a context variable before getting out of the way.
+"""
+
+import asyncio
+import atexit
+import itertools
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+from django.utils.decorators import sync_and_async_middleware
+
+_current = ContextVar('profile_sample', default=None)
+_counter = itertools.count()
+_lock = threading.Lock()
+_stacks = Counter()
+_last_flush = time.monotonic()
+_no_phase = nullcontext()
+
+
+class Sample:
+    """
+    Timings of one sampled request or frame.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = Counter()
+        # One [name, start, child_time] entry per open phase
+        self.stack = [[name, time.perf_counter_ns(), 0]]
+
+    def push(self, name):
+        self.stack.append([name, time.perf_counter_ns(), 0])
+
+    def pop(self):
+        path = ';'.join(entry[0] for entry in self.stack[1:])
+        name, start, child_time = self.stack.pop()
+        elapsed = time.perf_counter_ns() - start
+        self.timings[path] += elapsed - child_time
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+
+def sample_rate():
+    return getattr(settings, 'CHAT_PROFILE_SAMPLE_RATE', 0)
+
+
+def should_sample():
+    rate = sample_rate()
+    return bool(rate) and next(_counter) % rate == 0
+
+
+@contextmanager
+def profile(name):
+    """
+    Profile the enclosed work if it is picked as one of the 1-in-N samples.
+    """
+    if not should_sample():
+        yield None
+        return
+    sample = Sample(name)
+    token = _current.set(sample)
+    try:
+        yield sample
+    finally:
+        _current.reset(token)
+        sample.pop()
+        record(sample)
+
+
+def phase(name):
+    """
+    Time the enclosed block as `name` within the current sample, if any.
+    """
+    sample = _current.get()
+    if sample is None:
+        return _no_phase
+    return _phase(sample, name)
+
+
+@contextmanager
+def _phase(sample, name):
+    sample.push(name)
+    try:
+        yield
+    finally:
+        sample.pop()
+
+
+def profiled(name):
+    """
+    Decorator profiling an async consumer handler as `name`.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not sample_rate():
+                return await func(*args, **kwargs)
+            with profile(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(sample):
+    global _last_flush
+    with _lock:
+        for path, elapsed in sample.timings.items():
+            _stacks[sample.name + (';' + path if path else '')] += elapsed // 1000
+        due = time.monotonic() - _last_flush >= getattr(settings, 'CHAT_PROFILE_FLUSH_INTERVAL', 60)
+    if due:
+        flush()
+
+
+def flush():
+    """
+    Append the aggregated stacks to a folded-stack file and start over.
+    """
+    global _last_flush
+    with _lock:
+        stacks = _stacks.copy()
+        _stacks.clear()
+        _last_flush = time.monotonic()
+    if not stacks:
+        return None
+    directory = getattr(settings, 'CHAT_PROFILE_DIR', 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'profile-%d-%d.folded' % (os.getpid(), time.time()))
+    with open(path, 'a') as f:
+        for stack, microseconds in sorted(stacks.items()):
+            f.write('%s %d\n' % (stack, microseconds))
+    return path
+
+
+atexit.register(flush)
+
+
+def _time_query(execute, sql, params, many, context):
+    with phase('db'):
+        return execute(sql, params, many, context)
+
+
+def _request_name(request):
+    match = request.resolver_match
+    return 'http;%s' % (match.view_name if match else 'unresolved')
+
+
+@sync_and_async_middleware
+def ProfilingMiddleware(get_response):
+    """
+    Profile one in CHAT_PROFILE_SAMPLE_RATE HTTP requests, timing queries as 'db'.
+    """
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            if not sample_rate():
+                return await get_response(request)
+            with profile('http') as sample:
+                response = await get_response(request)
+                if sample is not None:
+                    sample.name = _request_name(request)
+            return response
+    else:
+        def middleware(request):
+            if not sample_rate():
+                return get_response(request)
+            with profile('http') as sample:
+                if sample is None:
+                    return get_response(request)
+                with connection.execute_wrapper(_time_query):
+                    response = get_response(request)
+                sample.name = _request_name(request)
+            return response
+    return middleware
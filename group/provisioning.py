@@ -0,0 +1,140 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+
+from .replicas import primary
+
+_executor = None
+
+
+def get_executor():
+    """
+    Return the shared process pool used for password hashing, or None when
+    CHAT_PROVISION_WORKERS is 0 and hashing happens in the calling thread.
+
+    Workers are spawned rather than forked so they do not inherit the
+    server's threads, open connections or event loops; they only need the
+    settings module to hash.
+    """
+    global _executor
+    if worker_count() == 0:
+        return None
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=worker_count(), mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def worker_count():
+    workers = getattr(settings, 'CHAT_PROVISION_WORKERS', None)
+    if workers is None:
+        return os.cpu_count() or 1
+    return workers
+
+
+def hash_passwords(passwords):
+    executor = get_executor()
+    if executor is None:
+        return [make_password(password) for password in passwords]
+    chunksize = max(1, len(passwords) // (worker_count() * 4))
+    return list(executor.map(make_password, passwords, chunksize=chunksize))
+
+
+@primary()
+def existing_usernames(usernames):
+    existing = set()
+    for i in range(0, len(usernames), 500):
+        existing.update(User.objects.filter(username__in=usernames[i:i + 500]).values_list('username', flat=True))
+    return existing
+
+
+@primary()
+def _create_batch(batch):
+    """
+    Insert a batch of (username, password) pairs and return the usernames
+    that were taken in the meantime.
+    """
+    hashes = hash_passwords([password for _, password in batch])
+    users = [User(username=username, password=hashed) for (username, _), hashed in zip(batch, hashes)]
+    try:
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+        return set()
+    except IntegrityError:
+        # Someone created one of these usernames since the existence check
+        taken = existing_usernames([user.username for user in users])
+        User.objects.bulk_create([user for user in users if user.username not in taken], ignore_conflicts=True)
+        return taken
+
+
+def provision_users(entries):
+    """
+    Create users from a list of {'username': ..., 'password': ...} entries.
+
+    Existing usernames are found with one query per 500 names, passwords are
+    hashed in parallel on a process pool and users are inserted in batches of
+    CHAT_PROVISION_BATCH_SIZE. Yields one result dict per entry, as soon as it
+    is known, with a 'status' of 'created', 'exists' or 'invalid'.
+
+    The results are streamed after the view returned, outside the request's
+    routing, so every query is sent to the primary explicitly.
+    """
+    valid = []
+    seen = set()
+    for entry in entries:
+        username = entry.get('username') if isinstance(entry, dict) else None
+        password = entry.get('password') if isinstance(entry, dict) else None
+        if not username or not password or not isinstance(username, str) or not isinstance(password, str):
+            yield {'username': username, 'status': 'invalid', 'error': 'Both username and password are required.'}
+        elif username in seen:
+            yield {'username': username, 'status': 'invalid', 'error': 'Duplicate username in request.'}
+        else:
+            seen.add(username)
+            valid.append((username, password))
+
+    existing = existing_usernames([username for username, _ in valid])
+    to_create = []
+    for username, password in valid:
+        if username in existing:
+            yield {'username': username, 'status': 'exists', 'error': 'Username already exists.'}
+        else:
+            to_create.append((username, password))
+
+    batch_size = getattr(settings, 'CHAT_PROVISION_BATCH_SIZE', 500)
+    for i in range(0, len(to_create), batch_size):
+        batch = to_create[i:i + batch_size]
+        taken = _create_batch(batch)
+        for username, _ in batch:
+            if username in taken:
+                yield {'username': username, 'status': 'exists', 'error': 'Username already exists.'}
+            else:
+                yield {'username': username, 'status': 'created'}
+
+
+def stream_results(results):
+    """
+    Encode results as newline-delimited JSON.
+    """
+    for result in results:
+        yield json.dumps(result) + '\n'
+
+
+async def astream_results(results):
+    """
+    Like `stream_results`, for ASGI servers, which read a synchronous iterator
+    in full before sending any of it. Each result is produced in the
+    request's sync thread and sent as soon as it is known.
+    """
+    results = iter(results)
+    done = object()
+    while True:
+        result = await sync_to_async(next)(results, done)
+        if result is done:
+            return
+        yield json.dumps(result) + '\n'
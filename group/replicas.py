@@ -0,0 +1,135 @@
+"""
+Primary/replica database routing.
+
+Writes always go to the `default` database, the primary. Reads go to one of
+the CHAT_READ_REPLICAS aliases, picked at random, except:
+
+- inside `primary()`, which chat writes and every non-GET request run in,
+- for a user who wrote in the last CHAT_REPLICA_PIN_SECONDS seconds, so a
+  user always reads their own writes even while the replicas lag behind,
+- for sessions, which must be found right after login.
+
+Pins live in the Django cache so that every worker sharing the cache agrees
+on them. Locally a replica is a second SQLite file refreshed by
+`python manage.py sync_replica`.
+"""
+
+import asyncio
+import random
+import sqlite3
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.decorators import sync_and_async_middleware
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_use_primary = ContextVar('use_primary', default=False)
+
+
+def replicas():
+    return getattr(settings, 'CHAT_READ_REPLICAS', [])
+
+
+def _pin_key(user_id):
+    return 'replicas:pin:%s' % user_id
+
+
+def pin(user_id):
+    """
+    Send the reads of `user_id` to the primary until the replicas caught up.
+    """
+    if user_id is not None and replicas():
+        cache.set(_pin_key(user_id), True, timeout=getattr(settings, 'CHAT_REPLICA_PIN_SECONDS', 10))
+
+
+def is_pinned(user_id):
+    return user_id is not None and cache.get(_pin_key(user_id), False)
+
+
+@contextmanager
+def primary():
+    """
+    Read from the primary within the enclosed block.
+    """
+    token = _use_primary.set(True)
+    try:
+        yield
+    finally:
+        _use_primary.reset(token)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        aliases = replicas()
+        if not aliases or _use_primary.get() or model._meta.app_label == 'sessions':
+            return DEFAULT_DB_ALIAS
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Every database holds the same rows
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copies of the primary, schema included
+        return db == DEFAULT_DB_ALIAS
+
+
+@sync_and_async_middleware
+def ReplicaRoutingMiddleware(get_response):
+    """
+    Run non-GET requests and requests of pinned users against the primary, and
+    pin the user after a non-GET request.
+    """
+    def route(request):
+        if request.method not in SAFE_METHODS:
+            return True
+        return is_pinned(request.session.get(SESSION_KEY))
+
+    def done(request):
+        if request.method not in SAFE_METHODS:
+            # Read after the view, so a login pins the user who just logged in
+            pin(request.session.get(SESSION_KEY))
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            # Loading the session may query the database
+            if not replicas() or not await sync_to_async(route)(request):
+                return await get_response(request)
+            with primary():
+                response = await get_response(request)
+            done(request)
+            return response
+    else:
+        def middleware(request):
+            if not replicas() or not route(request):
+                return get_response(request)
+            with primary():
+                response = get_response(request)
+            done(request)
+            return response
+    return middleware
+
+
+def sync_replica(path):
+    """
+    Copy the primary into the SQLite database file at `path`.
+
+    Uses SQLite's online backup, so the replica is replaced by a consistent
+    snapshot of the primary in a single transaction.
+    """
+    connection = connections[DEFAULT_DB_ALIAS]
+    connection.ensure_connection()
+    target = sqlite3.connect(str(path))
+    try:
+        connection.connection.backup(target)
+    finally:
+        target.close()
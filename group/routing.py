@@ -3,5 +3,6 @@ from django.urls import path
 from . import consumers
 
 websocket_urlpatterns = [
+    path('ws/', consumers.MultiplexConsumer.as_asgi()),
     path('ws/<str:group_name>/', consumers.ChatConsumer.as_asgi()),
 ]
@@ -0,0 +1,121 @@
+"""
+Session engine serving reads from a bounded in-process LRU.
+
+Set SESSION_ENGINE = 'group.sessions' to use it. Sessions are still stored
+in the django_session table: every save is written through to the database
+and then cached, and deleting a session (logout, flush, cycle_key on login
+or password change) evicts it. A session is served from memory for at most
+CHAT_SESSION_CACHE_TTL seconds.
+
+Other processes hold their own copies, so saving or deleting a session also
+gives it a new generation in the default cache, which workers share (see
+group.checks). A cached copy is only served while its generation is still
+current, so a session logged out in one worker is rejected by all of them
+on their next request. Django also checks the session's password hash
+against the user on every request.
+"""
+
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.utils import timezone
+
+from .lru import LRUCache
+
+_cache = LRUCache(
+    getattr(settings, 'CHAT_SESSION_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'CHAT_SESSION_CACHE_TTL', 300),
+)
+_stats_lock = threading.Lock()
+GENERATION_KEY = 'chat-session-generation:%s'
+_hits = 0
+_misses = 0
+
+
+def _count(hit):
+    global _hits, _misses
+    with _stats_lock:
+        if hit:
+            _hits += 1
+        else:
+            _misses += 1
+
+
+def stats():
+    """
+    Return the hit rate of the in-process session cache since startup.
+    """
+    with _stats_lock:
+        hits, misses = _hits, _misses
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / lookups if lookups else 0.0,
+        'size': len(_cache),
+    }
+
+
+def _generation(session_key):
+    return cache.get(GENERATION_KEY % session_key)
+
+
+def _new_generation(session_key):
+    """
+    Make every cached copy of the session stale and return its new generation.
+    """
+    generation = uuid.uuid4().hex
+    cache.set(GENERATION_KEY % session_key, generation, getattr(settings, 'CHAT_SESSION_CACHE_TTL', 300))
+    return generation
+
+
+def clear():
+    global _hits, _misses
+    _cache.clear()
+    with _stats_lock:
+        _hits = _misses = 0
+
+
+class SessionStore(DBStore):
+    """
+    Database-backed session store with an in-process read cache.
+
+    The cache holds the encoded session data, exactly as stored in the
+    database, so every request decodes its own copy, along with the
+    generation it was read at.
+    """
+
+    def load(self):
+        if self.session_key is not None:
+            cached = _cache.get(self.session_key)
+            if cached is not None and cached[1] > timezone.now() and cached[2] == _generation(self.session_key):
+                _count(True)
+                return self.decode(cached[0])
+        _count(False)
+
+        generation = _generation(self.session_key) if self.session_key is not None else None
+        s = self._get_session_from_db()
+        if s is None:
+            return {}
+        _cache.set(self.session_key, (s.session_data, s.expire_date, generation))
+        return self.decode(s.session_data)
+
+    def create_model_instance(self, data):
+        obj = super().create_model_instance(data)
+        self._saved_row = (obj.session_data, obj.expire_date)
+        return obj
+
+    def save(self, must_create=False):
+        super().save(must_create=must_create)
+        _cache.set(self.session_key, self._saved_row + (_new_generation(self.session_key),))
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            session_key = self.session_key
+        if session_key is not None:
+            _cache.pop(session_key)
+            _new_generation(session_key)
+        super().delete(session_key)
@@ -0,0 +1,29 @@
+"""
+Connection profile for SQLite.
+
+Every new SQLite connection gets the CHAT_SQLITE_PRAGMAS. With the defaults in
+settings.py:
+
+- journal_mode=wal lets readers keep reading while a write is committed,
+- busy_timeout makes a blocked connection wait for the lock instead of
+  failing at once with "database is locked",
+- synchronous=normal only syncs to disk at checkpoints, which is safe in
+  WAL mode,
+- mmap_size and cache_size keep hot pages in memory.
+
+Other database backends are left alone.
+"""
+
+
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    # Imported here, as the hook is connected before settings are used
+    from django.conf import settings
+
+    pragmas = getattr(settings, 'CHAT_SQLITE_PRAGMAS', {})
+    if not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
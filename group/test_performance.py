@@ -0,0 +1,279 @@
+import os
+import tempfile
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .attachments import find_attachment, object_path
+from .delivery import delete_message, edit_message, recent_client_ids, store_message
+from .likes import like_index, like_message, unlike_message
+from .management.commands.generate_chat_data import generate_chat_data
+from .mentions import process_batch
+from .models import Attachment, Group, Message
+from . import sessions
+
+
+class QueryBudgetTest(TestCase):
+    """
+    The number of queries of each view and consumer action must not grow with
+    the number of messages, members or groups. Sessions are served from the
+    in-process session cache, so views never read django_session.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='testuser', password='testpassword')
+        cls.group = Group.objects.create(name='Group 1', admin=cls.user.username, slug='group_1')
+        cls.others = [User.objects.create_user(username='member%d' % i, password='x') for i in range(10)]
+        cls.group.members.add(cls.user, *cls.others)
+        for i in range(30):
+            Message.objects.create(group=cls.group, user=cls.others[i % 10], content='Message %d' % i)
+        for i in range(5):
+            group = Group.objects.create(name='Other %d' % i, admin=cls.user.username, slug='other_%d' % i)
+            group.members.add(cls.user)
+
+    def setUp(self):
+        sessions.clear()
+        self.client.login(username='testuser', password='testpassword')
+        like_index.clear()
+        recent_client_ids.clear()
+
+    def test_group_view(self):
+        # User, group, recent messages with their authors, membership check
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('group', args=[self.group.slug]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_groups_view(self):
+        # User, groups
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('groups'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_search_groups_view(self):
+        # User, matching groups
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('search-groups'), {'query': 'Other'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_group_users_view(self):
+        # User, group, members
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('group-users', args=[self.group.slug]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_add_members_view(self):
+        # User, group, users who are not members yet
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('add-members', args=[self.group.slug]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_add_members_bulk_view(self):
+        # User, group, usernames, existing memberships, one bulk insert
+        usernames = ['member%d' % i for i in range(10)] + ['new%d' % i for i in range(50)]
+        User.objects.bulk_create([User(username=username) for username in usernames[10:]])
+        with self.assertNumQueries(5):
+            response = self.client.post(reverse('add-members-bulk', args=[self.group.slug]), {'usernames': ' '.join(usernames)})
+        self.assertEqual(len(response.context['result']['added']), 50)
+
+    def test_group_messages_view(self):
+        # User, group, membership, messages after the given id with their authors
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('group-messages', args=[self.group.slug]), {'after': 0})
+        self.assertEqual(response.status_code, 200)
+
+    def test_mentions_view(self):
+        # User, one page of mentions with their messages, authors and groups
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('mentions'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_group_activity_view(self):
+        # User, group, membership check, rollups; never the messages
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('group-activity', args=[self.group.slug]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_top_groups_view(self):
+        # User, one aggregate over the daily rollups
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('top_groups'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_store_message(self):
+        # User, group and the insert inside its savepoint
+        with self.assertNumQueries(5):
+            store_message('testuser', self.group.slug, 'Hello', timezone.now(), 'abc')
+
+    def test_like_message(self):
+        # The update and insert inside a savepoint, the new count
+        message = Message.objects.filter(group=self.group).first()
+        with self.assertNumQueries(5):
+            like_message(message.id, self.user.id)
+
+
+class QueryPlanTest(TestCase):
+    """
+    The queries of the hot paths must be answered from indexes: their SQLite
+    query plans may neither scan a whole table or index nor sort rows in a
+    temporary B-tree.
+
+    search_groups and add_members are left out on purpose. A substring search
+    and the list of every user who is not a member read the whole table.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='testuser', password='testpassword')
+        cls.other = User.objects.create_user(username='other', password='testpassword')
+        cls.group = Group.objects.create(name='Group 1', admin=cls.user.username, slug='group_1')
+        cls.group.members.add(cls.user, cls.other)
+        cls.messages = [
+            Message.objects.create(group=cls.group, user=cls.other, content='Hello @testuser %d' % i) for i in range(5)
+        ]
+
+    def setUp(self):
+        sessions.clear()
+        self.client.login(username='testuser', password='testpassword')
+        like_index.clear()
+        recent_client_ids.clear()
+
+    def assertIndexed(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        self.assertTrue(queries.captured_queries)
+        for query in queries.captured_queries:
+            sql = query['sql']
+            if not sql.startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                plan = [row[-1] for row in cursor.fetchall()]
+            slow = [step for step in plan if step.startswith('SCAN') or 'TEMP B-TREE' in step]
+            self.assertFalse(slow, 'Query is not served by an index:\n%s\n%s' % (sql, '\n'.join(plan)))
+
+    def test_group_view(self):
+        self.assertIndexed(lambda: self.client.get(reverse('group', args=[self.group.slug])))
+
+    def test_groups_view(self):
+        self.assertIndexed(lambda: self.client.get(reverse('groups')))
+
+    def test_group_users_view(self):
+        self.assertIndexed(lambda: self.client.get(reverse('group-users', args=[self.group.slug])))
+
+    def test_group_messages_view(self):
+        url = reverse('group-messages', args=[self.group.slug])
+        self.assertIndexed(lambda: self.client.get(url, {'after': self.messages[1].id}))
+        self.assertIndexed(lambda: self.client.get(url, {'after': self.messages[1].id, 'changes_after': 0}))
+
+    def test_mentions_view(self):
+        self.assertIndexed(lambda: process_batch([
+            (message.id, self.group.id, self.group.slug, 'other', message.content) for message in self.messages
+        ]))
+        self.assertIndexed(lambda: self.client.get(reverse('mentions'), {'before': self.messages[3].id}))
+
+    def test_group_activity_view(self):
+        self.assertIndexed(lambda: self.client.get(reverse('group-activity', args=[self.group.slug])))
+
+    def test_attachment_view(self):
+        attachment = Attachment.objects.create(
+            sha256='0' * 64, size=1, name='a.txt', content_type='text/plain', group=self.group, user=self.user,
+        )
+        with tempfile.TemporaryDirectory() as directory, self.settings(CHAT_ATTACHMENTS_DIR=directory):
+            os.makedirs(os.path.dirname(object_path(attachment.sha256)))
+            with open(object_path(attachment.sha256), 'wb') as f:
+                f.write(b'a')
+            self.assertIndexed(lambda: self.client.get(reverse('attachment', args=[attachment.id])).close())
+        self.assertIndexed(lambda: find_attachment(attachment.id, self.group.slug, 'testuser'))
+
+    def test_store_message(self):
+        self.assertIndexed(lambda: store_message('testuser', self.group.slug, 'Hello', timezone.now(), 'abc'))
+
+    def test_like_message(self):
+        self.assertIndexed(lambda: like_message(self.messages[0].id, self.user.id))
+        # A refused like loads the message's likers
+        self.assertIndexed(lambda: like_message(self.messages[0].id, self.user.id))
+        self.assertIndexed(lambda: unlike_message(self.messages[0].id, self.user.id))
+
+    def test_edit_and_delete_message(self):
+        self.assertIndexed(lambda: edit_message(self.messages[0].id, self.group.slug, self.user.id, 'Edited'))
+        self.assertIndexed(lambda: delete_message(self.messages[0].id, self.group.slug, self.user.id, 'testuser'))
+
+    def test_membership_check(self):
+        # As done by the multiplexed socket on every subscription
+        self.assertIndexed(lambda: Group.objects.filter(slug=self.group.slug, members=self.user.id).exists())
+
+
+class LargeDatasetPerformanceTest(TestCase):
+    """
+    Hot paths must keep their query counts, and stay within time and memory
+    limits, on a large dataset: 100k messages, 2000 users, 200 groups and one
+    group with every user as a member.
+
+    The time and memory limits depend on the machine. Raise them with
+    GROUP_CHAT_PERF_MAX_SECONDS and GROUP_CHAT_PERF_MAX_MEMORY_MB on slow
+    machines, or set either to 0 to skip that check.
+    """
+
+    max_seconds = float(os.environ.get('GROUP_CHAT_PERF_MAX_SECONDS', 0.5))
+    max_memory = float(os.environ.get('GROUP_CHAT_PERF_MAX_MEMORY_MB', 1.5)) * 1024 * 1024
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users, cls.groups = generate_chat_data(users=2000, groups=200, members=50, messages=100000)
+        cls.big_group = cls.groups[0]
+        cls.user = cls.users[0]
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        like_index.clear()
+        recent_client_ids.clear()
+
+    def measure(self, func, queries):
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            with self.assertNumQueries(queries):
+                result = func()
+        finally:
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        if self.max_seconds:
+            self.assertLess(elapsed, self.max_seconds)
+        if self.max_memory:
+            self.assertLess(peak, self.max_memory)
+        return result
+
+    def test_group_view(self):
+        # The page of the largest group only renders its recent history
+        response = self.measure(lambda: self.client.get(reverse('group', args=[self.big_group.slug])), 4)
+        self.assertEqual(response.status_code, 200)
+
+    def test_groups_view(self):
+        # The groups page of a user who belongs to many groups
+        response = self.measure(lambda: self.client.get(reverse('groups')), 2)
+        self.assertEqual(response.status_code, 200)
+
+    def test_search_groups_view(self):
+        response = self.measure(lambda: self.client.get(reverse('search-groups'), {'query': 'perf group 1'}), 2)
+        self.assertEqual(response.status_code, 200)
+
+    def test_group_messages_view(self):
+        # Syncing the largest group from its oldest message is capped by CHAT_SYNC_LIMIT
+        response = self.measure(lambda: self.client.get(reverse('group-messages', args=[self.big_group.slug]), {'after': 0}), 4)
+        self.assertEqual(response.status_code, 200)
+
+    def test_store_message(self):
+        self.measure(lambda: store_message(self.user.username, self.big_group.slug, 'Hello', timezone.now(), 'abc'), 5)
+
+    def test_like_message(self):
+        message = Message.objects.filter(group=self.big_group).last()
+        self.measure(lambda: like_message(message.id, self.user.id), 5)
@@ -1,8 +1,45 @@
+import asyncio
+import io
 import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase, Client
+from django.core.handlers.asgi import ASGIHandler
+from django.core.signals import request_started
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.contrib.sessions.models import Session
+from django.db import close_old_connections, connection
+from django.test.utils import CaptureQueriesContext
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, Client, RequestFactory, override_settings
 from django.urls import reverse
-from .models import Group, Message
+from .models import Attachment, Group, GroupActivity, Message, MessageLike, Mention
+from .likes import LikeIndex, like_index, like_message, unlike_message
+from .delivery import delete_message, edit_message, recent_client_ids, store_message
+from .routing import websocket_urlpatterns
+from .mentions import mention_worker, parse_mentions, process_batch, send_notifications, user_group_name
+from .auth import ConnectTokenAuthMiddlewareStack, make_connect_token, read_connect_token
+from .activity import roll_up, start_of_day
+from .attachments import BLOCK_SIZE, find_attachment, object_path, parse_range
+from .replicas import PrimaryReplicaRouter, ReplicaRoutingMiddleware, is_pinned, primary, sync_replica
+from .checks import check_shared_cache
+from .writer import db_writer
+from . import admission, fanout, profiling, sessions
+from django.utils import timezone
 from django.utils.text import slugify
 from .forms import SignUpForm
 from rest_framework import status
@@ -355,3 +392,1398 @@ class GroupViewsTest(TestCase):
 
         # Expect HTTP 302 redirect as the user is not logged in and should be redirected to login page
         self.assertEqual(response.status_code, 302)
+
+
+class MessageLikeTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.group = Group.objects.create(name='Group 1', admin=self.user, slug=slugify('Group 1'))
+        self.message = Message.objects.create(group=self.group, content='Test message', user=self.user)
+        like_index.clear()
+        cache.clear()
+
+    def test_like_is_counted_once_per_user(self):
+        # Liking the same message twice only counts the first like
+        self.assertEqual(like_message(self.message.id, self.user.id), 1)
+        self.assertIsNone(like_message(self.message.id, self.user.id))
+
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.likes, 1)
+        self.assertEqual(MessageLike.objects.filter(message=self.message).count(), 1)
+
+    def test_repeated_like_is_answered_from_index(self):
+        # Once a repeated like was refused, repeats are refused without a query
+        other = User.objects.create_user(username='other', password='testpassword')
+        like_message(self.message.id, self.user.id)
+        self.assertIsNone(like_message(self.message.id, self.user.id))
+        with self.assertNumQueries(0):
+            self.assertIsNone(like_message(self.message.id, self.user.id))
+            self.assertIsNone(unlike_message(self.message.id, other.id))
+
+    def test_index_changed_by_another_worker(self):
+        # A like or unlike made by another worker makes this worker's entry stale
+        other_worker = LikeIndex(10, 300)
+        like_message(self.message.id, self.user.id)
+        like_message(self.message.id, self.user.id)
+        MessageLike.objects.filter(message=self.message).delete()
+        other_worker.changed(self.message.id, self.user.id, liked=False)
+        self.assertEqual(like_message(self.message.id, self.user.id), 2)
+
+        other = User.objects.create_user(username='other', password='testpassword')
+        self.assertIsNone(unlike_message(self.message.id, other.id))
+        MessageLike.objects.create(message=self.message, user=other)
+        other_worker.changed(self.message.id, other.id, liked=True)
+        self.assertEqual(unlike_message(self.message.id, other.id), 1)
+
+    def test_like_missing_message(self):
+        # Liking a message that does not exist changes nothing
+        self.assertIsNone(like_message(self.message.id + 1, self.user.id))
+        self.assertEqual(MessageLike.objects.count(), 0)
+
+    def test_unlike(self):
+        # Unliking removes the like and decrements the count, unliking again does nothing
+        like_message(self.message.id, self.user.id)
+        self.assertEqual(unlike_message(self.message.id, self.user.id), 0)
+        self.assertIsNone(unlike_message(self.message.id, self.user.id))
+        self.assertFalse(MessageLike.objects.filter(message=self.message, user=self.user).exists())
+
+    def test_like_after_index_eviction(self):
+        # An existing like is still found after the message drops out of the index
+        like_message(self.message.id, self.user.id)
+        like_index.clear()
+        self.assertIsNone(like_message(self.message.id, self.user.id))
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.likes, 1)
+
+
+class MessageDeliveryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.group = Group.objects.create(name='Group 1', admin=self.user, slug=slugify('Group 1'))
+        recent_client_ids.clear()
+
+    def test_resent_message_is_stored_once(self):
+        # Sending the same client id twice stores one message and returns its id both times
+        message_id, created = store_message('testuser', self.group.slug, 'Hello', timezone.now(), 'abc')
+        self.assertTrue(created)
+
+        with self.assertNumQueries(0):
+            resent_id, created = store_message('testuser', self.group.slug, 'Hello', timezone.now(), 'abc')
+        self.assertFalse(created)
+        self.assertEqual(resent_id, message_id)
+        self.assertEqual(Message.objects.filter(group=self.group).count(), 1)
+
+    def test_resent_message_after_eviction(self):
+        # Once the id has left the in-memory window the unique constraint still catches the resend
+        message_id, _ = store_message('testuser', self.group.slug, 'Hello', timezone.now(), 'abc')
+        recent_client_ids.clear()
+
+        resent_id, created = store_message('testuser', self.group.slug, 'Hello', timezone.now(), 'abc')
+        self.assertFalse(created)
+        self.assertEqual(resent_id, message_id)
+        self.assertEqual(Message.objects.filter(group=self.group).count(), 1)
+
+    def test_client_ids_are_per_sender(self):
+        # Another member reusing a client id gets their own message, not an ack for someone else's
+        User.objects.create_user(username='other', password='testpassword')
+        message_id, _ = store_message('testuser', self.group.slug, 'Hello', timezone.now(), 'abc')
+
+        other_id, created = store_message('other', self.group.slug, 'Mine', timezone.now(), 'abc')
+        self.assertTrue(created)
+        self.assertNotEqual(other_id, message_id)
+
+        # Also once the ids have left the in-memory window
+        recent_client_ids.clear()
+        self.assertEqual(store_message('other', self.group.slug, 'Mine', timezone.now(), 'abc'), (other_id, False))
+        self.assertEqual(store_message('testuser', self.group.slug, 'Hello', timezone.now(), 'abc'), (message_id, False))
+
+    def test_messages_without_client_id(self):
+        # Messages without a client id are never deduplicated
+        store_message('testuser', self.group.slug, 'Hello', timezone.now())
+        store_message('testuser', self.group.slug, 'Hello', timezone.now())
+        self.assertEqual(Message.objects.filter(group=self.group).count(), 2)
+
+
+@override_settings(CHAT_FANOUT_SHARD_SIZE=1, CHAT_FANOUT_MAX_SHARDS=4, CHAT_FANOUT_REBALANCE_GRACE=0)
+class FanoutTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_shards_for_size(self):
+        # Shards double as the room grows and stop at the configured maximum
+        self.assertEqual(fanout.shards_for_size(1), 1)
+        self.assertEqual(fanout.shards_for_size(2), 2)
+        self.assertEqual(fanout.shards_for_size(3), 4)
+        self.assertEqual(fanout.shards_for_size(100), 4)
+
+    def test_join_and_leave(self):
+        # Joining past a shard boundary grows the room, the last leave resets it
+        self.assertEqual(fanout.join('room'), (1, False))
+        self.assertEqual(fanout.join('room'), (2, True))
+        self.assertEqual(fanout.join('room'), (4, True))
+        for _ in range(3):
+            fanout.leave('room')
+        self.assertEqual(fanout.room_shards('room'), 1)
+
+    def test_broadcast_reaches_every_socket_once(self):
+        # After the room is rebalanced, a broadcast to all shards reaches each socket exactly once
+        async def broadcast():
+            application = URLRouter(websocket_urlpatterns)
+            communicators = [WebsocketCommunicator(application, '/ws/room/') for _ in range(4)]
+            for communicator in communicators:
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+            await asyncio.sleep(0.1)
+
+            await fanout.group_send(get_channel_layer(), 'room', 4, {
+                'type': 'chat_message',
+                'message': 'Hello',
+                'username': 'testuser',
+                'timestamp': '2023-01-01 00:00:00',
+                'message_id': 1,
+            })
+            for communicator in communicators:
+                response = await communicator.receive_json_from()
+                self.assertEqual(response['message'], 'Hello')
+                self.assertTrue(await communicator.receive_nothing())
+                await communicator.disconnect()
+
+        async_to_sync(broadcast)()
+
+
+class MigrationsTest(TestCase):
+    def test_models_match_migrations(self):
+        # Every model change ships with its migration
+        call_command('makemigrations', 'group', check=True, dry_run=True, stdout=io.StringIO())
+
+
+class SharedCacheCheckTest(SimpleTestCase):
+    redis_layer = {'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer'}}
+    shared_cache = {'default': {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache'}}
+
+    def test_local_setup(self):
+        # One process with its own cache and channel layer is fine
+        with self.settings(SESSION_ENGINE='django.contrib.sessions.backends.db'):
+            self.assertEqual(check_shared_cache(None), [])
+
+    def test_shared_layer_needs_shared_cache(self):
+        # Workers sharing a channel layer must share shard counts too
+        with self.settings(CHANNEL_LAYERS=self.redis_layer):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['group.E001'])
+        with self.settings(CHANNEL_LAYERS=self.redis_layer, CACHES=self.shared_cache):
+            self.assertEqual(check_shared_cache(None), [])
+
+    def test_pins_and_room_limits_warn(self):
+        # Read replica pins and room limits are per process with a local cache
+        with self.settings(CHAT_READ_REPLICAS=['replica'], CHAT_MAX_ROOM_CONNECTIONS=10, SESSION_ENGINE='django.contrib.sessions.backends.db'):
+            warnings = check_shared_cache(None)
+        self.assertEqual([warning.id for warning in warnings], ['group.W001'])
+        self.assertIn('CHAT_READ_REPLICAS and CHAT_MAX_ROOM_CONNECTIONS', warnings[0].msg)
+
+    def test_session_cache_warns(self):
+        # Logouts only reach the other workers' session caches through a shared cache
+        warnings = check_shared_cache(None)
+        self.assertEqual([warning.id for warning in warnings], ['group.W001'])
+        self.assertIn('group.sessions', warnings[0].msg)
+        with self.settings(CACHES=self.shared_cache):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class ConnectTokenTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User(id=1, username='testuser')
+
+    def connect(self, path, application=None):
+        """
+        Return the first frame received on a new socket, {} if there is none, or
+        None if the socket was refused.
+        """
+        async def connect():
+            communicator = WebsocketCommunicator(application or ConnectTokenAuthMiddlewareStack(URLRouter(websocket_urlpatterns)), path)
+            connected, _ = await communicator.connect()
+            if connected:
+                response = {} if await communicator.receive_nothing() else await communicator.receive_json_from()
+                await communicator.disconnect()
+                return response
+            return None
+
+        return async_to_sync(connect)()
+
+    def test_token_round_trip(self):
+        # A token carries the user and the room it was issued for
+        claims = read_connect_token(make_connect_token(self.user, 'room'))
+        self.assertEqual(claims, {'u': 1, 'n': 'testuser', 'g': 'room'})
+
+    def test_tampered_or_expired_token(self):
+        # Tampered and expired tokens are rejected
+        token = make_connect_token(self.user, 'room')
+        self.assertIsNone(read_connect_token(token[:-1] + ('a' if token[-1] != 'a' else 'b')))
+        with self.settings(CHAT_CONNECT_TOKEN_MAX_AGE=-1):
+            self.assertIsNone(read_connect_token(token))
+
+    def test_connect_with_session(self):
+        # A socket authenticated by its session gets a token for the next reconnect
+        router = URLRouter(websocket_urlpatterns)
+
+        async def application(scope, receive, send):
+            return await router(dict(scope, user=self.user), receive, send)
+
+        response = self.connect('/ws/room/', application)
+        self.assertEqual(response['action'], 'token')
+        self.assertEqual(read_connect_token(response['token'])['u'], 1)
+
+    def test_connect_with_token(self):
+        # A valid token authenticates the socket without touching the database, but is not
+        # renewed, so a token outlives neither its max age nor the session it came from
+        response = self.connect('/ws/room/?token=' + make_connect_token(self.user, 'room'))
+        self.assertEqual(response, {})
+
+    def test_connect_with_token_for_other_room(self):
+        # A token issued for another room is refused
+        self.assertIsNone(self.connect('/ws/room/?token=' + make_connect_token(self.user, 'other')))
+
+
+class ProfilingTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.group = Group.objects.create(name='Group 1', admin=self.user, slug=slugify('Group 1'))
+        self.profile_dir = tempfile.mkdtemp()
+        profiling.flush()
+
+    def read_profile(self):
+        path = profiling.flush()
+        if path is None:
+            return {}
+        with open(path) as f:
+            return dict(line.rsplit(' ', 1) for line in f.read().splitlines())
+
+    def test_phases_are_folded_by_stack(self):
+        # Nested phases are recorded as folded stacks under the sample name
+        with self.settings(CHAT_PROFILE_SAMPLE_RATE=1, CHAT_PROFILE_DIR=self.profile_dir):
+            with profiling.profile('ws;receive'):
+                with profiling.phase('parse'):
+                    pass
+                with profiling.phase('db'):
+                    with profiling.phase('send'):
+                        pass
+            stacks = self.read_profile()
+        self.assertCountEqual(stacks, ['ws;receive', 'ws;receive;parse', 'ws;receive;db', 'ws;receive;db;send'])
+
+    def test_sampled_request_records_queries(self):
+        # A sampled request is named after its view and its queries are timed as 'db'
+        self.client.login(username='testuser', password='testpassword')
+        with self.settings(CHAT_PROFILE_SAMPLE_RATE=1, CHAT_PROFILE_DIR=self.profile_dir):
+            self.client.get(reverse('group', args=[self.group.slug]))
+            stacks = self.read_profile()
+        self.assertIn('http;group;db', stacks)
+        self.assertTrue(os.listdir(self.profile_dir))
+
+    def test_profiling_off(self):
+        # Nothing is recorded while the sample rate is 0
+        self.client.login(username='testuser', password='testpassword')
+        with self.settings(CHAT_PROFILE_DIR=self.profile_dir):
+            self.client.get(reverse('group', args=[self.group.slug]))
+            self.assertEqual(self.read_profile(), {})
+
+
+class BulkMembersTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.group = Group.objects.create(name='Group 1', admin=self.user, slug=slugify('Group 1'))
+        self.group.members.add(self.user)
+        for i in range(3):
+            User.objects.create_user(username='member%d' % i, password='testpassword')
+        self.client.login(username='testuser', password='testpassword')
+
+    def test_add_members_bulk_from_text(self):
+        # Existing users are added once, members are skipped and unknown names are reported
+        data = {'usernames': 'member0, member1\nmember1 testuser nobody'}
+        response = self.client.post(reverse('add-members-bulk', args=[self.group.slug]), data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['result'], {
+            'added': ['member0', 'member1'],
+            'already_members': ['testuser'],
+            'not_found': ['nobody'],
+        })
+        self.assertEqual(self.group.members.count(), 3)
+
+    def test_add_members_bulk_from_csv(self):
+        # Usernames are read from the first column of an uploaded CSV file, skipping the header
+        csv_file = SimpleUploadedFile('members.csv', b'username,email\nmember0,a@example.com\nmember2,b@example.com\n')
+        response = self.client.post(reverse('add-members-bulk', args=[self.group.slug]), {'csv_file': csv_file})
+
+        self.assertEqual(response.context['result']['added'], ['member0', 'member2'])
+        self.assertTrue(self.group.members.filter(username='member2').exists())
+
+    def test_add_members_bulk_named_username(self):
+        # Only a header row is skipped, a user named "username" can still be added
+        User.objects.create_user(username='username', password='testpassword')
+        data = {'usernames': 'username', 'csv_file': SimpleUploadedFile('members.csv', b'Username\nmember0\nusername\n')}
+        response = self.client.post(reverse('add-members-bulk', args=[self.group.slug]), data)
+
+        self.assertEqual(response.context['result']['added'], ['username', 'member0'])
+
+    def test_add_members_bulk_empty(self):
+        # Submitting no usernames shows a form error and adds nobody
+        response = self.client.post(reverse('add-members-bulk', args=[self.group.slug]), {'usernames': ' '})
+
+        self.assertIsNone(response.context['result'])
+        self.assertTrue(response.context['form'].errors)
+        self.assertEqual(self.group.members.count(), 1)
+
+
+class ProvisionUsersTest(TestCase):
+    def setUp(self):
+        User.objects.create_user(username='existing', password='testpassword')
+        self.staff = User.objects.create_user(username='staff', password='testpassword', is_staff=True)
+        self.client.force_login(self.staff)
+
+    def post_users(self, users):
+        response = self.client.post('/api/create-users/', {'users': users}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        return [(result['username'], result['status']) for result in map(json.loads, lines)]
+
+    def test_create_users(self):
+        # New users are created with hashed passwords on the process pool, others are reported
+        results = self.post_users([
+            {'username': 'new1', 'password': 'secret1'},
+            {'username': 'new2', 'password': 'secret2'},
+            {'username': 'existing', 'password': 'secret'},
+            {'username': 'nopassword'},
+            {'username': 'new1', 'password': 'again'},
+        ])
+
+        self.assertCountEqual(results, [
+            ('new1', 'created'), ('new2', 'created'), ('existing', 'exists'), ('nopassword', 'invalid'), ('new1', 'invalid'),
+        ])
+        self.assertTrue(User.objects.get(username='new1').check_password('secret1'))
+        self.assertTrue(User.objects.get(username='new2').check_password('secret2'))
+
+    @override_settings(CHAT_PROVISION_WORKERS=0, CHAT_PROVISION_BATCH_SIZE=2)
+    def test_create_users_in_batches(self):
+        # Users are inserted in batches with a single existence check, after loading the staff user
+        users = [{'username': 'user%d' % i, 'password': 'secret'} for i in range(5)]
+        with self.assertNumQueries(1 + 1 + 3 * 3):
+            results = self.post_users(users)
+
+        self.assertEqual({result for _, result in results}, {'created'})
+        self.assertEqual(User.objects.filter(username__startswith='user').count(), 5)
+
+    @override_settings(CHAT_PROVISION_WORKERS=0, CHAT_READ_REPLICAS=['replica'])
+    def test_create_users_reads_primary(self):
+        # The body is streamed after the routing middleware returned, yet never reads a replica
+        results = self.post_users([{'username': 'existing', 'password': 'secret'}, {'username': 'new1', 'password': 'secret1'}])
+        self.assertEqual(results, [('existing', 'exists'), ('new1', 'created')])
+
+    def test_create_users_requires_list(self):
+        # A body without a list of users is rejected
+        response = self.client.post('/api/create-users/', {'users': 'new1'}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(CHAT_PROVISION_MAX_USERS=2)
+    def test_create_users_limit(self):
+        # Too many users in one request are refused before any is hashed
+        users = [{'username': 'user%d' % i, 'password': 'secret'} for i in range(3)]
+        response = self.client.post('/api/create-users/', {'users': users}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(User.objects.filter(username__startswith='user').exists())
+
+    def test_create_users_requires_staff(self):
+        # Anonymous and regular users may not provision accounts
+        users = [{'username': 'new1', 'password': 'secret1'}]
+        self.client.logout()
+        response = self.client.post('/api/create-users/', {'users': users}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_login(User.objects.get(username='existing'))
+        response = self.client.post('/api/create-users/', {'users': users}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(User.objects.filter(username='new1').exists())
+
+
+class SessionCacheTest(TestCase):
+    def setUp(self):
+        sessions.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.client.login(username='testuser', password='testpassword')
+        self.session_key = self.client.session.session_key
+
+    def test_session_is_read_from_cache(self):
+        # A saved session is loaded again without reading django_session
+        with self.assertNumQueries(0):
+            session = sessions.SessionStore(self.session_key)
+            self.assertEqual(session['_auth_user_id'], str(self.user.id))
+        self.assertGreater(sessions.stats()['hits'], 0)
+
+    def test_session_is_written_through(self):
+        # Changes are saved to the database as well as the cache
+        session = sessions.SessionStore(self.session_key)
+        session['color'] = 'yellow'
+        session.save()
+
+        sessions.clear()
+        self.assertEqual(sessions.SessionStore(self.session_key)['color'], 'yellow')
+        self.assertEqual(sessions.stats()['misses'], 1)
+
+    def test_logout_invalidates_session(self):
+        # After logging out, the old session key is neither cached nor stored
+        self.client.post('/logout/')
+        self.assertFalse(Session.objects.filter(session_key=self.session_key).exists())
+        self.assertNotIn('_auth_user_id', sessions.SessionStore(self.session_key).load())
+
+    def test_logout_in_another_worker(self):
+        # A copy cached by another worker is not served once the session was logged out
+        sessions.SessionStore(self.session_key).load()
+        cached = sessions._cache.get(self.session_key)
+        self.client.post('/logout/')
+        sessions._cache.set(self.session_key, cached)
+        self.assertNotIn('_auth_user_id', sessions.SessionStore(self.session_key).load())
+
+    def test_session_cache_stats_view(self):
+        # Only staff users can see the hit rate
+        response = self.client.get(reverse('session_cache_stats'))
+        self.assertEqual(response.status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('session_cache_stats'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hit_rate', json.loads(response.content))
+
+
+class StartupTest(SimpleTestCase):
+    def test_lean_startup_skips_heavy_imports(self):
+        # In lean mode the ASGI app loads without Django REST framework or Twisted
+        code = 'import sys, group_chat.asgi; print(sorted(m for m in ("rest_framework", "twisted") if m in sys.modules))'
+        env = dict(os.environ, GROUP_CHAT_LEAN_STARTUP='1', DJANGO_SETTINGS_MODULE='group_chat.settings')
+        result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '[]')
+
+    def test_bench_startup(self):
+        # The startup benchmark reports timings and the heaviest imports as JSON
+        out = io.StringIO()
+        call_command('bench_startup', runs=1, lean=True, json=True, stdout=out)
+        summary = json.loads(out.getvalue())
+        self.assertGreater(summary['median_ms'], 0)
+        self.assertTrue(summary['top_imports'])
+
+
+class GroupMessagesTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.group = Group.objects.create(name='Group 1', admin=self.user, slug=slugify('Group 1'))
+        self.group.members.add(self.user)
+        self.messages = [Message.objects.create(group=self.group, content='Message %d' % i, user=self.user) for i in range(3)]
+        self.client.force_login(self.user)
+        self.url = reverse('group-messages', args=[self.group.slug])
+
+    def test_messages_after_id(self):
+        # Only messages after the given id are returned, as compact rows
+        response = self.client.get(self.url, {'after': self.messages[0].id})
+        data = json.loads(response.content)
+
+        self.assertEqual(data['fields'], ['id', 'username', 'content', 'timestamp', 'likes', 'attachment', 'version', 'deleted'])
+        self.assertEqual([row[2] for row in data['messages']], ['Message 1', 'Message 2'])
+        self.assertEqual(data['last_id'], self.messages[2].id)
+        self.assertFalse(data['more'])
+
+    def test_messages_limit(self):
+        # The limit caps the result and 'more' tells the client to ask again
+        data = json.loads(self.client.get(self.url, {'limit': 2}).content)
+        self.assertEqual(len(data['messages']), 2)
+        self.assertTrue(data['more'])
+        self.assertEqual(data['last_id'], self.messages[1].id)
+
+    def test_messages_etag(self):
+        # A matching If-None-Match gets 304 until something changes
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Message.objects.filter(id=self.messages[0].id).update(likes=1)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_messages_long_poll_timeout(self):
+        # With nothing new, a long-poll returns an empty result once the wait is over
+        response = self.client.get(self.url, {'after': self.messages[2].id, 'wait': 0.1})
+        data = json.loads(response.content)
+        self.assertEqual(data['messages'], [])
+        self.assertEqual(data['last_id'], self.messages[2].id)
+
+    def test_messages_long_poll_wakes_up(self):
+        # A long-poll returns as soon as a message is broadcast to the group
+        self.async_client.force_login(self.user)
+
+        async def poll():
+            request = asyncio.ensure_future(self.async_client.get(self.url, {'after': self.messages[2].id, 'wait': 5}))
+            await asyncio.sleep(0.2)
+            await sync_to_async(Message.objects.create)(group=self.group, content='New message', user=self.user)
+            await fanout.group_send(get_channel_layer(), self.group.slug, 1, {'type': 'chat_message', 'message': 'New message'})
+            return await request
+
+        response = async_to_sync(poll)()
+        data = json.loads(response.content)
+        self.assertEqual([row[2] for row in data['messages']], ['New message'])
+
+    def test_messages_changes_after(self):
+        # Edits and deletes after the client's last change come back in their current state
+        etag = self.client.get(self.url)['ETag']
+        baseline = json.loads(self.client.get(self.url, {'after': self.messages[2].id}).content)['last_change']
+        edit_message(self.messages[0].id, self.group.slug, self.user.id, 'Edited')
+        delete_message(self.messages[1].id, self.group.slug, self.user.id, 'testuser')
+        edit_message(self.messages[0].id, self.group.slug, self.user.id, 'Edited twice')
+
+        data = json.loads(self.client.get(self.url, {'after': self.messages[2].id, 'changes_after': baseline}).content)
+        self.assertEqual(data['messages'], [])
+        rows = [dict(zip(data['fields'], row)) for row in data['changes']]
+        self.assertEqual(
+            [(row['id'], row['content'], row['deleted']) for row in rows],
+            [(self.messages[1].id, '', True), (self.messages[0].id, 'Edited twice', False)],
+        )
+        self.assertEqual(data['last_change'], baseline + 3)
+        self.assertFalse(data['more_changes'])
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        # Nothing changed since then
+        data = json.loads(self.client.get(self.url, {'after': self.messages[2].id, 'changes_after': data['last_change']}).content)
+        self.assertEqual(data['changes'], [])
+
+        # Changes are paged like messages are
+        data = json.loads(self.client.get(self.url, {'after': self.messages[2].id, 'changes_after': baseline, 'limit': 1}).content)
+        self.assertEqual([row[0] for row in data['changes']], [self.messages[1].id])
+        self.assertTrue(data['more_changes'])
+
+    def test_messages_long_poll_wakes_up_on_patch(self):
+        # A long-poll waiting for changes returns when a message is edited
+        self.async_client.force_login(self.user)
+        params = {'after': self.messages[2].id, 'changes_after': self.group.changes, 'wait': 5}
+
+        async def poll():
+            request = asyncio.ensure_future(self.async_client.get(self.url, params))
+            await asyncio.sleep(0.2)
+            patch = await sync_to_async(edit_message)(self.messages[2].id, self.group.slug, self.user.id, 'Edited')
+            await fanout.group_send(get_channel_layer(), self.group.slug, 1, patch)
+            return await request
+
+        response = async_to_sync(poll)()
+        data = json.loads(response.content)
+        self.assertEqual([row[2] for row in data['changes']], ['Edited'])
+
+    def test_messages_unauthorized(self):
+        # Without a logged-in user the view redirects to the login page
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    def test_messages_members_only(self):
+        # Users outside the group can neither read nor long-poll its messages
+        self.client.force_login(User.objects.create_user(username='outsider', password='testpassword'))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.assertEqual(self.client.get(self.url, {'wait': 5}).status_code, 403)
+
+
+class MentionTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.alice = User.objects.create_user(username='alice', password='testpassword')
+        self.bob = User.objects.create_user(username='bob.smith', password='testpassword')
+        self.group = Group.objects.create(name='Group 1', admin=self.user, slug=slugify('Group 1'))
+        self.group.members.add(self.user, self.alice)
+
+    def mention(self, content, user=None):
+        message = Message.objects.create(group=self.group, content=content, user=user or self.user)
+        return message, (message.id, self.group.id, self.group.slug, message.user.username, content)
+
+    def test_parse_mentions(self):
+        # Usernames are found after an @, once each, without trailing punctuation
+        self.assertEqual(parse_mentions('hi @alice and @bob.smith. @alice, mail a@b.c'), ['alice', 'bob.smith'])
+
+    def test_only_members_are_mentioned(self):
+        # Mentions of non-members, unknown users and the author are ignored
+        message, item = self.mention('@alice @bob.smith @nobody @testuser')
+        process_batch([item])
+
+        self.assertEqual(list(Mention.objects.values_list('user__username', flat=True)), ['alice'])
+
+    def test_batch_is_indexed_with_few_queries(self):
+        # A batch of messages costs one lookup and one insert, and notifies only the mentioned user
+        items = [self.mention('hello @alice %d' % i)[1] for i in range(5)]
+
+        async def listen():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add(user_group_name(self.alice.id), channel)
+            await sync_to_async(self.process, thread_sensitive=True)(items)
+            events = [await layer.receive(channel) for _ in items]
+            await layer.group_discard(user_group_name(self.alice.id), channel)
+            return events
+
+        events = async_to_sync(listen)()
+        self.assertEqual({event['message_id'] for event in events}, {item[0] for item in items})
+        self.assertEqual(Mention.objects.filter(user=self.alice).count(), 5)
+
+    def process(self, items):
+        with self.assertNumQueries(2):
+            process_batch(items)
+
+    def test_notify_from_worker_thread(self):
+        # The worker's own thread wakes a socket waiting on the server's event loop at once
+        async def listen():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add(user_group_name(self.alice.id), channel)
+            mention_worker.listen(asyncio.get_running_loop())
+            worker = threading.Thread(target=send_notifications, args=([(self.alice.id, {'type': 'mention_notify', 'message_id': 1})],))
+            started = time.monotonic()
+            worker.start()
+            try:
+                event = await asyncio.wait_for(layer.receive(channel), 5)
+                return event, time.monotonic() - started
+            finally:
+                await sync_to_async(worker.join, thread_sensitive=False)()
+                await layer.group_discard(user_group_name(self.alice.id), channel)
+
+        event, elapsed = async_to_sync(listen)()
+        self.assertEqual(event['message_id'], 1)
+        self.assertLess(elapsed, 1)
+
+    def test_mentions_view(self):
+        # The inbox lists the newest mentions first, a page at a time, with one query per page
+        for i in range(3):
+            process_batch([self.mention('@alice number %d' % i)[1]])
+        self.client.force_login(self.alice)
+
+        with self.settings(CHAT_MENTIONS_PAGE_SIZE=2):
+            response = self.client.get(reverse('mentions'))
+            contents = [mention.message.content for mention in response.context['mentions']]
+            self.assertEqual(contents, ['@alice number 2', '@alice number 1'])
+
+            response = self.client.get(reverse('mentions'), {'before': response.context['next_before']})
+            self.assertEqual([mention.message.content for mention in response.context['mentions']], ['@alice number 0'])
+            self.assertIsNone(response.context['next_before'])
+
+
+@override_settings(CHAT_READ_REPLICAS=['replica'])
+class ReplicaRoutingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = PrimaryReplicaRouter()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.group = Group.objects.create(name='Group 1', admin=self.user, slug=slugify('Group 1'))
+
+    def test_reads_go_to_replicas_and_writes_to_primary(self):
+        # Reads use a replica unless the primary is asked for, sessions always use the primary
+        self.assertEqual(self.router.db_for_read(Message), 'replica')
+        self.assertEqual(self.router.db_for_write(Message), 'default')
+        self.assertEqual(self.router.db_for_read(Session), 'default')
+        with primary():
+            self.assertEqual(self.router.db_for_read(Message), 'default')
+        self.assertEqual(self.router.db_for_read(Message), 'replica')
+
+    @override_settings(CHAT_READ_REPLICAS=[])
+    def test_without_replicas_everything_uses_primary(self):
+        # Nothing is routed or pinned when no replica is configured
+        self.assertEqual(self.router.db_for_read(Message), 'default')
+        store_message(self.user.username, self.group.slug, 'Hello', timezone.now())
+        self.assertFalse(is_pinned(self.user.id))
+
+    def test_writer_reads_its_own_writes(self):
+        # Posting a message pins the sender to the primary, and only the sender
+        other = User.objects.create_user(username='other', password='testpassword')
+        store_message(self.user.username, self.group.slug, 'Hello', timezone.now())
+        self.assertTrue(is_pinned(self.user.id))
+        self.assertFalse(is_pinned(other.id))
+
+        # A pinned user's GET requests read from the primary, other users' from a replica
+        self.assertEqual(self.route('GET', self.user), 'default')
+        self.assertEqual(self.route('GET', other), 'replica')
+
+    def test_non_get_requests_use_primary_and_pin(self):
+        # A POST runs against the primary and pins the user for the following reads
+        self.assertEqual(self.route('POST', self.user), 'default')
+        self.assertTrue(is_pinned(self.user.id))
+
+    def route(self, method, user):
+        request = getattr(RequestFactory(), method.lower())('/')
+        request.session = self.client.session
+        request.session['_auth_user_id'] = str(user.id)
+        databases = []
+
+        def view(request):
+            databases.append(self.router.db_for_read(Message))
+            return HttpResponse()
+
+        ReplicaRoutingMiddleware(view)(request)
+        return databases[0]
+
+
+class SyncReplicaTest(TransactionTestCase):
+    # SQLite cannot back up a database while a transaction is open on it
+
+    def test_sync_replica(self):
+        # The replica file is a copy of the primary, including recent writes
+        user = User.objects.create_user(username='testuser', password='testpassword')
+        group = Group.objects.create(name='Group 1', admin=user, slug=slugify('Group 1'))
+        Message.objects.create(group=group, user=user, content='Hello')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'replica.sqlite3')
+            sync_replica(path)
+            connection = sqlite3.connect(path)
+            try:
+                rows = connection.execute('SELECT content FROM group_message').fetchall()
+            finally:
+                connection.close()
+        self.assertEqual(rows, [('Hello',)])
+
+
+class SqliteProfileTest(SimpleTestCase):
+    databases = {'default'}
+
+    def pragma(self, connection, name):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA %s' % name)
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        # New connections wait for locks and only sync to disk at checkpoints
+        self.assertEqual(self.pragma(connection, 'busy_timeout'), 5000)
+        self.assertEqual(self.pragma(connection, 'synchronous'), 1)
+        self.assertEqual(self.pragma(connection, 'cache_size'), -64 * 1024)
+
+    def test_wal(self):
+        # A database file is switched to WAL, which an in-memory test database cannot use
+        with tempfile.TemporaryDirectory() as directory:
+            other = connection.copy()
+            other.settings_dict = dict(connection.settings_dict, NAME=os.path.join(directory, 'db.sqlite3'))
+            try:
+                self.assertEqual(self.pragma(other, 'journal_mode'), 'wal')
+            finally:
+                other.close()
+
+
+class DatabaseWriterTest(TransactionTestCase):
+    # The writer has its own connection, which only sees committed rows
+
+    def setUp(self):
+        recent_client_ids.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.group = Group.objects.create(name='Group 1', admin=self.user, slug=slugify('Group 1'))
+        self.group.members.add(self.user)
+
+    def test_writes_on_one_thread(self):
+        # Every write runs on the same writer thread and returns its result
+        async def write():
+            return await asyncio.gather(*(
+                db_writer.run(lambda i=i: (threading.current_thread().name, store_message('testuser', self.group.slug, 'Hello %d' % i, timezone.now(), str(i))))
+                for i in range(5)
+            ))
+
+        results = async_to_sync(write)()
+        self.assertEqual(len({name for name, _ in results}), 1)
+        self.assertTrue(results[0][0].startswith('db-writer'))
+        self.assertNotEqual(results[0][0], threading.current_thread().name)
+        self.assertEqual(Message.objects.filter(group=self.group).count(), 5)
+
+    def test_errors(self):
+        # A failed write raises in the caller and leaves the writer usable
+        with self.assertRaises(Message.DoesNotExist):
+            db_writer.call(lambda: Message.objects.get(id=0))
+        message_id, created = db_writer.call(store_message, 'testuser', self.group.slug, 'Hello', timezone.now(), 'abc')
+        self.assertTrue(created)
+        self.assertTrue(Message.objects.filter(id=message_id).exists())
+
+    def test_bench_sqlite(self):
+        # The benchmark runs each profile on its own database file and reports JSON
+        out = io.StringIO()
+        call_command('bench_sqlite', writers=2, readers=2, duration=0.2, messages=10, json=True, stdout=out)
+        results = {result['profile']: result for result in json.loads(out.getvalue())}
+        self.assertEqual(set(results), {'default', 'tuned'})
+        self.assertGreater(results['tuned']['writes'], 0)
+        self.assertGreater(results['tuned']['reads'], 0)
+        self.assertEqual(Message.objects.count(), 0)
+
+    @override_settings(CHAT_DB_WRITER=False)
+    def test_disabled(self):
+        # Without the writer, writes run like other sync code
+        name = async_to_sync(db_writer.run)(lambda: threading.current_thread().name)
+        self.assertFalse(name.startswith('db-writer'))
+
+
+class AttachmentTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(CHAT_ATTACHMENTS_DIR=self.directory.name, CHAT_ATTACHMENT_CHUNK_SIZE=4)
+        self.settings_override.enable()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.group = Group.objects.create(name='Group 1', admin=self.user, slug=slugify('Group 1'))
+        self.group.members.add(self.user)
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.directory.cleanup()
+
+    def start(self, content, name='notes.txt'):
+        response = self.client.post(reverse('start-attachment-upload', args=[self.group.slug]), {
+            'name': name, 'size': len(content), 'content_type': 'text/plain',
+        })
+        self.assertEqual(response.status_code, 200)
+        return response.json()['upload_id']
+
+    def send_chunk(self, upload_id, offset, chunk):
+        url = reverse('attachment-upload', args=[upload_id]) + '?offset=%d' % offset
+        return self.client.post(url, chunk, content_type='application/octet-stream')
+
+    def upload(self, content, name='notes.txt'):
+        upload_id = self.start(content, name)
+        for offset in range(0, len(content), 4):
+            self.assertEqual(self.send_chunk(upload_id, offset, content[offset:offset + 4]).status_code, 200)
+        response = self.client.post(reverse('complete-attachment-upload', args=[upload_id]))
+        self.assertEqual(response.status_code, 200)
+        return Attachment.objects.get(id=response.json()['id'])
+
+    def test_identical_files_are_stored_once(self):
+        # Both uploads get an attachment, but share one file named by its hash
+        first = self.upload(b'hello world')
+        second = self.upload(b'hello world', name='copy.txt')
+
+        self.assertEqual(first.sha256, second.sha256)
+        self.assertNotEqual(first.id, second.id)
+        with open(object_path(first.sha256), 'rb') as f:
+            self.assertEqual(f.read(), b'hello world')
+        self.assertEqual(os.listdir(os.path.join(self.directory.name, 'uploads')), [])
+
+    def test_resume_after_a_chunk_at_the_wrong_offset(self):
+        # A chunk must start where the previous one ended, the response says where that is
+        upload_id = self.start(b'hello world')
+        self.send_chunk(upload_id, 0, b'hell')
+
+        response = self.send_chunk(upload_id, 8, b'rld')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['offset'], 4)
+        self.assertEqual(self.client.get(reverse('attachment-upload', args=[upload_id])).json(), {'offset': 4})
+
+        # Completing early is refused too
+        response = self.client.post(reverse('complete-attachment-upload', args=[upload_id]))
+        self.assertEqual(response.status_code, 400)
+
+    def test_download(self):
+        # Files are served with their hash as ETag and cached for good
+        attachment = self.upload(b'hello world')
+        url = reverse('attachment', args=[attachment.id])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'hello world')
+        self.assertEqual(response['ETag'], '"%s"' % attachment.sha256)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('attachment; filename="notes.txt"', response['Content-Disposition'])
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_download_range(self):
+        # A single byte range is served as partial content
+        attachment = self.upload(b'hello world')
+        url = reverse('attachment', args=[attachment.id])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=6-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'world')
+        self.assertEqual(response['Content-Range'], 'bytes 6-10/11')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */11')
+
+    def test_deleted_message_revokes_attachment(self):
+        # Deleting its message deletes the attachment, and its file once no other attachment shares it
+        shared = self.upload(b'hello world')
+        attachment = self.upload(b'hello world', name='copy.txt')
+        message = Message.objects.create(group=self.group, user=self.user, content='', attachment=attachment)
+        with self.captureOnCommitCallbacks(execute=True):
+            delete_message(message.id, self.group.slug, self.user.id, 'testuser')
+        self.assertFalse(Attachment.objects.filter(id=attachment.id).exists())
+        self.assertEqual(self.client.get(reverse('attachment', args=[attachment.id])).status_code, 404)
+        self.assertTrue(os.path.exists(object_path(shared.sha256)))
+
+        message = Message.objects.create(group=self.group, user=self.user, content='', attachment=shared)
+        with self.captureOnCommitCallbacks(execute=True):
+            delete_message(message.id, self.group.slug, self.user.id, 'testuser')
+        self.assertFalse(Attachment.objects.exists())
+        self.assertFalse(os.path.exists(object_path(shared.sha256)))
+
+    def test_upload_racing_a_delete(self):
+        # An upload completing while a delete removes the same content keeps the file
+        attachment = self.upload(b'hello world')
+        message = Message.objects.create(group=self.group, user=self.user, content='', attachment=attachment)
+        with self.captureOnCommitCallbacks() as callbacks:
+            delete_message(message.id, self.group.slug, self.user.id, 'testuser')
+        again = self.upload(b'hello world', name='again.txt')
+        for callback in callbacks:
+            callback()
+
+        self.assertEqual(os.listdir(os.path.dirname(object_path(again.sha256))), [again.sha256])
+        response = self.client.get(reverse('attachment', args=[again.id]))
+        self.assertEqual(b''.join(response.streaming_content), b'hello world')
+
+    def asgi_get(self, path, headers=()):
+        """
+        Run a GET request through the ASGI handler and return the status, the
+        sizes of the body messages sent and the peak of traced memory.
+        """
+        cookie = '%s=%s' % (settings.SESSION_COOKIE_NAME, self.client.cookies[settings.SESSION_COOKIE_NAME].value)
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+            'headers': [(b'cookie', cookie.encode())] + list(headers),
+            'client': ('127.0.0.1', 1234), 'server': ('testserver', 80),
+        }
+        sent = {'status': None, 'bodies': []}
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                sent['status'] = message['status']
+            else:
+                sent['bodies'].append(len(message.get('body', b'')))
+
+        # As the test client does, keep the test's connection open across the request
+        request_started.disconnect(close_old_connections)
+        tracemalloc.start()
+        try:
+            async_to_sync(ASGIHandler())(scope, receive, send)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            request_started.connect(close_old_connections)
+        return sent['status'], sent['bodies'], peak
+
+    def test_asgi_download_streams(self):
+        # Over ASGI a large file is sent one block at a time, never read into memory whole
+        size = 8 * 1024 * 1024
+        attachment = Attachment.objects.create(
+            sha256='1' * 64, size=size, name='big.bin', content_type='application/octet-stream', group=self.group, user=self.user,
+        )
+        os.makedirs(os.path.dirname(object_path(attachment.sha256)))
+        with open(object_path(attachment.sha256), 'wb') as f:
+            f.write(os.urandom(size))
+        path = reverse('attachment', args=[attachment.id])
+
+        for headers, status_code, length in (((), 200, size), (((b'range', b'bytes=1024-'),), 206, size - 1024)):
+            status_code_sent, bodies, peak = self.asgi_get(path, headers)
+            self.assertEqual(status_code_sent, status_code)
+            self.assertEqual(sum(bodies), length)
+            self.assertLessEqual(max(bodies), BLOCK_SIZE)
+            self.assertLess(peak, 16 * BLOCK_SIZE)
+
+    def test_parse_range(self):
+        # First and last bytes, suffixes, and ranges the whole file is sent for
+        self.assertEqual(parse_range('bytes=0-3', 10), (0, 3))
+        self.assertEqual(parse_range('bytes=5-100', 10), (5, 9))
+        self.assertEqual(parse_range('bytes=-3', 10), (7, 9))
+        self.assertIsNone(parse_range('bytes=0-1,4-5', 10))
+        self.assertIsNone(parse_range('items=0-1', 10))
+        self.assertIsNone(parse_range(None, 10))
+        with self.assertRaises(ValueError):
+            parse_range('bytes=10-', 10)
+
+    def test_non_members(self):
+        # Only members can upload to a group and download its files
+        attachment = self.upload(b'hello world')
+        other = User.objects.create_user(username='other', password='testpassword')
+        self.client.force_login(other)
+
+        response = self.client.post(reverse('start-attachment-upload', args=[self.group.slug]), {'name': 'a', 'size': 1})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.get(reverse('attachment', args=[attachment.id])).status_code, 404)
+
+    def test_message_with_attachment(self):
+        # A message refers to an attachment its author uploaded to the same group
+        attachment = self.upload(b'hello world')
+        self.assertIsNone(find_attachment(attachment.id, self.group.slug, 'other'))
+        self.assertEqual(find_attachment(attachment.id, self.group.slug, 'testuser'), attachment)
+
+        message_id, _ = store_message('testuser', self.group.slug, 'See this', timezone.now(), attachment=attachment)
+        self.assertEqual(Message.objects.get(id=message_id).attachment, attachment)
+        response = self.client.get(reverse('group', args=[self.group.slug]))
+        self.assertContains(response, attachment.get_absolute_url())
+
+
+class AdmissionTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.application = URLRouter(websocket_urlpatterns)
+
+    def tearDown(self):
+        admission._draining = False
+
+    async def open(self, path='/ws/room/'):
+        communicator = WebsocketCommunicator(self.application, path)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def assert_closed(self, communicator, code, action):
+        # Rejected sockets are told why, then closed with the given code
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['action'], action)
+        output = await communicator.receive_output()
+        self.assertEqual(output, {'type': 'websocket.close', 'code': code})
+        return frame
+
+    @override_settings(CHAT_MAX_CONNECTIONS=1)
+    def test_worker_limit(self):
+        # A full worker asks the client to come back later
+        async def connect():
+            first = await self.open()
+            second = await self.open()
+            frame = await self.assert_closed(second, admission.CLOSE_OVERLOADED, 'reconnect')
+            self.assertGreaterEqual(frame['retry_after'], 1)
+            await first.disconnect()
+
+            # Leaving frees the slot
+            third = await self.open()
+            self.assertTrue(await third.receive_nothing())
+            await third.disconnect()
+
+        async_to_sync(connect)()
+        self.assertEqual(admission.connection_count(), 0)
+
+    @override_settings(CHAT_MAX_ROOM_CONNECTIONS=1)
+    def test_room_limit(self):
+        # A full room rejects further sockets, other rooms are unaffected
+        async def connect():
+            first = await self.open()
+            second = await self.open()
+            await self.assert_closed(second, admission.CLOSE_ROOM_FULL, 'rejected')
+            other = await self.open('/ws/other/')
+            self.assertTrue(await other.receive_nothing())
+            for communicator in (first, other):
+                await communicator.disconnect()
+
+        async_to_sync(connect)()
+        self.assertEqual(fanout.room_size('room'), 0)
+
+    @override_settings(CHAT_DRAIN_RECONNECT_SPREAD=5)
+    def test_drain(self):
+        # Draining sends every client away with a spread-out reconnect delay and admits nobody new
+        async def drain():
+            communicators = [await self.open() for _ in range(3)]
+            task = asyncio.ensure_future(admission.drain(timeout=5, exit=False))
+            for communicator in communicators:
+                frame = await self.assert_closed(communicator, admission.CLOSE_RESTARTING, 'reconnect')
+                self.assertTrue(1 <= frame['retry_after'] <= 5)
+
+            late = await self.open()
+            await self.assert_closed(late, admission.CLOSE_RESTARTING, 'reconnect')
+
+            for communicator in communicators:
+                await communicator.disconnect()
+            await asyncio.wait_for(task, 5)
+
+        async_to_sync(drain)()
+        self.assertEqual(admission.connection_count(), 0)
+
+
+# Rows created by a TestCase are only visible to its own connection, not the writer's
+@override_settings(CHAT_DB_WRITER=False)
+class MultiplexTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        recent_client_ids.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.groups = [Group.objects.create(name=name, admin=self.user, slug=slugify(name)) for name in ('Room A', 'Room B', 'Room C')]
+        self.groups[0].members.add(self.user)
+        self.groups[1].members.add(self.user)
+        self.application = ConnectTokenAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+
+    async def open(self, path):
+        communicator = WebsocketCommunicator(self.application, path)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def test_subscriptions(self):
+        # One socket follows several rooms, each frame says which room it is about
+        async def chat():
+            token = make_connect_token(self.user, 'room-a')
+            socket = await self.open('/ws/?token=' + token)
+            for slug in ('room-a', 'room-b', 'room-c'):
+                await socket.send_json_to({'action': 'subscribe', 'group': slug})
+            self.assertEqual(await socket.receive_json_from(), {'action': 'subscribed', 'group': 'room-a'})
+            self.assertEqual(await socket.receive_json_from(), {'action': 'subscribed', 'group': 'room-b'})
+            # Room C is not one of the user's groups
+            self.assertEqual(
+                await socket.receive_json_from(),
+                {'action': 'error', 'group': 'room-c', 'reason': 'not_member'},
+            )
+
+            # Messages sent over the multiplexed socket reach the room's single-room sockets and vice versa
+            room_b = await self.open('/ws/room-b/?token=' + make_connect_token(self.user, 'room-b'))
+            await socket.send_json_to({'action': 'message', 'group': 'room-b', 'message': 'Hello B', 'client_id': 'b1'})
+            frames = {frame['action']: frame for frame in [await socket.receive_json_from() for _ in range(2)]}
+            self.assertEqual((frames['message']['group'], frames['message']['message']), ('room-b', 'Hello B'))
+            self.assertEqual((frames['ack']['group'], frames['ack']['client_id']), ('room-b', 'b1'))
+            self.assertEqual((await room_b.receive_json_from())['message'], 'Hello B')
+
+            await room_b.send_json_to({'message': 'Hi', 'username': 'testuser', 'group': 'room-b'})
+            received = await socket.receive_json_from()
+            self.assertEqual((received['group'], received['message']), ('room-b', 'Hi'))
+            await room_b.receive_json_from()
+
+            # After unsubscribing, the room's messages no longer arrive
+            await socket.send_json_to({'action': 'unsubscribe', 'group': 'room-b'})
+            self.assertEqual(await socket.receive_json_from(), {'action': 'unsubscribed', 'group': 'room-b'})
+            await room_b.send_json_to({'message': 'Bye', 'username': 'testuser', 'group': 'room-b'})
+            await room_b.receive_json_from()
+            self.assertTrue(await socket.receive_nothing())
+
+            # Frames for rooms that are not subscribed are refused
+            await socket.send_json_to({'action': 'message', 'group': 'room-b', 'message': 'Again'})
+            self.assertEqual(
+                await socket.receive_json_from(),
+                {'action': 'error', 'group': 'room-b', 'reason': 'not_subscribed'},
+            )
+
+            for communicator in (socket, room_b):
+                await communicator.disconnect()
+
+        async_to_sync(chat)()
+        self.assertEqual(fanout.room_size('room-a'), 0)
+        self.assertEqual(Message.objects.filter(group=self.groups[1]).count(), 3)
+
+    def test_anonymous_users_are_refused(self):
+        # Without a session or connect token the socket is closed right away
+        async def connect():
+            communicator = WebsocketCommunicator(self.application, '/ws/')
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+
+        async_to_sync(connect)()
+
+
+# Rows created by a TestCase are only visible to its own connection, not the writer's
+@override_settings(CHAT_DB_WRITER=False)
+class MessagePatchTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.other = User.objects.create_user(username='other', password='testpassword')
+        self.group = Group.objects.create(name='Group 1', admin=self.user, slug=slugify('Group 1'))
+        self.group.members.add(self.user, self.other)
+        self.message = Message.objects.create(group=self.group, user=self.other, content='Hello')
+        self.application = ConnectTokenAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+
+    def test_edit(self):
+        # Only the author edits a message, each edit bumps its version
+        self.assertIsNone(edit_message(self.message.id, self.group.slug, self.user.id, 'Hijacked'))
+        self.assertIsNone(edit_message(self.message.id, 'other-group', self.other.id, 'Elsewhere'))
+        patch = edit_message(self.message.id, self.group.slug, self.other.id, 'Hello again')
+        self.assertEqual(
+            {key: patch[key] for key in ('type', 'action', 'group', 'message_id', 'version', 'message')},
+            {'type': 'message_patch', 'action': 'edit', 'group': 'group-1', 'message_id': self.message.id, 'version': 2, 'message': 'Hello again'},
+        )
+        self.message.refresh_from_db()
+        self.assertEqual((self.message.content, self.message.version), ('Hello again', 2))
+        self.assertIsNotNone(self.message.edited)
+
+    def test_delete(self):
+        # The group's admin may delete any message, which leaves a tombstone
+        Mention.objects.create(user=self.user, message=self.message, group=self.group)
+        MessageLike.objects.create(user=self.user, message=self.message)
+        patch = delete_message(self.message.id, self.group.slug, self.user.id, 'testuser')
+        self.assertEqual((patch['action'], patch['version'], patch['message']), ('delete', 2, ''))
+        self.message.refresh_from_db()
+        self.assertTrue(self.message.deleted)
+        self.assertEqual(self.message.content, '')
+        self.assertFalse(Mention.objects.filter(message=self.message).exists())
+
+        # A tombstone can no longer be edited, deleted again or liked
+        self.assertIsNone(edit_message(self.message.id, self.group.slug, self.other.id, 'Back'))
+        self.assertIsNone(delete_message(self.message.id, self.group.slug, self.other.id, 'other'))
+        self.assertIsNone(like_message(self.message.id, self.other.id))
+
+        # Other members cannot delete messages of someone else
+        message = Message.objects.create(group=self.group, user=self.user, content='Mine')
+        self.assertIsNone(delete_message(message.id, self.group.slug, self.other.id, 'other'))
+
+    def test_edit_reindexes_mentions(self):
+        # An edit drops the mentions it removed and notifies only newly mentioned users
+        alice = User.objects.create_user(username='alice', password='testpassword')
+        self.group.members.add(alice)
+        item = (self.message.id, self.group.id, self.group.slug, 'other', 'Hello @testuser')
+        process_batch([item])
+
+        async def listen(content):
+            layer = get_channel_layer()
+            channels = {}
+            for user in (self.user, alice):
+                channels[user.username] = await layer.new_channel()
+                await layer.group_add(user_group_name(user.id), channels[user.username])
+            await sync_to_async(process_batch, thread_sensitive=True)([item[:4] + (content,)], edited={self.message.id})
+            notified = [username for username, channel in channels.items() if not await self.is_empty(layer, channel)]
+            for user in (self.user, alice):
+                await layer.group_discard(user_group_name(user.id), channels[user.username])
+            return notified
+
+        self.assertEqual(async_to_sync(listen)('Hello @testuser and @alice'), ['alice'])
+        self.assertEqual(set(Mention.objects.values_list('user__username', flat=True)), {'testuser', 'alice'})
+        self.assertEqual(async_to_sync(listen)('Hello everyone'), [])
+        self.assertFalse(Mention.objects.exists())
+
+    @staticmethod
+    async def is_empty(layer, channel):
+        try:
+            await asyncio.wait_for(layer.receive(channel), 0.1)
+        except asyncio.TimeoutError:
+            return True
+        return False
+
+    def test_history_shows_patches(self):
+        # The group page and delta sync reflect edits and tombstones
+        edit_message(self.message.id, self.group.slug, self.other.id, 'Edited text')
+        deleted = Message.objects.create(group=self.group, user=self.other, content='Secret')
+        delete_message(deleted.id, self.group.slug, self.other.id, 'other')
+        self.client.force_login(self.user)
+
+        response = self.client.get(reverse('group', args=[self.group.slug]))
+        self.assertContains(response, 'Edited text')
+        self.assertContains(response, '(edited)')
+        self.assertContains(response, 'This message was deleted.')
+        self.assertNotContains(response, 'Secret')
+
+        data = json.loads(self.client.get(reverse('group-messages', args=[self.group.slug])).content)
+        rows = [dict(zip(data['fields'], row)) for row in data['messages']]
+        self.assertEqual([(row['content'], row['version'], row['deleted']) for row in rows], [('Edited text', 2, False), ('', 2, True)])
+
+    def test_patch_broadcast(self):
+        # Edits and deletes reach every socket of the room, the multiplexed ones included
+        async def chat():
+            author = WebsocketCommunicator(self.application, '/ws/group-1/?token=' + make_connect_token(self.other, 'group-1'))
+            self.assertTrue((await author.connect())[0])
+            multiplexed = WebsocketCommunicator(self.application, '/ws/?token=' + make_connect_token(self.user, 'group-1'))
+            self.assertTrue((await multiplexed.connect())[0])
+            await multiplexed.send_json_to({'action': 'subscribe', 'group': 'group-1'})
+            await multiplexed.receive_json_from()
+
+            await author.send_json_to({'action': 'edit', 'message_id': self.message.id, 'message': 'Edited'})
+            for communicator in (author, multiplexed):
+                frame = await communicator.receive_json_from()
+                self.assertEqual(
+                    (frame['action'], frame['group'], frame['message_id'], frame['version'], frame['message']),
+                    ('edit', 'group-1', self.message.id, 2, 'Edited'),
+                )
+
+            # Someone else's edit is ignored, nothing is broadcast
+            await multiplexed.send_json_to({'action': 'edit', 'group': 'group-1', 'message_id': self.message.id, 'message': 'Mine'})
+            self.assertTrue(await author.receive_nothing())
+
+            # The admin deletes it from the multiplexed socket
+            await multiplexed.send_json_to({'action': 'delete', 'group': 'group-1', 'message_id': self.message.id})
+            for communicator in (author, multiplexed):
+                frame = await communicator.receive_json_from()
+                self.assertEqual((frame['action'], frame['version'], frame['message']), ('delete', 3, ''))
+
+            for communicator in (author, multiplexed):
+                await communicator.disconnect()
+
+        async_to_sync(chat)()
+        self.message.refresh_from_db()
+        self.assertTrue(self.message.deleted)
+
+
+class ActivityTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.other = User.objects.create_user(username='other', password='testpassword')
+        self.group = Group.objects.create(name='Group 1', admin=self.user, slug=slugify('Group 1'))
+        self.quiet = Group.objects.create(name='Group 2', admin=self.user, slug=slugify('Group 2'))
+        self.group.members.add(self.user, self.other)
+        self.quiet.members.add(self.user)
+        self.yesterday = start_of_day(timezone.now()) - timedelta(days=1)
+
+    def post(self, group, user, hour, likes=0):
+        message = Message.objects.create(group=group, user=user, content='Hello')
+        Message.objects.filter(id=message.id).update(timestamp=self.yesterday + timedelta(hours=hour))
+        for liker in [self.user, self.other][:likes]:
+            like = MessageLike.objects.create(message=message, user=liker)
+            MessageLike.objects.filter(id=like.id).update(timestamp=self.yesterday + timedelta(hours=hour))
+        return message
+
+    def activity(self, group, period):
+        return list(
+            GroupActivity.objects.filter(group=group, period=period)
+            .order_by('start')
+            .values_list('start', 'messages', 'likes', 'active_users')
+        )
+
+    def test_roll_up(self):
+        # Messages, likes and distinct posters are counted per hour and per day
+        self.post(self.group, self.user, 1, likes=2)
+        self.post(self.group, self.user, 1)
+        self.post(self.group, self.other, 3, likes=1)
+        self.post(self.quiet, self.user, 3)
+        roll_up()
+
+        self.assertEqual(self.activity(self.group, GroupActivity.HOUR), [
+            (self.yesterday + timedelta(hours=1), 2, 2, 1),
+            (self.yesterday + timedelta(hours=3), 1, 1, 1),
+        ])
+        self.assertEqual(self.activity(self.group, GroupActivity.DAY), [(self.yesterday, 3, 3, 2)])
+        self.assertEqual(self.activity(self.quiet, GroupActivity.DAY), [(self.yesterday, 1, 0, 1)])
+
+    def test_roll_up_is_incremental(self):
+        # A later run recounts the last day instead of adding to it
+        self.post(self.group, self.user, 1)
+        roll_up()
+        self.post(self.group, self.other, 5)
+        roll_up()
+
+        self.assertEqual(self.activity(self.group, GroupActivity.DAY), [(self.yesterday, 2, 0, 2)])
+        self.assertEqual(len(self.activity(self.group, GroupActivity.HOUR)), 2)
+
+    def test_backfill_command(self):
+        # The command rolls up the whole history in windows of CHAT_ACTIVITY_BATCH_DAYS days
+        message = self.post(self.group, self.user, 1)
+        Message.objects.filter(id=message.id).update(timestamp=self.yesterday - timedelta(days=30))
+        self.post(self.group, self.user, 1)
+        with self.settings(CHAT_ACTIVITY_BATCH_DAYS=2):
+            call_command('rollup_activity', '--backfill', stdout=io.StringIO())
+        self.assertEqual(len(self.activity(self.group, GroupActivity.DAY)), 2)
+
+    def test_group_activity_view(self):
+        # Members read the rollups, the messages table is never touched
+        self.post(self.group, self.user, 1, likes=1)
+        roll_up()
+        self.client.force_login(self.other)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('group-activity', args=[self.group.slug]), {'period': 'hour'})
+        self.assertFalse([query for query in queries if 'group_message"' in query['sql']])
+        self.assertEqual(response.json()['buckets'], [[(self.yesterday + timedelta(hours=1)).isoformat(), 1, 1, 1]])
+
+        response = self.client.get(reverse('group-activity', args=[self.quiet.slug]))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse('group-activity', args=[self.group.slug]), {'period': 'week'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_top_groups_view(self):
+        # Staff see the groups ranked by messages or likes
+        self.post(self.group, self.user, 1)
+        self.post(self.group, self.user, 2)
+        self.post(self.quiet, self.user, 1, likes=2)
+        roll_up()
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('top_groups')).status_code, 403)
+
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        response = self.client.get(reverse('top_groups'))
+        self.assertEqual([group['slug'] for group in response.json()['groups']], ['group-1', 'group-2'])
+        response = self.client.get(reverse('top_groups'), {'order': 'likes', 'limit': 1})
+        self.assertEqual(response.json()['groups'], [
+            {'slug': 'group-2', 'name': 'Group 2', 'messages': 1, 'likes': 2, 'peak_active_users': 1},
+        ])
+
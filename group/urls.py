@@ -1,20 +1,46 @@
+from importlib import import_module
+
 from django.contrib.auth import views as auth_views
 from django.urls import path
+from django.views.decorators.csrf import csrf_exempt
 
 from . import views
 
+
+def lazy_api_view(name):
+    """
+    Route to a view of `group.api`, importing it (and Django REST framework)
+    only when the route is first requested.
+    """
+    @csrf_exempt
+    def view(request, *args, **kwargs):
+        return getattr(import_module('group.api'), name)(request, *args, **kwargs)
+    return view
+
+
 urlpatterns = [
     path('', views.home, name='home'),
-    path('api/create-user/', views.create_user, name='create_user'),
-    path('api/edit-user/<str:username>/', views.edit_user, name='edit_user'),
+    path('api/create-user/', lazy_api_view('create_user'), name='create_user'),
+    path('api/create-users/', lazy_api_view('create_users'), name='create_users'),
+    path('api/edit-user/<str:username>/', lazy_api_view('edit_user'), name='edit_user'),
+    path('api/session-cache-stats/', views.session_cache_stats, name='session_cache_stats'),
+    path('api/activity/top/', views.top_groups, name='top_groups'),
     path('signup/', views.signup, name='signup'),
     path('login/', auth_views.LoginView.as_view(template_name='login.html'), name='login'),
     path('logout/', auth_views.LogoutView.as_view(), name='logout'),
     path('groups/', views.groups, name='groups'),
+    path('mentions/', views.mentions, name='mentions'),
     path('groups/create/', views.create_group, name='create-group'),
     path('groups/search/', views.search_groups, name='search-groups'),
     path('groups/<slug:slug>/', views.group, name='group'),
     path('groups/<slug:slug>/delete/', views.delete_group, name='delete-group'),
     path('groups/<slug:slug>/group-users/', views.group_users, name='group-users'),
+    path('groups/<slug:slug>/messages/', views.group_messages, name='group-messages'),
+    path('groups/<slug:slug>/activity/', views.group_activity, name='group-activity'),
     path('groups/<slug:slug>/add-members/', views.add_members, name='add-members'),
+    path('groups/<slug:slug>/add-members/bulk/', views.add_members_bulk, name='add-members-bulk'),
+    path('groups/<slug:slug>/attachments/', views.start_attachment_upload, name='start-attachment-upload'),
+    path('attachments/uploads/<str:upload_id>/', views.attachment_upload, name='attachment-upload'),
+    path('attachments/uploads/<str:upload_id>/complete/', views.complete_attachment_upload, name='complete-attachment-upload'),
+    path('attachments/<int:attachment_id>/', views.attachment, name='attachment'),
 ]
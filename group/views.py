@@ -1,126 +1,31 @@
+import hashlib
 import json
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, redirect, get_object_or_404
 from .forms import GroupForm
 from django.contrib import messages
-from .models import Group, Message
-from django.http import JsonResponse
+from .models import Attachment, Group, GroupActivity, Message, Mention
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
+from django.views.decorators.http import require_POST
 from django.contrib.auth.models import User
 from django.contrib.auth import login
-from .forms import SignUpForm
-from rest_framework import status
-from rest_framework.decorators import api_view
-from rest_framework.response import Response
+from .forms import SignUpForm, BulkMembersForm
+from .members import add_members_in_bulk
+from . import attachments, sessions
+from .auth import make_connect_token
+from django.db.models import Max, Sum
+from django.utils import timezone
+from .activity import ACTIVITY_FIELDS, TRUNCATE, start_of_day
+from .history import MESSAGE_FIELDS, RoomListener, changes_after, messages_after
+from .replicas import primary
 
 
-@api_view(['POST'])
-def create_user(request):
-    """
-    API endpoint to create a new user.
-
-    This view allows users to register by providing a unique username and password in the request data.
-    If the provided username or password is missing, it will return a 400 Bad Request error.
-    If the username is already taken, it will return a 400 Bad Request error.
-    If the username is available and the password is provided, it will create a new user with the given
-    username and password, and return a 201 Created response with a success message.
-
-    Parameters:
-        request (HttpRequest): The HTTP request object containing the user's data.
-
-    Returns:
-        Response: JSON response with a success message if the user is created successfully,
-                  or an error message if the username is already taken or validation fails.
-
-    """
-    if request.method == 'POST':
-        username = request.data.get('username')
-        password = request.data.get('password')
-        # Perform basic validation
-        if not username or not password:
-            return Response({'error': 'Both username and password are required.'}, status=status.HTTP_400_BAD_REQUEST)
-        try:
-            # Check if the username already exists
-            user = User.objects.get(username=username)
-            return Response({'error': 'Username already exists.'}, status=status.HTTP_400_BAD_REQUEST)
-        except User.DoesNotExist:
-            # Create a new user
-            user = User.objects.create_user(username=username, password=password)
-            return Response({'message': 'User created successfully.'}, status=status.HTTP_201_CREATED)
-
-
-@api_view(['PUT', 'PATCH'])
-def edit_user(request, username):
-    """
-    Edit user details using PUT or PATCH method.
-
-    Retrieves the user with the given username from the database. If the user exists,
-    the view checks the request method. If the method is PUT, the view updates the user's
-    details (username and password) using the provided data. If the method is PATCH, the view
-    updates the user's details based on the provided data (either username or password).
-
-    For PUT method:
-    - New username and password are required.
-    - The new username must be unique (not taken by other users).
-    - The user's details are updated in the database.
-
-    For PATCH method:
-    - Either username or password can be updated.
-    - The new username must be unique (not taken by other users).
-    - The user's details are updated in the database.
-
-    If the user does not exist, a 404 Not Found response is returned.
-
-    Parameters:
-        request (HttpRequest): The HTTP request object.
-
-        username (str): The username of the user to edit.
-
-    Returns:
-        Response: JSON response with a success message on successful update (PUT/PATCH),
-                  or an error message if the user is not found or validation fails.
-
-    """
-    try:
-        # Check if the user exists
-        user = User.objects.get(username=username)
-    except User.DoesNotExist:
-        return Response({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
-
-    if request.method == 'PUT':
-        # Update user details using PUT data
-        new_username = request.data.get('username')
-        new_password = request.data.get('password')
-
-        # Perform basic validation
-        if not new_username or not new_password:
-            return Response({'error': 'Both username and password are required.'}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Check if the new username is already taken
-        if new_username != username and User.objects.filter(username=new_username).exists():
-            return Response({'error': 'Username already exists.'}, status=status.HTTP_400_BAD_REQUEST)
-
-        user.username = new_username
-        user.set_password(new_password)
-        user.save()
-        return Response({'message': 'User updated successfully.'}, status=status.HTTP_200_OK)
-
-    elif request.method == 'PATCH':
-        # Update user details using PATCH data
-        new_username = request.data.get('username')
-        new_password = request.data.get('password')
-
-        # Check if the new username is already taken
-        if new_username and new_username != username and User.objects.filter(username=new_username).exists():
-            return Response({'error': 'Username already exists.'}, status=status.HTTP_400_BAD_REQUEST)
-
-        if new_username:
-            user.username = new_username
-        if new_password:
-            user.set_password(new_password)
-
-        user.save()
-        return Response({'message': 'User updated successfully.'}, status=status.HTTP_200_OK)
-
 def home(request):
     """
     Render the home page.
@@ -167,9 +72,12 @@ def group(request, slug):
     """
     Display a group and its associated messages.
 
-    Retrieves the group with the given slug from the database. Then, fetches all
-    messages associated with the group. Finally, renders the 'group.html' template
-    with the retrieved group and messages.
+    Retrieves the group with the given slug from the database. Then, fetches the
+    most recent CHAT_HISTORY_LIMIT messages of the group together with their
+    authors and attachments in a single query, checks whether the logged-in user is a member and
+    signs a short-lived connect token that lets the page open the group's
+    WebSocket without a session lookup. Finally, renders the 'group.html'
+    template with the retrieved group and messages.
 
     Parameters:
         request (HttpRequest): The HTTP request object.
@@ -183,9 +91,17 @@ def group(request, slug):
         Http404: If the group with the given slug does not exist.
     """
     group = Group.objects.get(slug=slug)
-    messages = Message.objects.filter(group=group)
+    recent = Message.objects.filter(group=group).select_related('user', 'attachment').order_by('-id')[:settings.CHAT_HISTORY_LIMIT]
+    messages = list(reversed(recent))
+    is_member = group.members.filter(id=request.user.id).exists()
+    connect_token = make_connect_token(request.user, group.slug)
 
-    return render(request, 'group.html', {'group': group, 'messages': messages})
+    return render(request, 'group.html', {
+        'group': group,
+        'messages': messages,
+        'is_member': is_member,
+        'connect_token': connect_token,
+    })
 
 
 @login_required
@@ -287,7 +203,7 @@ def add_members(request, slug):
     Handle adding members to a group.
 
     Retrieves the group with the given slug from the database. If the group exists,
-    the view fetches all users from the database. If the request method is POST,
+    the view fetches all users who are not yet members of the group. If the request method is POST,
     the view tries to add a member to the group based on the provided member's username.
     If the username corresponds to an existing user, they are added to the group's members.
     If the username does not match any user, the view does nothing. Then, redirect to
@@ -308,7 +224,7 @@ def add_members(request, slug):
         group = get_object_or_404(Group, slug=slug)
     except:
         return redirect('groups')
-    all_users = User.objects.all()
+    all_users = User.objects.exclude(group=group)
     if request.method == 'POST':
         member_username = request.POST.get('member_username')
         try:
@@ -319,6 +235,45 @@ def add_members(request, slug):
         return redirect('group', slug=slug)
     return render(request, 'add_members.html', {'group': group, 'all_users': all_users})
 
+@login_required
+def add_members_bulk(request, slug):
+    """
+    Handle adding many members to a group at once.
+
+    Retrieves the group with the given slug from the database. If the request method
+    is POST, the view reads the usernames from the form's text field and/or uploaded
+    CSV file, resolves them all with batched IN queries and inserts only the missing
+    memberships in a single bulk insert. Then, it renders the 'add_members_bulk.html'
+    template again with the added usernames, the ones that were already members and
+    the ones that were not found.
+
+    If the group does not exist, redirect to the 'groups' page.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object containing the usernames.
+
+        slug (str): The slug of the group to which members will be added.
+
+    Returns:
+        HttpResponse: Rendered 'add_members_bulk.html' template with the form and the
+                      result of the last submission, or redirect to 'groups' page if
+                      the group does not exist.
+    """
+    try:
+        group = get_object_or_404(Group, slug=slug)
+    except:
+        return redirect('groups')
+    result = None
+    if request.method == 'POST':
+        form = BulkMembersForm(request.POST, request.FILES)
+        if form.is_valid():
+            added, already_members, not_found = add_members_in_bulk(group, form.cleaned_data['username_list'])
+            result = {'added': added, 'already_members': already_members, 'not_found': not_found}
+            form = BulkMembersForm()
+    else:
+        form = BulkMembersForm()
+    return render(request, 'add_members_bulk.html', {'group': group, 'form': form, 'result': result})
+
 @login_required
 def group_users(request, slug):
     """
@@ -347,6 +302,94 @@ def group_users(request, slug):
     user_data = [{'username': user.username} for user in users]
     return JsonResponse({'users': user_data})
 
+async def group_messages(request, slug):
+    """
+    Return the messages of a group posted after a given message id.
+
+    Lets clients that cannot keep a WebSocket open stay in sync without reloading the
+    group page. The 'after' GET parameter is the id of the last message the client has
+    (0 for the oldest messages) and 'limit' caps the number of messages returned, up to
+    CHAT_SYNC_LIMIT. Messages are returned as compact rows in the order given by 'fields',
+    with the id of the last message returned and whether more messages are waiting.
+
+    Messages edited or deleted after the client synced them are caught with the
+    'changes_after' GET parameter: the 'last_change' of the previous response (0 to get
+    a baseline first). Those messages are returned in their current state as 'changes',
+    in the order they changed, with the 'last_change' to ask from next time and whether
+    more changes are waiting.
+
+    If 'wait' is given and there is nothing new, the view long-polls: it waits on the
+    channel layer for up to 'wait' seconds (at most CHAT_SYNC_MAX_WAIT) for a message
+    to be posted, edited or deleted in the group, then answers with whatever is new.
+
+    Responses carry an ETag, and a request whose If-None-Match matches it gets a
+    304 Not Modified response.
+
+    Only members of the group may read its messages. If the user is not logged in,
+    redirect to the login page.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object.
+
+        slug (str): The slug of the group to sync.
+
+    Returns:
+        JsonResponse: JSON response with 'fields', 'messages', 'last_id', 'more' and
+                      'last_change', plus 'changes' and 'more_changes' if
+                      'changes_after' was given, or an error with status 400 for
+                      invalid parameters, 403 if the user is not a member of the group or
+                      404 if the group does not exist.
+    """
+    is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+    if not is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    try:
+        after = int(request.GET.get('after', 0))
+        limit = max(1, min(int(request.GET.get('limit', settings.CHAT_SYNC_LIMIT)), settings.CHAT_SYNC_LIMIT))
+        wait = max(0.0, min(float(request.GET.get('wait', 0)), settings.CHAT_SYNC_MAX_WAIT))
+        since = request.GET.get('changes_after')
+        since = None if since is None else max(0, int(since))
+    except ValueError:
+        return JsonResponse({'error': 'after, limit, wait and changes_after must be numbers.'}, status=400)
+
+    group = await sync_to_async(Group.objects.filter(slug=slug).first)()
+    if group is None:
+        return JsonResponse({'error': 'Group not found.'}, status=404)
+    if not await sync_to_async(lambda: group.members.filter(id=request.user.id).exists())():
+        return JsonResponse({'error': 'Only members can read the messages of this group.'}, status=403)
+
+    def sync(group):
+        rows = messages_after(group, after, limit + 1)
+        changes = changes_after(group, after, since, limit) if since is not None else ([], since, False)
+        return rows, changes
+
+    if wait:
+        async with RoomListener(slug) as listener:
+            rows, changes = await sync_to_async(sync)(group)
+            if not rows and not changes[0] and await listener.wait(wait):
+                # The replicas may not have the change we were woken up for yet
+                with primary():
+                    group = await sync_to_async(Group.objects.get)(id=group.id)
+                    rows, changes = await sync_to_async(sync)(group)
+    else:
+        rows, changes = await sync_to_async(sync)(group)
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    last_id = rows[-1][0] if rows else after
+    data = {'fields': MESSAGE_FIELDS, 'messages': rows, 'last_id': last_id, 'more': more, 'last_change': group.changes}
+    if since is not None:
+        data['changes'], data['last_change'], data['more_changes'] = changes
+    body = json.dumps(data, separators=(',', ':'))
+    etag = '"%s"' % hashlib.md5(body.encode()).hexdigest()
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
 @login_required
 def search_groups(request):
     """
@@ -373,3 +416,299 @@ def search_groups(request):
     else:
         groups = Group.objects.none()
     return render(request, 'search_groups.html', {'groups': groups, 'query': query})
+
+@login_required
+def session_cache_stats(request):
+    """
+    Report the hit rate of this process's in-memory session cache.
+
+    Only staff users may see the statistics; other users get a 403 Forbidden response.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        JsonResponse: JSON response with the number of hits and misses, the hit rate
+                      and the number of cached sessions.
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff only.'}, status=403)
+    return JsonResponse(sessions.stats())
+
+@login_required
+def mentions(request):
+    """
+    Display the messages in which the logged-in user was mentioned.
+
+    Shows the newest CHAT_MENTIONS_PAGE_SIZE mentions first. The 'before' GET parameter
+    is the id of the last mention of the previous page, so each page is read with a
+    single query on the (user, id) index, together with the messages, their authors
+    and groups.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: Rendered 'mentions.html' template with a page of mentions and the
+                      id to request the next page with, if there is one.
+    """
+    page_size = settings.CHAT_MENTIONS_PAGE_SIZE
+    inbox = Mention.objects.filter(user=request.user).select_related('message__user', 'group').order_by('-id')
+    try:
+        before = int(request.GET.get('before', 0))
+    except ValueError:
+        before = 0
+    if before:
+        inbox = inbox.filter(id__lt=before)
+    page = list(inbox[:page_size + 1])
+    next_before = page[page_size - 1].id if len(page) > page_size else None
+    return render(request, 'mentions.html', {'mentions': page[:page_size], 'next_before': next_before})
+
+@login_required
+@require_POST
+def start_attachment_upload(request, slug):
+    """
+    Start a chunked upload of a file to be attached to a message of a group.
+
+    The 'name', 'size' and 'content_type' POST parameters describe the file. The
+    returned upload id is signed, so nothing is written to the database until the
+    upload is complete. Only members of the group may upload files to it.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object.
+
+        slug (str): The slug of the group the file will be sent to.
+
+    Returns:
+        JsonResponse: JSON response with the 'upload_id', the 'chunk_size' to upload the
+                      file in and the current 'offset', or an error with status 400 for
+                      an invalid size or 403 if the user is not a member of the group.
+    """
+    group = get_object_or_404(Group, slug=slug)
+    if not group.members.filter(id=request.user.id).exists():
+        return JsonResponse({'error': 'Only members can send files to this group.'}, status=403)
+    try:
+        size = int(request.POST.get('size', ''))
+        upload_id = attachments.start_upload(
+            request.user, group, request.POST.get('name', ''), size, request.POST.get('content_type', ''),
+        )
+    except ValueError:
+        return JsonResponse({'error': 'size must be a number.'}, status=400)
+    except attachments.UploadError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'upload_id': upload_id, 'chunk_size': attachments.chunk_size(), 'offset': 0})
+
+@login_required
+def attachment_upload(request, upload_id):
+    """
+    Receive one chunk of an upload, or report how much of it was received.
+
+    A POST appends its raw body to the upload. The 'offset' GET parameter is the
+    position of the chunk in the file and must be the number of bytes received so
+    far, so a chunk is never written twice. After an error, a GET returns that number
+    and the upload can resume from there.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object with the chunk as its body.
+
+        upload_id (str): The id returned by start_attachment_upload.
+
+    Returns:
+        JsonResponse: JSON response with the 'offset' of the next chunk, or an error
+                      with status 400 for an invalid chunk or 404 for an unknown upload.
+    """
+    claims = attachments.read_upload(upload_id, request.user)
+    if claims is None:
+        return JsonResponse({'error': 'Upload not found.'}, status=404)
+    if request.method != 'POST':
+        return JsonResponse({'offset': attachments.received(claims)})
+    try:
+        offset = int(request.GET.get('offset', ''))
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return JsonResponse({'error': 'offset must be a number.'}, status=400)
+    try:
+        # Copied block by block from the request, never read into memory as a whole
+        received = attachments.append_chunk(claims, offset, length, request)
+    except attachments.UploadError as e:
+        return JsonResponse({'error': str(e), 'offset': attachments.received(claims)}, status=400)
+    return JsonResponse({'offset': received})
+
+@login_required
+@require_POST
+def complete_attachment_upload(request, upload_id):
+    """
+    Finish an upload once all of its chunks were received.
+
+    The file is stored under its content hash, once however many times it is uploaded,
+    and the returned attachment id can be sent along with a chat message.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object.
+
+        upload_id (str): The id returned by start_attachment_upload.
+
+    Returns:
+        JsonResponse: JSON response with the attachment's 'id', 'name', 'size' and 'url',
+                      or an error with status 400 if chunks are missing or 404 for an
+                      unknown upload.
+    """
+    claims = attachments.read_upload(upload_id, request.user)
+    if claims is None:
+        return JsonResponse({'error': 'Upload not found.'}, status=404)
+    try:
+        attachment = attachments.complete_upload(claims)
+    except attachments.UploadError as e:
+        return JsonResponse({'error': str(e), 'offset': attachments.received(claims)}, status=400)
+    return JsonResponse(attachments.describe(attachment))
+
+@login_required
+def attachment(request, attachment_id):
+    """
+    Download a file attached to a group's messages.
+
+    The file is streamed from disk one block at a time, read in a thread when served
+    over ASGI, so a download never holds more than a block in memory. A single byte range can be requested with a Range
+    header, for example to resume a download or seek in a video. Stored files never
+    change, so responses can be cached for a year and revalidated by their ETag, the
+    content hash. Only members of the attachment's group may download it.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object.
+
+        attachment_id (int): The id of the attachment.
+
+    Returns:
+        HttpResponse: The file, part of it with status 206, 304 Not Modified if the
+                      If-None-Match header matches, 416 for a range past the end of
+                      the file or 404 if the attachment does not exist or the user is
+                      not a member of its group.
+    """
+    try:
+        # get() rather than first(), which would sort the joined rows by id
+        attachment = Attachment.objects.get(id=attachment_id, group__members=request.user)
+    except Attachment.DoesNotExist:
+        raise Http404('Attachment not found.')
+
+    etag = '"%s"' % attachment.sha256
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponse(status=304)
+    else:
+        path = attachments.object_path(attachment.sha256)
+        byte_range = None
+        if request.headers.get('If-Range', etag) == etag:
+            try:
+                byte_range = attachments.parse_range(request.headers.get('Range'), attachment.size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % attachment.size
+                return response
+        start, end = byte_range if byte_range is not None else (0, attachment.size - 1)
+        # Django buffers a synchronous iterator in full before sending it over ASGI
+        stream = attachments.aiter_file if isinstance(request, ASGIRequest) else attachments.iter_file
+        response = StreamingHttpResponse(
+            stream(path, start, end - start + 1),
+            status=200 if byte_range is None else 206,
+            content_type=attachment.content_type,
+        )
+        response['Content-Length'] = end - start + 1
+        if byte_range is not None:
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, attachment.size)
+        # Anything but plain images is downloaded rather than rendered by the browser
+        inline = attachment.content_type in attachments.INLINE_TYPES
+        response['Content-Disposition'] = content_disposition_header(not inline, attachment.name)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+@login_required
+def group_activity(request, slug):
+    """
+    Return the rolled up activity of a group as JSON.
+
+    Reads the hourly or daily GroupActivity rows written by the rollup_activity job, never
+    the messages themselves. The 'period' GET parameter is 'hour' or 'day' (the default) and
+    'days' is how many days back to go, up to CHAT_ACTIVITY_MAX_DAYS. Only members of the
+    group and staff users may see its activity.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object.
+
+        slug (str): The slug of the group.
+
+    Returns:
+        JsonResponse: JSON response with the 'period', the 'fields' of each bucket and the
+                      'buckets', oldest first, or an error with status 400 for invalid
+                      parameters, 403 for non-members or 404 if the group does not exist.
+    """
+    period = request.GET.get('period', GroupActivity.DAY)
+    try:
+        days = int(request.GET.get('days', 7))
+    except ValueError:
+        days = 0
+    if period not in TRUNCATE or not 0 < days <= settings.CHAT_ACTIVITY_MAX_DAYS:
+        return JsonResponse({'error': 'period must be hour or day and days between 1 and %d.' % settings.CHAT_ACTIVITY_MAX_DAYS}, status=400)
+    group = get_object_or_404(Group, slug=slug)
+    if not request.user.is_staff and not group.members.filter(id=request.user.id).exists():
+        return JsonResponse({'error': 'Only members can see the activity of this group.'}, status=403)
+
+    since = start_of_day(timezone.now()) - timedelta(days=days - 1)
+    buckets = (
+        GroupActivity.objects.filter(group=group, period=period, start__gte=since)
+        .order_by('start')
+        .values_list(*ACTIVITY_FIELDS)
+    )
+    return JsonResponse({
+        'group': group.slug,
+        'period': period,
+        'fields': ACTIVITY_FIELDS,
+        'buckets': [[start.isoformat()] + list(counts) for start, *counts in buckets],
+    })
+
+@login_required
+def top_groups(request):
+    """
+    Return the busiest groups over the last days as JSON.
+
+    Sums the daily GroupActivity rows of the last 'days' days (7 by default, up to
+    CHAT_ACTIVITY_MAX_DAYS) and returns the 'limit' (at most 100) groups with the most
+    messages, or the most likes with 'order=likes'. Only staff users may see the ranking;
+    other users get a 403 Forbidden response.
+
+    Parameters:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        JsonResponse: JSON response with the 'groups', each with its slug, name, number of
+                      messages and likes and its peak number of active users in a day, or
+                      an error with status 400 for invalid parameters.
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff only.'}, status=403)
+    order = request.GET.get('order', 'messages')
+    try:
+        days = int(request.GET.get('days', 7))
+        limit = max(1, min(int(request.GET.get('limit', 10)), 100))
+    except ValueError:
+        days = 0
+    if order not in ('messages', 'likes') or not 0 < days <= settings.CHAT_ACTIVITY_MAX_DAYS:
+        return JsonResponse({'error': 'order must be messages or likes and days between 1 and %d.' % settings.CHAT_ACTIVITY_MAX_DAYS}, status=400)
+
+    since = start_of_day(timezone.now()) - timedelta(days=days - 1)
+    groups = (
+        GroupActivity.objects.filter(period=GroupActivity.DAY, start__gte=since)
+        .values('group__slug', 'group__name')
+        .annotate(messages=Sum('messages'), likes=Sum('likes'), peak_active_users=Max('active_users'))
+        .order_by('-' + order)[:limit]
+    )
+    return JsonResponse({'days': days, 'groups': [
+        {
+            'slug': row['group__slug'],
+            'name': row['group__name'],
+            'messages': row['messages'],
+            'likes': row['likes'],
+            'peak_active_users': row['peak_active_users'],
+        }
+        for row in groups
+    ]})
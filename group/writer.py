@@ -0,0 +1,72 @@
+"""
+A single thread for chat writes.
+
+SQLite allows one writer at a time. Writes from many threads queue on the
+database lock, and readers wait behind them. Sending every chat write to the
+one thread of `db_writer` queues them in Python instead. The writer keeps a
+single connection, and the sync threads stay free for reads.
+
+With CHAT_DB_WRITER set to False, writes run like any other ORM call.
+"""
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+
+
+class DatabaseWriter:
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def enabled(self):
+        return getattr(settings, 'CHAT_DB_WRITER', True)
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+            return self._executor
+
+    @staticmethod
+    def _call(func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # Unlike a request, the writer keeps its connection between
+            # writes, unless it broke
+            for connection in connections.all(initialized_only=True):
+                if connection.connection is not None and connection.errors_occurred and not connection.is_usable():
+                    connection.close()
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run `func` on the writer thread and return its result.
+        """
+        if not self.enabled():
+            return await sync_to_async(func)(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor(), functools.partial(self._call, func, *args, **kwargs))
+
+    def call(self, func, *args, **kwargs):
+        """
+        Run `func` on the writer thread from synchronous code, blocking until it is done.
+        """
+        if not self.enabled():
+            return func(*args, **kwargs)
+        return self.executor().submit(self._call, func, *args, **kwargs).result()
+
+    async def flush(self):
+        """
+        Wait for the writes queued so far.
+        """
+        if self._executor is not None:
+            await self.run(lambda: None)
+
+
+db_writer = DatabaseWriter()
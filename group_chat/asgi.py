@@ -10,16 +10,20 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
-from channels.auth import AuthMiddlewareStack
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'group_chat.settings')
+
+# Set up Django before importing anything that touches models
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
 
 import group.routing
-
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'group_chat.settings')
+from group.auth import ConnectTokenAuthMiddlewareStack
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "http": django_asgi_app,
+    "websocket": ConnectTokenAuthMiddlewareStack(
         URLRouter(
             group.routing.websocket_urlpatterns
         )
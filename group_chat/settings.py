@@ -10,8 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
-from telnetlib import LOGOUT
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -35,6 +35,11 @@ LOGIN_URL = '/groups/'
 
 # Application definition
 
+# Lean startup for workers run by an external ASGI server (daphne, uvicorn):
+# skips the 'channels' app, which only provides runserver and imports Twisted,
+# and the 'rest_framework' app, which is then imported on the first /api/ request.
+LEAN_STARTUP = os.environ.get('GROUP_CHAT_LEAN_STARTUP') == '1'
+
 INSTALLED_APPS = [
     'django.contrib.admin',
     'django.contrib.auth',
@@ -47,9 +52,19 @@ INSTALLED_APPS = [
     'rest_framework'
 ]
 
+if LEAN_STARTUP:
+    INSTALLED_APPS.remove('channels')
+    INSTALLED_APPS.remove('rest_framework')
+    # The browsable API needs the rest_framework app's templates
+    REST_FRAMEWORK = {
+        'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer'],
+    }
+
 MIDDLEWARE = [
+    'group.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'group.replicas.ReplicaRoutingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -75,9 +90,15 @@ TEMPLATES = [
     },
 ]
 
+# Sessions are stored in the database and read through an in-process LRU
+# With several workers, logouts reach the others through a shared default cache (see group.checks)
+SESSION_ENGINE = 'group.sessions'
+
 WSGI_APPLICATION = 'group_chat.wsgi.application'
 ASGI_APPLICATION = 'group_chat.asgi.application'
 
+# A channel layer shared by several processes needs a shared CACHES backend as
+# well, for room shard counts, room limits and replica pins (see group.checks)
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels.layers.InMemoryChannelLayer'
@@ -94,6 +115,17 @@ DATABASES = {
     }
 }
 
+# With GROUP_CHAT_REPLICA=1 reads are served from a copy of the database that
+# `python manage.py sync_replica --interval 5` keeps up to date
+if os.environ.get('GROUP_CHAT_REPLICA') == '1':
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.replica.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['group.replicas.PrimaryReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -135,3 +167,97 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Chat
+
+# Number of most recent messages rendered on a group's page
+CHAT_HISTORY_LIMIT = 100
+
+# Number of messages whose likers are kept in memory, and for how many seconds
+CHAT_LIKE_INDEX_SIZE = 10000
+CHAT_LIKE_INDEX_TTL = 300
+
+# Recently delivered client message ids remembered per room, and how many rooms
+CHAT_DELIVERY_IDS_PER_ROOM = 1000
+CHAT_DELIVERY_ROOMS = 10000
+
+# Sockets per channel-layer group before a room is split into shards
+CHAT_FANOUT_SHARD_SIZE = 1000
+CHAT_FANOUT_MAX_SHARDS = 64
+# Seconds a rebalanced socket stays in its old shard
+CHAT_FANOUT_REBALANCE_GRACE = 5
+
+# Lifetime in seconds of the signed tokens used to open a group's WebSocket
+CHAT_CONNECT_TOKEN_MAX_AGE = 300
+
+# Profile one in N requests and WebSocket frames (0 turns profiling off), and
+# write the aggregated folded stacks to CHAT_PROFILE_DIR every interval seconds
+CHAT_PROFILE_SAMPLE_RATE = 0
+CHAT_PROFILE_DIR = BASE_DIR / 'profiles'
+CHAT_PROFILE_FLUSH_INTERVAL = 60
+
+# Processes hashing passwords for bulk user provisioning (None uses every CPU,
+# 0 hashes in the request thread), users inserted per batch and the most users
+# one request may create
+CHAT_PROVISION_WORKERS = None
+CHAT_PROVISION_BATCH_SIZE = 500
+CHAT_PROVISION_MAX_USERS = 10000
+
+# Sessions kept in the in-process cache of group.sessions and for how many seconds.
+# Logouts reach the other workers through the default cache.
+CHAT_SESSION_CACHE_SIZE = 10000
+CHAT_SESSION_CACHE_TTL = 300
+
+# Most messages returned by one delta-sync request, and the longest long-poll in seconds
+CHAT_SYNC_LIMIT = 200
+CHAT_SYNC_MAX_WAIT = 30
+
+# Mentions are indexed by a background worker in batches of up to this many
+# messages, waiting at most this many seconds for a batch to fill up
+CHAT_MENTIONS_BATCH_SIZE = 500
+CHAT_MENTIONS_BATCH_WAIT = 0.5
+# Mentions shown per page of the inbox
+CHAT_MENTIONS_PAGE_SIZE = 50
+
+# Databases read-only queries are spread over, and for how many seconds a user
+# who just wrote keeps reading from the primary
+CHAT_READ_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+CHAT_REPLICA_PIN_SECONDS = 10
+
+# Attachments are stored under this directory by content hash, uploaded in chunks
+# of at most CHAT_ATTACHMENT_CHUNK_SIZE bytes, and uploads expire after a day
+CHAT_ATTACHMENTS_DIR = BASE_DIR / 'attachments'
+CHAT_ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+CHAT_ATTACHMENT_MAX_SIZE = 100 * 1024 * 1024
+CHAT_ATTACHMENT_UPLOAD_MAX_AGE = 24 * 60 * 60
+
+# Most WebSockets per worker process and per room across workers (None for no limit)
+CHAT_MAX_CONNECTIONS = 10000
+CHAT_MAX_ROOM_CONNECTIONS = None
+# A draining worker tells clients to reconnect within this many seconds, waits up to
+# CHAT_DRAIN_TIMEOUT seconds for them to leave, and starts draining on this signal
+CHAT_DRAIN_RECONNECT_SPREAD = 30
+CHAT_DRAIN_TIMEOUT = 10
+CHAT_DRAIN_SIGNAL = 'SIGUSR1'
+
+# Rooms one multiplexed WebSocket at ws/ may subscribe to
+CHAT_MAX_SUBSCRIPTIONS = 50
+
+# Days of history the rollup_activity job counts per transaction, and the longest
+# window the activity endpoints answer for
+CHAT_ACTIVITY_BATCH_DAYS = 7
+CHAT_ACTIVITY_MAX_DAYS = 366
+
+# PRAGMAs run on every new SQLite connection by group.sqlite: WAL so reads go on
+# while a write commits, a 5 second wait for locks instead of "database is locked",
+# syncing to disk at checkpoints only, and 256 MB mapped plus 64 MB of page cache
+CHAT_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'busy_timeout': 5000,
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+}
+# Chat messages and likes from WebSockets are written by a single writer thread
+CHAT_DB_WRITER = True